@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Benchmark từng bước của pipeline xử lý khung hình.
+
+Phát lại một thư mục ảnh JPEG/PNG hoặc một file video qua các bước của
+process_frame_from_client: decode base64, imdecode, lật + đổi màu, Face Detection,
+Face Mesh, calculate_face_rotation, vẽ overlay và imencode. Kết quả gồm độ trễ
+p50/p95/p99 của từng bước, số khung hình/giây và bộ nhớ RSS cao nhất, xuất ra JSON
+để so sánh giữa các lần chạy (--compare).
+
+Ví dụ:
+    python benchmark.py frames/ --output baseline.json
+    python benchmark.py video.mp4 --limit 300 --compare baseline.json
+"""
+
+import argparse
+import base64
+import json
+import os
+import platform
+import sys
+import time
+
+import cv2
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+
+# Thứ tự các bước trong báo cáo
+STAGES = [
+    "base64_decode",
+    "imdecode",
+    "flip_cvtcolor",
+    "face_detection",
+    "face_mesh",
+    "rotation",
+    "overlay",
+    "imencode",
+    "pipeline",
+    "end_to_end"
+]
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def parse_args():
+    """Phân tích các đối số dòng lệnh."""
+    parser = argparse.ArgumentParser(description='Benchmark từng bước của pipeline xử lý khung hình')
+    parser.add_argument('input', help='Thư mục ảnh (.jpg/.jpeg/.png) hoặc file video')
+    parser.add_argument('--limit', type=int, default=0, help='Số khung hình tối đa được nạp (mặc định: tất cả)')
+    parser.add_argument('--repeat', type=int, default=1, help='Số lần phát lại toàn bộ tập khung hình (mặc định: 1)')
+    parser.add_argument('--warmup', type=int, default=5, help='Số khung hình chạy trước không tính thời gian (mặc định: 5)')
+    parser.add_argument('--output', help='Ghi kết quả JSON vào file thay vì in ra màn hình')
+    parser.add_argument('--compare', help='File JSON của lần chạy trước để so sánh')
+    return parser.parse_args()
+
+
+def load_frames(path, limit=0):
+    """Nạp khung hình dạng bytes JPEG (giống dữ liệu client gửi lên) từ thư mục ảnh hoặc video"""
+    frames = []
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            file_path = os.path.join(path, name)
+            if name.lower().endswith(".png"):
+                image = cv2.imread(file_path)
+                if image is None:
+                    continue
+                _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 85])
+                frames.append(buffer.tobytes())
+            else:
+                with open(file_path, "rb") as f:
+                    frames.append(f.read())
+            if limit and len(frames) >= limit:
+                break
+    else:
+        capture = cv2.VideoCapture(path)
+        if not capture.isOpened():
+            raise ValueError(f"Không thể mở video: {path}")
+        try:
+            while not limit or len(frames) < limit:
+                ok, image = capture.read()
+                if not ok:
+                    break
+                _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 85])
+                frames.append(buffer.tobytes())
+        finally:
+            capture.release()
+    return frames
+
+
+def peak_rss_mb():
+    """Bộ nhớ RSS cao nhất của tiến trình (MB); ru_maxrss là KB trên Linux, byte trên macOS
+
+    Trên Windows dùng peak working set của psutil nếu đã cài, None nếu không đo được.
+    """
+    if resource is None:
+        if psutil is None:
+            return None
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+class StageTimer:
+    """Ghi thời gian (ms) của từng bước cho mỗi khung hình"""
+
+    def __init__(self):
+        self.samples = {stage: [] for stage in STAGES}
+        self.enabled = True
+
+    def measure(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        if self.enabled:
+            self.samples[stage].append((time.perf_counter() - start) * 1000)
+        return result
+
+    def summary(self):
+        report = {}
+        for stage, samples in self.samples.items():
+            if not samples:
+                continue
+            values = np.asarray(samples)
+            report[stage] = {
+                "count": len(values),
+                "mean_ms": round(float(values.mean()), 3),
+                "p50_ms": round(float(np.percentile(values, 50)), 3),
+                "p95_ms": round(float(np.percentile(values, 95)), 3),
+                "p99_ms": round(float(np.percentile(values, 99)), 3),
+                "max_ms": round(float(values.max()), 3)
+            }
+        return report
+
+
+def run_stages(app, graphs, timer, frame_bytes):
+    """Chạy từng bước của pipeline cho một khung hình (không dùng chế độ kết hợp hay ROI)"""
+    pipeline_start = time.perf_counter()
+    data_url = "data:image/jpeg;base64," + base64.b64encode(frame_bytes).decode("ascii")
+    encoded = data_url.split(',')[1]
+    raw = timer.measure("base64_decode", base64.b64decode, encoded)
+    frame = timer.measure("imdecode", cv2.imdecode, np.frombuffer(raw, np.uint8), cv2.IMREAD_COLOR)
+
+    def flip_and_convert(image):
+        flipped = cv2.flip(image, 1)
+        return flipped, cv2.cvtColor(flipped, cv2.COLOR_BGR2RGB)
+
+    image, image_rgb = timer.measure("flip_cvtcolor", flip_and_convert, frame)
+    detection_results, _ = timer.measure("face_detection", graphs.process, image_rgb, True, False)
+    _, face_landmarks_list = timer.measure("face_mesh", graphs.process, image_rgb, False, True)
+
+    rotation = None
+    if face_landmarks_list:
+        rotation = timer.measure("rotation", app.calculate_face_rotation, face_landmarks_list[0], image)
+
+    def draw_overlay():
+        if detection_results and detection_results.detections:
+            for detection in detection_results.detections:
+                app.mp_drawing.draw_detection(image, detection)
+            app.draw_real_face_score(image)
+        if rotation is not None:
+            roll, pitch, yaw = rotation
+            app.draw_rotation_overlay(image, roll, pitch, yaw, *app.analyze_rotation_direction(roll, pitch, yaw))
+
+    timer.measure("overlay", draw_overlay)
+    timer.measure("imencode", app.encode_frame, image, True)
+    if timer.enabled:
+        timer.samples["pipeline"].append((time.perf_counter() - pipeline_start) * 1000)
+
+
+def run_benchmark(frames, repeat=1, warmup=5):
+    # Import ở đây để thời gian nạp MediaPipe không tính vào benchmark
+    from main import FaceDetectionApp, FaceGraphs
+
+    stage_graphs = FaceGraphs()
+    stage_app = FaceDetectionApp(stage_graphs)
+    end_to_end_app = FaceDetectionApp()
+    timer = StageTimer()
+
+    # Chạy trước vài khung hình để khởi tạo đồ thị MediaPipe
+    timer.enabled = False
+    for frame_bytes in frames[:warmup]:
+        run_stages(stage_app, stage_graphs, timer, frame_bytes)
+        end_to_end_app.process_frame_from_client(frame_bytes, as_base64=True)
+    timer.enabled = True
+
+    # Các bước riêng lẻ (mỗi mô hình chạy trên toàn khung hình)
+    stage_start = time.perf_counter()
+    for _ in range(repeat):
+        for frame_bytes in frames:
+            run_stages(stage_app, stage_graphs, timer, frame_bytes)
+    stage_elapsed = time.perf_counter() - stage_start
+
+    # Toàn bộ process_frame_from_client với cấu hình hiện tại (chế độ kết hợp, tracking ROI...)
+    end_to_end_start = time.perf_counter()
+    for _ in range(repeat):
+        for frame_bytes in frames:
+            timer.measure("end_to_end", end_to_end_app.process_frame_from_client, frame_bytes, True)
+    end_to_end_elapsed = time.perf_counter() - end_to_end_start
+
+    total_frames = len(frames) * repeat
+    stage_graphs.close()
+    peak_rss = peak_rss_mb()
+    return {
+        "frames": total_frames,
+        "stages": timer.summary(),
+        "fps": {
+            "pipeline": round(total_frames / stage_elapsed, 2) if stage_elapsed > 0 else 0.0,
+            "end_to_end": round(total_frames / end_to_end_elapsed, 2) if end_to_end_elapsed > 0 else 0.0
+        },
+        "peak_rss_mb": round(peak_rss, 1) if peak_rss is not None else None
+    }
+
+
+def compare_reports(current, baseline):
+    """Tỷ lệ thay đổi p50/p95/p99 của từng bước so với lần chạy trước (âm = nhanh hơn)"""
+    changes = {}
+    for stage, stats in current["stages"].items():
+        base_stats = baseline.get("stages", {}).get(stage)
+        if not base_stats:
+            continue
+        changes[stage] = {
+            key: round((stats[key] - base_stats[key]) / base_stats[key] * 100, 1) if base_stats[key] else None
+            for key in ("p50_ms", "p95_ms", "p99_ms")
+        }
+    return {
+        "baseline": baseline.get("input"),
+        "stages_change_pct": changes,
+        "fps_change_pct": {
+            key: round((value - baseline["fps"][key]) / baseline["fps"][key] * 100, 1)
+            for key, value in current["fps"].items()
+            if baseline.get("fps", {}).get(key)
+        },
+        "peak_rss_change_mb": (
+            round(current["peak_rss_mb"] - baseline["peak_rss_mb"], 1)
+            if current["peak_rss_mb"] is not None and baseline.get("peak_rss_mb") is not None else None
+        )
+    }
+
+
+def main():
+    """Hàm main để chạy benchmark."""
+    args = parse_args()
+    frames = load_frames(args.input, args.limit)
+    if not frames:
+        print(f"Không tìm thấy khung hình nào trong {args.input}", file=sys.stderr)
+        sys.exit(1)
+
+    report = {
+        "input": args.input,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "opencv": cv2.__version__
+        },
+        "config": {
+            key: os.environ[key]
+            for key in ("DETECTION_INTERVAL", "ROI_TRACKING", "ROI_INPUT_SIZE", "INFERENCE_WORKERS", "MOTION_GATE", "MOTION_THRESHOLD")
+            if key in os.environ
+        }
+    }
+    report.update(run_benchmark(frames, repeat=args.repeat, warmup=args.warmup))
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            report["comparison"] = compare_reports(report, json.load(f))
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Chọn ảnh chụp tốt nhất trong một cửa sổ khung hình cho mỗi hướng.
+
+Thay vì lưu ngay khung hình đầu tiên đạt ngưỡng góc xoay (thường bị mờ vì đang
+chuyển động), mỗi khung hình đạt tiêu chí được chấm điểm nhanh trên vùng khuôn mặt
+đã thu nhỏ: độ nét (phương sai Laplacian), độ phơi sáng và khoảng cách tới tư thế
+mục tiêu của hướng. Bộ đệm chỉ giữ buffer_size ứng viên tốt nhất (ảnh vùng khuôn
+mặt cỡ roi_size, không giữ cả khung hình) nên bộ nhớ bị giới hạn. Khi cửa sổ đóng
+(đủ số khung hình hoặc thời gian, hoặc người dùng rời tư thế), chỉ ứng viên tốt
+nhất được lưu.
+"""
+
+import heapq
+import itertools
+import time
+
+import cv2
+import numpy as np
+
+# Tư thế mục tiêu (yaw, pitch) của từng hướng, theo quy ước dấu của analyze_rotation_direction
+TARGET_POSES = {
+    "straight": (0.0, 0.0),
+    "left": (-25.0, 0.0),
+    "right": (25.0, 0.0),
+    "up": (0.0, -15.0),
+    "down": (0.0, 18.0)
+}
+
+# Phương sai Laplacian cho điểm độ nét 0.5 và độ lệch góc (độ) cho điểm tư thế 0.5
+SHARPNESS_REF = 100.0
+POSE_REF = 15.0
+
+# Trọng số của các thành phần trong điểm ứng viên
+SHARPNESS_WEIGHT = 0.5
+EXPOSURE_WEIGHT = 0.2
+POSE_WEIGHT = 0.3
+
+
+def quality_scores(face_image, direction_key, rotation):
+    """Điểm độ nét, phơi sáng, tư thế (0-1) và điểm tổng của ảnh vùng khuôn mặt BGR"""
+    gray = cv2.cvtColor(face_image, cv2.COLOR_BGR2GRAY)
+    sharpness = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    sharpness_score = sharpness / (sharpness + SHARPNESS_REF)
+
+    # Phơi sáng: độ sáng trung bình gần mức giữa và ít điểm ảnh bị cháy/bị tối hoàn toàn
+    mean = float(gray.mean())
+    clipped = float(np.count_nonzero((gray < 10) | (gray > 245))) / gray.size
+    exposure_score = max(0.0, 1.0 - abs(mean - 128.0) / 128.0 - clipped)
+
+    target_yaw, target_pitch = TARGET_POSES[direction_key]
+    distance = float(np.hypot(rotation["yaw"] - target_yaw, rotation["pitch"] - target_pitch))
+    pose_score = 1.0 / (1.0 + (distance / POSE_REF) ** 2)
+
+    return {
+        "score": round(SHARPNESS_WEIGHT * sharpness_score + EXPOSURE_WEIGHT * exposure_score + POSE_WEIGHT * pose_score, 4),
+        "sharpness": round(sharpness, 1),
+        "exposure": round(exposure_score, 3),
+        "pose": round(pose_score, 3)
+    }
+
+
+class CaptureSelector:
+    """Cửa sổ chọn ảnh của một phiên: tối đa buffer_size ứng viên cho hướng đang chụp"""
+
+    def __init__(self, buffer_size=3, window_frames=5, window_seconds=1.5, roi_size=160):
+        self.buffer_size = max(1, buffer_size)
+        self.window_frames = max(1, window_frames)
+        self.window_seconds = window_seconds
+        self.roi_size = roi_size
+        self.order = itertools.count()  # Phân định thứ tự khi hai ứng viên cùng điểm
+        self.committed = 0
+        self.candidates_seen = 0
+        self.reset()
+
+    def reset(self):
+        """Bỏ cửa sổ đang mở (khi bắt đầu phiên chụp mới)"""
+        self.direction = None  # Hướng (tiếng Việt, như get_capture_direction) của cửa sổ đang mở
+        self.heap = []         # Min-heap (điểm, thứ tự, ứng viên): ứng viên kém nhất ở đầu
+        self.frames = 0
+        self.opened_at = 0.0
+
+    def offer(self, direction, direction_key, face_image, analysis):
+        """Thêm khung hình đạt tiêu chí của direction vào cửa sổ (mở cửa sổ mới nếu chưa có)
+
+        Trả về ứng viên tốt nhất của cửa sổ trước nếu cửa sổ đó bị đóng vì hướng đã thay đổi.
+        """
+        closed = None
+        if self.direction is not None and self.direction != direction:
+            closed = self.close()
+        if self.direction is None:
+            self.direction = direction
+            self.opened_at = time.monotonic()
+
+        # Vùng khuôn mặt thu nhỏ về cỡ cố định: giới hạn bộ nhớ và để độ nét so sánh được giữa các ứng viên
+        roi = cv2.resize(face_image, (self.roi_size, self.roi_size), interpolation=cv2.INTER_AREA)
+        quality = quality_scores(roi, direction_key, analysis["rotation"])
+        candidate = {"face_image": roi, "analysis": analysis, "quality": quality}
+        entry = (quality["score"], next(self.order), candidate)
+        if len(self.heap) < self.buffer_size:
+            heapq.heappush(self.heap, entry)
+        elif entry[0] > self.heap[0][0]:
+            heapq.heapreplace(self.heap, entry)
+        self.frames += 1
+        self.candidates_seen += 1
+        return closed
+
+    def due(self):
+        """Cửa sổ đang mở đã đủ số khung hình hoặc hết thời gian"""
+        if self.direction is None:
+            return False
+        return self.frames >= self.window_frames or time.monotonic() - self.opened_at >= self.window_seconds
+
+    def close(self):
+        """Đóng cửa sổ đang mở, trả về (hướng, ứng viên tốt nhất) hoặc None nếu không có cửa sổ"""
+        if self.direction is None or not self.heap:
+            self.reset()
+            return None
+        direction = self.direction
+        best = max(self.heap, key=lambda entry: (entry[0], -entry[1]))[2]
+        self.reset()
+        self.committed += 1
+        return direction, best
+
+    def stats(self):
+        return {
+            "open_direction": self.direction,
+            "buffered": len(self.heap),
+            "candidates_seen": self.candidates_seen,
+            "committed": self.committed
+        }
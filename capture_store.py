@@ -0,0 +1,197 @@
+"""
+Kho lưu ảnh chụp có chỉ mục.
+
+Thay cho các cặp file JPEG + JSON rời trong một thư mục phẳng, ảnh JPEG được ghi
+nối tiếp vào một file pack cho mỗi phiên chụp (packs/<session_id>.pack), còn
+metadata và vị trí của ảnh trong pack được lưu trong SQLite (captures.db) với
+chỉ mục theo mã nhân viên, phiên, phòng ban, hướng và thời gian. Dữ liệu được
+giữ nguyên sau khi khởi động lại server.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT NOT NULL UNIQUE,
+    session_id TEXT,
+    employee_id TEXT,
+    fullname TEXT,
+    email TEXT,
+    department TEXT,
+    direction TEXT,
+    original_direction TEXT,
+    timestamp TEXT,
+    real_face_score REAL,
+    roll REAL,
+    pitch REAL,
+    yaw REAL,
+    client_ip TEXT,
+    pack TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    metadata TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_captures_employee ON captures (employee_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_captures_session ON captures (session_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_captures_department ON captures (department, timestamp);
+CREATE INDEX IF NOT EXISTS idx_captures_direction ON captures (direction, timestamp);
+CREATE INDEX IF NOT EXISTS idx_captures_timestamp ON captures (timestamp);
+"""
+
+# Tham số truy vấn -> điều kiện SQL
+QUERY_FILTERS = {
+    "employee_id": "employee_id = ?",
+    "session_id": "session_id = ?",
+    "department": "department = ?",
+    "direction": "direction = ?",
+    "since": "timestamp >= ?",
+    "until": "timestamp <= ?"
+}
+
+MAX_QUERY_LIMIT = 1000
+
+
+class CaptureStore:
+    """Lưu ảnh chụp vào file pack theo phiên và metadata vào SQLite"""
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.pack_dir = os.path.join(root_dir, "packs")
+        os.makedirs(self.pack_dir, exist_ok=True)
+        self.db_path = os.path.join(root_dir, "captures.db")
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def _pack_path(self, session_id):
+        pack_name = f"{session_id or 'unknown'}.pack"
+        return pack_name, os.path.join(self.pack_dir, pack_name)
+
+    def add(self, filename, image_bytes, metadata):
+        """Ghi nối ảnh JPEG vào pack của phiên và thêm metadata vào chỉ mục"""
+        user_info = metadata.get("user_info", {})
+        rotation = metadata.get("rotation", {})
+        with self.lock:
+            pack_name, pack_path = self._pack_path(metadata.get("session_id"))
+            with open(pack_path, "ab") as f:
+                offset = f.tell()
+                f.write(image_bytes)
+            self.db.execute(
+                "INSERT OR REPLACE INTO captures (filename, session_id, employee_id, fullname, email, department, "
+                "direction, original_direction, timestamp, real_face_score, roll, pitch, yaw, client_ip, "
+                "pack, offset, length, metadata) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    filename,
+                    metadata.get("session_id"),
+                    user_info.get("employeeId"),
+                    user_info.get("fullname"),
+                    user_info.get("email"),
+                    user_info.get("department"),
+                    metadata.get("direction"),
+                    metadata.get("original_direction"),
+                    metadata.get("timestamp"),
+                    metadata.get("real_face_score"),
+                    rotation.get("roll"),
+                    rotation.get("pitch"),
+                    rotation.get("yaw"),
+                    metadata.get("client_ip"),
+                    pack_name,
+                    offset,
+                    len(image_bytes),
+                    json.dumps(metadata, ensure_ascii=False)
+                )
+            )
+            self.db.commit()
+
+    def read_image(self, filename):
+        """Đọc bytes JPEG của ảnh theo tên file, None nếu không có trong kho"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT pack, offset, length FROM captures WHERE filename = ?", (filename,)
+            ).fetchone()
+        if row is None:
+            return None
+        with open(os.path.join(self.pack_dir, row["pack"]), "rb") as f:
+            f.seek(row["offset"])
+            return f.read(row["length"])
+
+    def get_metadata(self, filename):
+        """Metadata của ảnh theo tên file, None nếu không có trong kho"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT metadata FROM captures WHERE filename = ?", (filename,)
+            ).fetchone()
+        return json.loads(row["metadata"]) if row is not None else None
+
+    def query(self, limit=100, offset=0, **filters):
+        """Tìm ảnh theo employee_id/session_id/department/direction và khoảng thời gian (since/until)
+
+        Thời gian có định dạng giống metadata ("%Y%m%d_%H%M%S"). Kết quả mới nhất trước.
+        """
+        conditions = []
+        params = []
+        for key, value in filters.items():
+            if key not in QUERY_FILTERS:
+                raise ValueError(f"Tham số truy vấn không hợp lệ: {key}")
+            if value is not None:
+                conditions.append(QUERY_FILTERS[key])
+                params.append(value)
+
+        sql = "SELECT filename, metadata FROM captures"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?"
+        params.extend([max(0, min(int(limit), MAX_QUERY_LIMIT)), max(0, int(offset))])
+
+        with self.lock:
+            rows = self.db.execute(sql, params).fetchall()
+        return [
+            {"filename": row["filename"], "url": f"/temp_captures/{row['filename']}", **json.loads(row["metadata"])}
+            for row in rows
+        ]
+
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM captures").fetchone()[0]
+
+    def import_legacy_files(self, directory):
+        """Nhập các cặp file .jpg/.json rời (định dạng cũ) trong thư mục vào kho
+
+        Bỏ qua các ảnh đã có trong chỉ mục; không xóa file gốc. Trả về số ảnh đã nhập.
+        """
+        with self.lock:
+            known = {row[0] for row in self.db.execute("SELECT filename FROM captures")}
+
+        imported = 0
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(".jpg") or name in known:
+                continue
+            image_path = os.path.join(directory, name)
+            metadata_path = os.path.splitext(image_path)[0] + ".json"
+            try:
+                metadata = {}
+                if os.path.exists(metadata_path):
+                    with open(metadata_path, "r", encoding="utf-8") as f:
+                        metadata = json.load(f)
+                with open(image_path, "rb") as f:
+                    image_bytes = f.read()
+                self.add(name, image_bytes, metadata)
+                imported += 1
+            except Exception as e:
+                logger.error(f"Lỗi khi nhập ảnh {name}: {e}")
+        return imported
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,161 @@
+"""
+Hàng đợi ghi ảnh chụp ra đĩa ở nền.
+
+Việc resize, encode JPEG và ghi ảnh cùng metadata vào kho ảnh (CaptureStore)
+được chuyển khỏi luồng xử lý request sang các thread ghi. Hàng đợi có giới hạn; khi đầy, ảnh
+được ghi đồng bộ ngay trong request (backpressure) thay vì bị bỏ mất.
+Các file đang chờ ghi được theo dõi để route phục vụ ảnh có thể đợi đến khi
+ghi xong, và hàng đợi được flush khi tắt ứng dụng.
+"""
+
+import atexit
+import logging
+import queue
+import threading
+import time
+
+import cv2
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_WRITE_SECONDS = Histogram("face_app_capture_write_seconds", "Thời gian encode và ghi một ảnh chụp vào kho")
+CAPTURES_TOTAL = Counter("face_app_captures_total", "Số ảnh chụp đã ghi theo hướng và kết quả")
+
+
+class CaptureWriter:
+    """Ghi ảnh chụp và metadata bằng các thread nền với hàng đợi giới hạn"""
+
+    def __init__(self, store, num_threads=1, max_queue=64, image_size=(128, 128), jpeg_quality=80, on_write=None):
+        self.store = store
+        self.on_write = on_write  # Hàm gọi sau khi ghi xong: on_write(ảnh đã resize, tên file, metadata)
+        self.image_size = image_size
+        self.jpeg_quality = jpeg_quality
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.pending = {}  # tên file -> threading.Event, set khi đã ghi xong
+        self.written = 0
+        self.failed = 0
+        self.sync_writes = 0
+        self.total_write_time = 0.0
+        self.max_write_time = 0.0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.threads = [
+            threading.Thread(target=self._run, name=f"capture-writer-{index}", daemon=True)
+            for index in range(num_threads)
+        ]
+        for thread in self.threads:
+            thread.start()
+        atexit.register(self.close)
+
+    def submit(self, face_image, filename, metadata):
+        """Đưa ảnh khuôn mặt (chưa resize) và metadata vào hàng đợi ghi
+
+        Trả về ngay; dùng wait(tên file) để chờ ảnh được ghi xong.
+        """
+        done = threading.Event()
+        with self.lock:
+            self.pending[filename] = done
+
+        job = (face_image, filename, metadata, done)
+        if self.closed:
+            self._write(job)
+            return
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            # Hàng đợi đầy: ghi đồng bộ để không mất ảnh
+            with self.lock:
+                self.sync_writes += 1
+            logger.warning("Hàng đợi ghi ảnh đầy, ghi đồng bộ trong request")
+            self._write(job)
+
+    def wait(self, filename, timeout=5.0):
+        """Chờ file đang trong hàng đợi được ghi xong. Trả về False nếu hết thời gian chờ"""
+        with self.lock:
+            done = self.pending.get(filename)
+        if done is None:
+            return True
+        return done.wait(timeout)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                self._write(job)
+            finally:
+                self.queue.task_done()
+
+    def _write(self, job):
+        face_image, filename, metadata, done = job
+        start_time = time.time()
+        try:
+            # Nén hình và đổi kích thước
+            resized_face = cv2.resize(face_image, self.image_size, interpolation=cv2.INTER_AREA)
+            ok, buffer = cv2.imencode('.jpg', resized_face, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+            if not ok:
+                raise ValueError("Không thể encode ảnh JPEG")
+
+            # Ghi ảnh và metadata vào kho ảnh
+            self.store.add(filename, buffer.tobytes(), metadata)
+            succeeded = True
+        except Exception as e:
+            logger.error(f"Lỗi khi ghi ảnh {filename}: {e}")
+            succeeded = False
+
+        if succeeded and self.on_write is not None:
+            try:
+                self.on_write(resized_face, filename, metadata)
+            except Exception as e:
+                logger.error(f"Lỗi khi xử lý ảnh {filename} sau khi ghi: {e}")
+
+        elapsed = time.time() - start_time
+        CAPTURE_WRITE_SECONDS.observe(elapsed)
+        CAPTURES_TOTAL.inc(direction=metadata.get("direction", "unknown"), status="ok" if succeeded else "error")
+        with self.lock:
+            if succeeded:
+                self.written += 1
+            else:
+                self.failed += 1
+            self.total_write_time += elapsed
+            self.max_write_time = max(self.max_write_time, elapsed)
+            self.pending.pop(filename, None)
+        done.set()
+
+    def flush(self):
+        """Chờ đến khi tất cả ảnh trong hàng đợi đã được ghi"""
+        self.queue.join()
+
+    def stats(self):
+        with self.lock:
+            completed = self.written + self.failed
+            return {
+                "queue_depth": self.queue.qsize(),
+                "pending": len(self.pending),
+                "written": self.written,
+                "failed": self.failed,
+                "sync_writes": self.sync_writes,
+                "avg_write_ms": round(self.total_write_time / completed * 1000, 2) if completed else 0.0,
+                "max_write_ms": round(self.max_write_time * 1000, 2)
+            }
+
+    def close(self):
+        """Flush hàng đợi và dừng các thread ghi"""
+        if self.closed:
+            return
+        self.closed = True
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        # Ghi nốt các ảnh được đưa vào sau khi các thread đã dừng
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                self._write(job)
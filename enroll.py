@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Đăng ký hàng loạt nhân viên từ thư mục ảnh/video.
+
+Mỗi thư mục con là một nhân viên (tên thư mục là mã nhân viên) chứa ảnh và/hoặc
+video; file ảnh/video nằm trực tiếp trong thư mục gốc cũng được coi là một nhân
+viên (tên file là mã nhân viên). Thông tin nhân viên lấy từ file CSV (--manifest,
+các cột employeeId, fullname, email, department) hoặc info.json trong thư mục
+của nhân viên.
+
+Khung hình được xử lý bằng cùng logic với kiosk (process_image,
+calculate_face_rotation, check_and_capture_face, crop_face_from_image) trên một
+pool tiến trình; ảnh chụp và metadata được ghi vào kho ảnh giống như
+save_image_to_temp và đặc trưng khuôn mặt được thêm vào chỉ mục nhận diện.
+Tiến độ được ghi vào file JSONL nên có thể chạy tiếp sau khi bị dừng.
+Chỉ tiến trình chính ghi vào chỉ mục (worker không mở chỉ mục); chỉ mục có khóa
+file giữa các tiến trình nên có thể chạy khi server đang hoạt động, server tự nạp
+các vector mới.
+
+Ví dụ:
+    python enroll.py hr_photos/ --manifest employees.csv --processes 4
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov", ".mkv", ".webm")
+
+# Trạng thái của tiến trình worker (khởi tạo trong init_worker)
+_worker = {}
+
+
+def parse_args():
+    """Phân tích các đối số dòng lệnh."""
+    parser = argparse.ArgumentParser(description='Đăng ký hàng loạt nhân viên từ thư mục ảnh/video')
+    parser.add_argument('input', help='Thư mục chứa ảnh/video của nhân viên')
+    parser.add_argument('--manifest', help='File CSV thông tin nhân viên (employeeId, fullname, email, department)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                        help='Số tiến trình xử lý song song (mặc định: số nhân CPU)')
+    parser.add_argument('--video-stride', type=int, default=None,
+                        help='Chỉ xử lý 1 trên N khung hình của video (mặc định: VIDEO_STRIDE hoặc 5)')
+    parser.add_argument('--progress', default=None,
+                        help='File JSONL ghi tiến độ để chạy tiếp (mặc định: <input>/.enroll_progress.jsonl)')
+    parser.add_argument('--restart', action='store_true', help='Bỏ qua tiến độ cũ và xử lý lại tất cả')
+    return parser.parse_args()
+
+
+def is_media(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS + VIDEO_EXTENSIONS)
+
+
+def discover_employees(root):
+    """Danh sách (mã nhân viên, thư mục hoặc None, [file ảnh/video]) theo thứ tự tên"""
+    employees = []
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        if os.path.isdir(path):
+            files = [os.path.join(path, f) for f in sorted(os.listdir(path)) if is_media(f)]
+            if files:
+                employees.append((name, path, files))
+        elif is_media(name):
+            employees.append((os.path.splitext(name)[0], None, [path]))
+    return employees
+
+
+def load_manifest(path):
+    """Đọc thông tin nhân viên từ CSV, trả về dict employeeId -> thông tin"""
+    if not path:
+        return {}
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        return {row["employeeId"]: row for row in csv.DictReader(f) if row.get("employeeId")}
+
+
+def employee_info(employee_id, folder, manifest):
+    """Thông tin người dùng giống form đăng ký trên kiosk"""
+    info = dict(manifest.get(employee_id, {}))
+    if not info and folder and os.path.exists(os.path.join(folder, "info.json")):
+        with open(os.path.join(folder, "info.json"), "r", encoding="utf-8") as f:
+            info = json.load(f)
+    return {
+        "fullname": info.get("fullname") or employee_id,
+        "employeeId": employee_id,
+        "email": info.get("email", ""),
+        "department": info.get("department", "")
+    }
+
+
+def load_progress(path):
+    """Các nhân viên đã xử lý xong ở lần chạy trước"""
+    done = set()
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)["employee_id"])
+                except (ValueError, KeyError):
+                    continue
+    return done
+
+
+def read_image(path):
+    import cv2
+
+    return cv2.imread(path)
+
+
+def collect_embedding(face_image, filename, metadata):
+    """Thay cho enroll_capture trong worker: tính đặc trưng nhưng để tiến trình chính ghi vào chỉ mục"""
+    main = _worker["main"]
+    label = main.face_index_label(filename, metadata)
+    if label is not None:
+        _worker["embeddings"].append((main.face_embedder.embed(face_image), label))
+
+
+def init_worker():
+    """Khởi tạo FaceDetectionApp riêng cho mỗi tiến trình worker"""
+    import main
+
+    app = main.FaceDetectionApp()
+    # Ảnh của HR là ảnh tĩnh: không dùng điểm liveness theo thời gian, chạy cả hai mô hình trên mọi khung hình
+    app.liveness_weight = 0.0
+    app.detection_interval = 1
+    main.capture_writer.on_write = collect_embedding
+    _worker.update({"main": main, "app": app, "embeddings": []})
+
+
+def enroll_employee(task):
+    """Xử lý toàn bộ ảnh/video của một nhân viên, trả về thống kê và đặc trưng của ảnh đã chụp"""
+    employee_id, user_info, files, video_stride = task
+    main = _worker["main"]
+    app = _worker["app"]
+    start_time = time.time()
+
+    # Mỗi nhân viên là một phiên chụp mới
+    app.reset_captured_directions()
+    app.user_info = dict(user_info)
+    frames = 0
+    errors = []
+
+    for path in files:
+        try:
+            if path.lower().endswith(VIDEO_EXTENSIONS):
+                # Video được đọc lần lượt và dừng ngay khi đã chụp đủ 5 hướng
+                frames += sum(1 for step in app.capture_from_video(path, video_stride) if step["frame_index"] is not None)
+            else:
+                image = read_image(path)
+                if image is None:
+                    raise ValueError("không đọc được ảnh")
+                # Ảnh tĩnh độc lập với khung hình trước: xóa trạng thái tracking
+                app.reset_tracking()
+                app.liveness.reset()
+                app.capture_from_frame(image)
+                frames += 1
+        except Exception as e:
+            errors.append(f"{os.path.basename(path)}: {e}")
+        if all(app.captured_directions.values()):
+            break
+
+    # Lưu ứng viên tốt nhất của cửa sổ chọn ảnh còn mở, rồi chờ ảnh được ghi vào kho
+    # trước khi báo hoàn thành (tiến trình worker không chạy atexit)
+    app.flush_capture_candidates()
+    main.capture_writer.flush()
+    embeddings = _worker["embeddings"]
+    _worker["embeddings"] = []
+
+    return {
+        "employee_id": employee_id,
+        "files": len(files),
+        "frames": frames,
+        "captures": [image["filename"] for image in app.captured_images],
+        "directions": [direction for direction, captured in app.captured_directions.items() if captured],
+        "errors": errors,
+        "elapsed_s": round(time.time() - start_time, 2),
+        "embeddings": embeddings
+    }
+
+
+def main():
+    """Hàm main để đăng ký hàng loạt."""
+    args = parse_args()
+    if not os.path.isdir(args.input):
+        print(f"Không tìm thấy thư mục: {args.input}", file=sys.stderr)
+        sys.exit(1)
+
+    progress_path = args.progress or os.path.join(args.input, ".enroll_progress.jsonl")
+    if args.restart and os.path.exists(progress_path):
+        os.remove(progress_path)
+    done = load_progress(progress_path)
+    manifest = load_manifest(args.manifest)
+
+    employees = discover_employees(args.input)
+    tasks = [
+        (employee_id, employee_info(employee_id, folder, manifest), files, args.video_stride)
+        for employee_id, folder, files in employees
+        if employee_id not in done
+    ]
+    print(f"Tìm thấy {len(employees)} nhân viên, {len(done)} đã xử lý trước đó, còn {len(tasks)}")
+    if not tasks:
+        return
+
+    # Tiến trình chính là nơi duy nhất ghi vào chỉ mục khuôn mặt
+    from main import face_index
+
+    start_time = time.time()
+    totals = {"employees": 0, "frames": 0, "captures": 0, "without_capture": 0}
+    context = multiprocessing.get_context("spawn")
+    processes = max(1, min(args.processes, len(tasks)))
+    with context.Pool(processes, initializer=init_worker) as pool, \
+            open(progress_path, "a", encoding="utf-8") as progress:
+        for result in pool.imap_unordered(enroll_employee, tasks):
+            for vector, label in result.pop("embeddings"):
+                face_index.add(vector, label)
+            progress.write(json.dumps(result, ensure_ascii=False) + "\n")
+            progress.flush()
+
+            totals["employees"] += 1
+            totals["frames"] += result["frames"]
+            totals["captures"] += len(result["captures"])
+            if not result["captures"]:
+                totals["without_capture"] += 1
+            elapsed = time.time() - start_time
+            print(
+                f"[{totals['employees']}/{len(tasks)}] {result['employee_id']}: "
+                f"{len(result['captures'])} ảnh ({', '.join(result['directions']) or 'không có'}), "
+                f"{totals['frames'] / elapsed:.1f} khung hình/giây, {totals['employees'] / elapsed:.2f} nhân viên/giây"
+            )
+            for error in result["errors"]:
+                print(f"    Lỗi: {error}")
+
+    elapsed = time.time() - start_time
+    totals["elapsed_s"] = round(elapsed, 2)
+    totals["frames_per_s"] = round(totals["frames"] / elapsed, 2) if elapsed > 0 else 0.0
+    print(json.dumps(totals, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
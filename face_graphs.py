@@ -0,0 +1,93 @@
+"""
+Bộ đồ thị MediaPipe (FaceDetection + FaceMesh) của một phiên.
+
+Module này chỉ phụ thuộc NumPy và MediaPipe để các tiến trình worker suy luận
+(inference_engine) chỉ cần import nó khi tạo đồ thị, không phải import main
+(kho ảnh, chỉ mục khuôn mặt, ứng dụng Flask...).
+"""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# MediaPipe chỉ được import khi nạp mô hình (load_models) hoặc khi tạo đồ thị đầu tiên,
+# để việc import main (run.py, benchmark.py...) nhanh
+mp = None
+
+
+def get_mediapipe():
+    """Import MediaPipe ở lần dùng đầu tiên"""
+    global mp
+    if mp is None:
+        import mediapipe
+        mp = mediapipe
+    return mp
+
+
+def landmarks_to_array(face_landmarks):
+    """Chuyển NormalizedLandmarkList của MediaPipe thành mảng NumPy liên tục (N, 3) gồm x, y, z tương đối"""
+    return np.array(
+        [(landmark.x, landmark.y, landmark.z) for landmark in face_landmarks.landmark],
+        dtype=np.float32
+    )
+
+
+class FaceGraphs:
+    """Một bộ đồ thị MediaPipe (FaceDetection + FaceMesh) dùng cho một phiên"""
+
+    def __init__(self):
+        mp = get_mediapipe()
+        
+        # Khởi tạo Face Detection với các tùy chọn
+        self.face_detection = mp.solutions.face_detection.FaceDetection(
+            model_selection=1, 
+            min_detection_confidence=0.5
+        )
+        
+        # Khởi tạo Face Mesh với các tùy chọn
+        self.face_mesh = mp.solutions.face_mesh.FaceMesh(
+            max_num_faces=1,
+            refine_landmarks=True,
+            min_detection_confidence=0.5,
+            min_tracking_confidence=0.5
+        )
+
+    def process(self, image_rgb, detect=True, mesh=True):
+        """Chạy Face Detection và/hoặc Face Mesh trên khung hình RGB
+
+        Trả về (detection_results, face_landmarks), trong đó face_landmarks là danh sách mảng
+        landmark (478, 3) của từng khuôn mặt (None nếu không chạy Face Mesh).
+        """
+        # Xử lý hình ảnh với Face Detection một cách an toàn
+        detection_results = None
+        if detect:
+            try:
+                detection_results = self.face_detection.process(image_rgb)
+            except Exception as e:
+                logger.error(f"Lỗi khi xử lý face detection: {e}")
+                detection_results = None
+        
+        # Xử lý hình ảnh với Face Mesh một cách an toàn
+        face_landmarks = None
+        if mesh:
+            face_landmarks = []
+            try:
+                mesh_results = self.face_mesh.process(image_rgb)
+                # Chuyển landmark sang mảng NumPy một lần duy nhất cho mỗi khung hình
+                if mesh_results.multi_face_landmarks:
+                    face_landmarks = [landmarks_to_array(lms) for lms in mesh_results.multi_face_landmarks]
+            except Exception as e:
+                logger.error(f"Lỗi khi xử lý face mesh: {e}")
+        
+        return detection_results, face_landmarks
+
+    def reset(self):
+        """Xóa trạng thái tracking trước khi giao đồ thị cho phiên khác"""
+        self.face_detection.reset()
+        self.face_mesh.reset()
+
+    def close(self):
+        self.face_detection.close()
+        self.face_mesh.close()
@@ -0,0 +1,295 @@
+"""
+Trích xuất đặc trưng khuôn mặt và chỉ mục so khớp 1:N.
+
+Mỗi ảnh chụp khi đăng ký được chuyển thành một vector đặc trưng ngắn bằng một
+embedder (mặc định là histogram LBP đồng nhất theo lưới ô, chỉ dùng OpenCV/NumPy,
+không cần tải mô hình). Các vector đã chuẩn hóa L2 được lưu trong một ma trận
+float32 nối tiếp trên đĩa (vectors.f32) và được nạp bằng memory-mapping; tìm kiếm
+là một phép nhân ma trận (cosine similarity) cho cả lô truy vấn.
+
+Nhiều tiến trình (server và enroll.py) có thể dùng chung một thư mục chỉ mục: mọi
+lần ghi và nạp lại đều giữ khóa file index.lock, và mỗi tiến trình tự nạp các hàng
+mới khi labels.jsonl lớn lên.
+"""
+
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+# Số hàng của ma trận được nhân mỗi lần khi tìm kiếm (giới hạn bộ nhớ tạm)
+SEARCH_CHUNK_ROWS = 65536
+
+
+def _uniform_lbp_table():
+    """Bảng ánh xạ mã LBP 8 bit -> 59 bin (58 mẫu đồng nhất + 1 bin cho các mẫu còn lại)"""
+    table = np.full(256, 58, dtype=np.int64)
+    next_bin = 0
+    for code in range(256):
+        bits = [(code >> i) & 1 for i in range(8)]
+        transitions = sum(bits[i] != bits[(i + 1) % 8] for i in range(8))
+        if transitions <= 2:
+            table[code] = next_bin
+            next_bin += 1
+    return table
+
+
+class LBPEmbedder:
+    """Đặc trưng histogram LBP đồng nhất trên lưới grid x grid ô của ảnh khuôn mặt xám"""
+
+    name = "lbp"
+    bins = 59
+
+    # Thứ tự 8 điểm lân cận (dy, dx) theo chiều kim đồng hồ
+    NEIGHBORS = [(-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1)]
+
+    def __init__(self, size=128, grid=4):
+        self.size = size
+        self.grid = grid
+        self.dim = grid * grid * self.bins
+        self.table = _uniform_lbp_table()
+
+    def embed(self, face_image):
+        """Trả về vector float32 (dim,) đã chuẩn hóa L2 của ảnh khuôn mặt BGR hoặc xám"""
+        gray = face_image if face_image.ndim == 2 else cv2.cvtColor(face_image, cv2.COLOR_BGR2GRAY)
+        gray = cv2.resize(gray, (self.size, self.size), interpolation=cv2.INTER_AREA)
+        gray = cv2.equalizeHist(gray).astype(np.int16)
+
+        # Mã LBP của các điểm bên trong: mỗi bit là so sánh với một điểm lân cận
+        center = gray[1:-1, 1:-1]
+        h, w = gray.shape
+        codes = np.zeros(center.shape, dtype=np.uint8)
+        for bit, (dy, dx) in enumerate(self.NEIGHBORS):
+            neighbor = gray[1 + dy:h - 1 + dy, 1 + dx:w - 1 + dx]
+            codes |= (neighbor >= center).astype(np.uint8) << bit
+        labels = self.table[codes]
+
+        # Histogram theo từng ô của lưới, tính bằng một lần bincount
+        cell = labels.shape[0] // self.grid
+        labels = labels[:cell * self.grid, :cell * self.grid]
+        cell_rows = np.arange(labels.shape[0]) // cell
+        cell_cols = np.arange(labels.shape[1]) // cell
+        cell_ids = cell_rows[:, None] * self.grid + cell_cols[None, :]
+        histogram = np.bincount(
+            (cell_ids * self.bins + labels).ravel(),
+            minlength=self.dim
+        ).astype(np.float32)
+
+        # Chuẩn hóa Hellinger (căn bậc hai) rồi L2 để dùng cosine similarity
+        vector = np.sqrt(histogram)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+
+# Các backend trích xuất đặc trưng có sẵn (tên -> lớp)
+EMBEDDERS = {
+    LBPEmbedder.name: LBPEmbedder
+}
+
+
+@contextmanager
+def file_lock(path):
+    """Khóa độc quyền giữa các tiến trình bằng file khóa path"""
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def create_embedder(name):
+    if name not in EMBEDDERS:
+        raise ValueError(f"Không hỗ trợ embedder: {name}")
+    return EMBEDDERS[name]()
+
+
+class FaceIndex:
+    """Chỉ mục vector khuôn mặt lưu trên đĩa, nạp bằng memory-mapping, tìm kiếm cosine theo lô
+
+    Thư mục chỉ mục gồm index.json (embedder, số chiều), vectors.f32 (ma trận float32 ghi nối tiếp),
+    labels.jsonl (thông tin nhân viên của từng hàng) và index.lock (khóa giữa các tiến trình).
+    """
+
+    def __init__(self, directory, embedder_name, dim):
+        self.directory = directory
+        self.dim = dim
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.labels_path = os.path.join(directory, "labels.jsonl")
+        self.lock_path = os.path.join(directory, "index.lock")
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        meta_path = os.path.join(directory, "index.json")
+        with file_lock(self.lock_path):
+            if os.path.exists(meta_path):
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                if meta.get("embedder") != embedder_name or meta.get("dim") != dim:
+                    raise ValueError(
+                        f"Chỉ mục tại {directory} được tạo bằng {meta.get('embedder')} ({meta.get('dim')} chiều), "
+                        f"không khớp với {embedder_name} ({dim} chiều)"
+                    )
+            else:
+                with open(meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"embedder": embedder_name, "dim": dim}, f)
+
+            self._repair()
+            self._clear()
+            self._reload()
+        if self.labels:
+            logger.info(f"Đã nạp chỉ mục khuôn mặt với {len(self.labels)} vector")
+
+    def _employee_code(self, label):
+        return self.employee_ids.setdefault(label.get("employee_id"), len(self.employee_ids))
+
+    def _clear(self):
+        """Xóa dữ liệu đã nạp trong bộ nhớ"""
+        self.labels = []
+        self.labels_offset = 0  # Số byte của labels.jsonl đã nạp
+        self.employee_ids = {}  # employee_id -> mã số nguyên dùng cho mảng label_ids
+        self.label_ids = np.zeros(0, dtype=np.int64)
+        self.matrix = None
+        self._map()
+
+    def _repair(self):
+        """Cắt bỏ phần ghi dở (số hàng vector và số nhãn không khớp sau khi dừng đột ngột). Gọi khi giữ khóa file"""
+        lines = []
+        if os.path.exists(self.labels_path):
+            with open(self.labels_path, "rb") as f:
+                data = f.read()
+            lines = data[:data.rfind(b"\n") + 1].splitlines(keepends=True)
+        row_bytes = self.dim * 4
+        size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+        rows = min(size // row_bytes, len(lines))
+        if size != rows * row_bytes:
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(rows * row_bytes)
+        if os.path.exists(self.labels_path) and os.path.getsize(self.labels_path) != sum(map(len, lines[:rows])):
+            with open(self.labels_path, "wb") as f:
+                f.write(b"".join(lines[:rows]))
+
+    def _reload(self):
+        """Nạp các hàng do tiến trình này hoặc tiến trình khác ghi thêm. Gọi khi giữ self.lock và khóa file"""
+        size = os.path.getsize(self.labels_path) if os.path.exists(self.labels_path) else 0
+        if size < self.labels_offset:
+            # File bị cắt bởi _repair của tiến trình khác: nạp lại từ đầu
+            self._clear()
+        if size == self.labels_offset:
+            return
+        with open(self.labels_path, "rb") as f:
+            f.seek(self.labels_offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        new_labels = [json.loads(line) for line in data[:end].decode("utf-8").splitlines() if line.strip()]
+        self.labels_offset += end
+        if new_labels:
+            # Danh sách mới thay vì nối tại chỗ: snapshot của search() không bị thay đổi
+            self.labels = self.labels + new_labels
+            self.label_ids = np.concatenate([
+                self.label_ids,
+                np.array([self._employee_code(label) for label in new_labels], dtype=np.int64)
+            ])
+            self._map()
+
+    def _changed(self):
+        """labels.jsonl có kích thước khác phần đã nạp (tiến trình khác đã ghi thêm)"""
+        try:
+            return os.path.getsize(self.labels_path) != self.labels_offset
+        except OSError:
+            return False
+
+    def _sync(self):
+        """Nạp lại nếu file đã thay đổi. Gọi khi giữ self.lock"""
+        if self._changed():
+            with file_lock(self.lock_path):
+                self._reload()
+
+    def _map(self):
+        """Ánh xạ file vector vào bộ nhớ (chỉ đọc)"""
+        rows = len(self.labels)
+        if rows == 0:
+            self.matrix = np.zeros((0, self.dim), dtype=np.float32)
+        else:
+            self.matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+
+    def add(self, vector, label):
+        """Thêm một vector (dim,) cùng nhãn {"employee_id", "fullname", ...} vào chỉ mục"""
+        vector = np.ascontiguousarray(vector, dtype=np.float32).reshape(self.dim)
+        line = (json.dumps(label, ensure_ascii=False) + "\n").encode("utf-8")
+        with self.lock, file_lock(self.lock_path):
+            # Nạp các hàng của tiến trình khác trước để hàng mới nằm đúng vị trí trong cả hai file
+            self._reload()
+            with open(self.vectors_path, "ab") as f:
+                f.truncate(len(self.labels) * self.dim * 4)  # Bỏ phần vector ghi dở của tiến trình bị dừng
+                f.write(vector.tobytes())
+            with open(self.labels_path, "ab") as f:
+                f.truncate(self.labels_offset)  # Bỏ dòng nhãn ghi dở
+                f.write(line)
+            self._reload()
+
+    def search(self, queries, top_k=5):
+        """Tìm top_k nhân viên giống nhất cho mỗi vector truy vấn
+
+        queries có dạng (dim,) hoặc (Q, dim). Trả về danh sách (một phần tử cho mỗi truy vấn)
+        các kết quả {"score", "employee_id", ...}, mỗi nhân viên xuất hiện tối đa một lần.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        # Ảnh chụp nhất quán của chỉ mục: mọi mảng được cắt theo cùng số hàng có tại thời điểm lấy snapshot
+        with self.lock:
+            self._sync()
+            rows = len(self.labels)
+            matrix = self.matrix[:rows]
+            labels = self.labels[:rows]
+            label_ids = self.label_ids[:rows]
+        if rows == 0:
+            return [[] for _ in range(len(queries))]
+
+        # Cosine similarity cho cả lô truy vấn, nhân từng khối hàng của ma trận
+        scores = np.empty((len(queries), rows), dtype=np.float32)
+        for start in range(0, rows, SEARCH_CHUNK_ROWS):
+            end = start + SEARCH_CHUNK_ROWS
+            scores[:, start:end] = queries @ matrix[start:end].T
+
+        results = []
+        for query_scores in scores:
+            # Ứng viên tốt nhất theo hàng, rồi giữ mỗi nhân viên một kết quả cao nhất
+            candidates = min(len(query_scores), top_k * 20)
+            top_rows = np.argpartition(-query_scores, candidates - 1)[:candidates]
+            top_rows = top_rows[np.argsort(-query_scores[top_rows])]
+            _, first = np.unique(label_ids[top_rows], return_index=True)
+            best_rows = top_rows[np.sort(first)][:top_k]
+            results.append([
+                {"score": round(float(query_scores[row]), 4), **labels[row]}
+                for row in best_rows
+            ])
+        return results
+
+    def stats(self):
+        with self.lock:
+            self._sync()
+            return {
+                "vectors": len(self.labels),
+                "employees": len(self.employee_ids),
+                "dim": self.dim
+            }
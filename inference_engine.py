@@ -0,0 +1,223 @@
+"""
+Engine suy luận đa tiến trình cho MediaPipe.
+
+Chạy N tiến trình worker, mỗi worker có các đồ thị FaceDetection/FaceMesh riêng.
+Khung hình đã decode được chuyển sang worker qua vùng nhớ dùng chung
+(multiprocessing.shared_memory) thay vì pickle; chỉ kết quả nhỏ (detections và
+mảng landmark (478, 3)) được gửi ngược lại qua Pipe.
+
+Mỗi bộ đồ thị trong GraphPool tương ứng với một "slot" cố định trên một worker
+(slot_id % N), nên một phiên luôn được xử lý bởi cùng một worker và FaceMesh
+giữ được trạng thái tracking.
+"""
+
+import atexit
+import logging
+import multiprocessing
+import threading
+from multiprocessing import shared_memory
+from types import SimpleNamespace
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Kích thước tối đa của khung hình RGB truyền qua shared memory (pixel)
+DEFAULT_MAX_FRAME_PIXELS = 1920 * 1080
+
+
+def _worker_main(conn, shm_name, graph_factory):
+    """Vòng lặp của tiến trình worker: nhận khung hình từ shared memory và chạy suy luận"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    graphs = {}  # slot_id -> bộ đồ thị của slot
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+            if message is None:
+                break
+
+            op, slot_id = message[0], message[1]
+            if op == "process":
+                shape, array, detect, mesh = message[2:6]
+                if array is None:
+                    # Khung hình nằm trong shared memory, tạo view không sao chép
+                    image = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+                else:
+                    image = array
+                try:
+                    slot_graphs = graphs.get(slot_id)
+                    if slot_graphs is None:
+                        slot_graphs = graphs[slot_id] = graph_factory()
+                    detection_results, face_landmarks = slot_graphs.process(image, detect, mesh)
+                    conn.send((
+                        "ok",
+                        detection_results.detections if detection_results else None,
+                        face_landmarks
+                    ))
+                except Exception as e:
+                    conn.send(("error", str(e), None))
+                finally:
+                    del image
+            elif op == "reset":
+                slot_graphs = graphs.get(slot_id)
+                if slot_graphs is not None:
+                    slot_graphs.reset()
+    finally:
+        for slot_graphs in graphs.values():
+            slot_graphs.close()
+        shm.close()
+
+
+class _Worker:
+    """Tiến trình worker cùng vùng shared memory và Pipe của nó (phía tiến trình chính)"""
+
+    def __init__(self, index, graph_factory, slot_bytes, context):
+        self.index = index
+        self.graph_factory = graph_factory
+        self.slot_bytes = slot_bytes
+        self.context = context
+        self.lock = threading.Lock()
+        self.process = None
+        self.conn = None
+        self.shm = None
+        self.frames = 0
+        self.restarts = 0
+
+    def ensure_started(self):
+        """Khởi động (hoặc khởi động lại) tiến trình worker nếu cần. Gọi khi đang giữ lock"""
+        if self.process is not None and self.process.is_alive():
+            return
+        if self.process is not None:
+            logger.warning(f"Worker suy luận {self.index} đã dừng, đang khởi động lại")
+            self.restarts += 1
+            self.stop()
+
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slot_bytes)
+        parent_conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(
+            target=_worker_main,
+            args=(child_conn, self.shm.name, self.graph_factory),
+            name=f"inference-worker-{self.index}",
+            daemon=True
+        )
+        try:
+            self.process.start()
+        except Exception:
+            self.process = None
+            parent_conn.close()
+            child_conn.close()
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+            raise
+        child_conn.close()
+        self.conn = parent_conn
+        logger.info(f"Đã khởi động worker suy luận {self.index} (pid {self.process.pid})")
+
+    def process_frame(self, slot_id, image_rgb, detect=True, mesh=True):
+        with self.lock:
+            self.ensure_started()
+            if image_rgb.nbytes <= self.slot_bytes:
+                # Ghi khung hình vào shared memory, chỉ gửi kích thước qua Pipe
+                view = np.ndarray(image_rgb.shape, dtype=np.uint8, buffer=self.shm.buf)
+                np.copyto(view, image_rgb)
+                del view
+                self.conn.send(("process", slot_id, image_rgb.shape, None, detect, mesh))
+            else:
+                # Khung hình quá lớn so với vùng nhớ dùng chung, gửi qua Pipe
+                self.conn.send(("process", slot_id, image_rgb.shape, image_rgb, detect, mesh))
+            try:
+                status, detections, face_landmarks = self.conn.recv()
+            except EOFError:
+                raise RuntimeError(f"Worker suy luận {self.index} đã dừng bất thường")
+            self.frames += 1
+
+        if status != "ok":
+            raise RuntimeError(detections)
+        return SimpleNamespace(detections=detections), face_landmarks
+
+    def reset_slot(self, slot_id):
+        with self.lock:
+            if self.process is not None and self.process.is_alive():
+                self.conn.send(("reset", slot_id))
+
+    def stop(self):
+        if self.conn is not None:
+            try:
+                self.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            self.conn.close()
+            self.conn = None
+        if self.process is not None:
+            self.process.join(timeout=5)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process = None
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class RemoteFaceGraphs:
+    """Bộ đồ thị nằm trong một worker; có cùng giao diện với FaceGraphs (process/reset/close)"""
+
+    def __init__(self, engine, slot_id):
+        self.engine = engine
+        self.slot_id = slot_id
+
+    def process(self, image_rgb, detect=True, mesh=True):
+        return self.engine.process(self.slot_id, image_rgb, detect, mesh)
+
+    def reset(self):
+        self.engine.reset_slot(self.slot_id)
+
+    def close(self):
+        self.reset()
+
+
+class InferenceEngine:
+    """Phân phối suy luận tới N tiến trình worker với session affinity"""
+
+    def __init__(self, graph_factory, num_workers, max_frame_pixels=DEFAULT_MAX_FRAME_PIXELS):
+        context = multiprocessing.get_context("spawn")
+        slot_bytes = max_frame_pixels * 3
+        self.workers = [
+            _Worker(index, graph_factory, slot_bytes, context)
+            for index in range(num_workers)
+        ]
+        self.next_slot_id = 0
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def create_graphs(self):
+        """Factory cho GraphPool: cấp một slot mới, gắn cố định với một worker"""
+        with self.lock:
+            slot_id = self.next_slot_id
+            self.next_slot_id += 1
+        return RemoteFaceGraphs(self, slot_id)
+
+    def _worker_for(self, slot_id):
+        return self.workers[slot_id % len(self.workers)]
+
+    def process(self, slot_id, image_rgb, detect=True, mesh=True):
+        return self._worker_for(slot_id).process_frame(slot_id, image_rgb, detect, mesh)
+
+    def reset_slot(self, slot_id):
+        self._worker_for(slot_id).reset_slot(slot_id)
+
+    def stats(self):
+        return {
+            "workers": len(self.workers),
+            "frames": [worker.frames for worker in self.workers],
+            "restarts": sum(worker.restarts for worker in self.workers)
+        }
+
+    def close(self):
+        for worker in self.workers:
+            with worker.lock:
+                worker.stop()
@@ -0,0 +1,171 @@
+"""
+Phân tích khuôn mặt thật (liveness) theo thời gian.
+
+Mỗi phiên giữ một bộ đệm vòng NumPy cấp phát sẵn chứa đặc trưng của các khung
+hình gần nhất: tỷ lệ mắt (EAR) để phát hiện nháy mắt, chuyển động nhỏ của
+landmark (sau khi loại bỏ dịch chuyển, co giãn và xoay của cả khuôn mặt) và độ
+rung của góc xoay. Tổng của từng cột được cập nhật tăng dần nên mỗi khung hình
+chỉ tốn O(1) theo độ dài lịch sử, và bộ nhớ của mỗi phiên là cố định. Điểm chỉ
+được tính khi bộ đệm phủ ít nhất min_seconds giây (không phải một số khung hình cố
+định), vì client có thể gửi từ 1 đến hàng chục khung hình mỗi giây.
+
+Ảnh in hoặc ảnh trên màn hình không nháy mắt và gần như không có chuyển động
+không cứng của landmark, nên điểm liveness thấp.
+"""
+
+import time
+
+import numpy as np
+
+# Landmark của Face Mesh quanh mắt theo thứ tự p1..p6 của công thức EAR
+LEFT_EYE = [33, 160, 158, 133, 153, 144]
+RIGHT_EYE = [362, 385, 387, 263, 373, 380]
+
+# Mắt được coi là nhắm khi EAR thấp hơn tỷ lệ này so với EAR trung bình của cửa sổ
+BLINK_EAR_RATIO = 0.75
+
+# Ngưỡng chuyển động nhỏ của landmark (đơn vị: bán kính khuôn mặt) cho điểm 0 và điểm tối đa;
+# dưới MOTION_LOW là mức nhiễu của Face Mesh trên ảnh tĩnh
+MOTION_LOW = 0.006
+MOTION_HIGH = 0.02
+
+# Độ rung góc xoay trung bình (độ/khung hình) cho điểm tối đa; mỗi khung hình bị giới hạn
+# ở JITTER_CLIP để các lần quay đầu có chủ đích không lấn át
+JITTER_HIGH = 1.0
+JITTER_CLIP = 5.0
+
+# Số khung hình tối thiểu để có đặc trưng chuyển động (ngoài điều kiện về thời gian)
+MIN_FRAMES = 3
+
+# Trọng số của các thành phần trong điểm liveness
+BLINK_WEIGHT = 0.4
+MOTION_WEIGHT = 0.4
+JITTER_WEIGHT = 0.2
+
+
+def eye_aspect_ratio(points):
+    """EAR trung bình của hai mắt từ tọa độ pixel (N, 2) của landmark"""
+    ratios = []
+    for indices in (LEFT_EYE, RIGHT_EYE):
+        p1, p2, p3, p4, p5, p6 = points[indices]
+        horizontal = np.linalg.norm(p1 - p4)
+        vertical = np.linalg.norm(p2 - p6) + np.linalg.norm(p3 - p5)
+        ratios.append(vertical / (2.0 * horizontal) if horizontal > 0 else 0.0)
+    return float(np.mean(ratios))
+
+
+def normalize_shape(points):
+    """Đưa landmark về tâm (0, 0) và bán kính RMS bằng 1 (loại bỏ dịch chuyển và co giãn)"""
+    centered = points - points.mean(axis=0)
+    scale = np.sqrt((centered ** 2).sum(axis=1).mean())
+    return centered / scale if scale > 0 else centered
+
+
+def shape_motion(previous, current):
+    """Độ lệch trung bình giữa hai hình dạng đã chuẩn hóa sau khi loại bỏ phép xoay (Procrustes)"""
+    u, _, vt = np.linalg.svd(current.T @ previous)
+    if np.linalg.det(u @ vt) < 0:
+        u[:, -1] = -u[:, -1]
+    aligned = current @ (u @ vt)
+    return float(np.sqrt(((aligned - previous) ** 2).sum(axis=1)).mean())
+
+
+class LivenessTracker:
+    """Bộ đệm vòng đặc trưng theo khung hình và điểm liveness cập nhật O(1) cho một phiên"""
+
+    # Các cột của bộ đệm
+    EAR, MOTION, JITTER, BLINK = range(4)
+
+    def __init__(self, window=90, min_seconds=3.0):
+        self.window = window
+        self.min_seconds = min_seconds
+        self.buffer = np.zeros((window, 4), dtype=np.float64)
+        self.times = np.zeros(window, dtype=np.float64)  # Thời điểm của từng hàng trong bộ đệm
+        self.sums = np.zeros(4, dtype=np.float64)
+        self.reset()
+
+    def reset(self):
+        """Xóa lịch sử (khi mất khuôn mặt, khung hình tiếp theo có thể là người khác)"""
+        self.buffer.fill(0.0)
+        self.times.fill(0.0)
+        self.sums.fill(0.0)
+        self.index = 0
+        self.count = 0
+        self.previous_shape = None
+        self.previous_pose = None
+        self.eye_closed = False
+
+    def span(self):
+        """Khoảng thời gian (giây) mà các khung hình trong bộ đệm phủ"""
+        if self.count < 2:
+            return 0.0
+        newest = self.times[self.index - 1]
+        oldest = self.times[self.index] if self.count == self.window else self.times[0]
+        return float(newest - oldest)
+
+    def ready(self):
+        """Đủ lịch sử để chấm điểm: ít nhất MIN_FRAMES khung hình trải trên min_seconds giây (hoặc bộ đệm đã đầy)"""
+        if self.count < MIN_FRAMES:
+            return False
+        return self.count == self.window or self.span() >= self.min_seconds
+
+    def update(self, face_landmarks, rotation, width, height, timestamp=None):
+        """Thêm đặc trưng của một khung hình: landmark (N, 3) tương đối và góc (roll, pitch, yaw)
+
+        timestamp là thời điểm của khung hình (giây, mặc định time.monotonic()).
+        """
+        points = face_landmarks[:, :2].astype(np.float64) * (width, height)
+        ear = eye_aspect_ratio(points)
+
+        shape = normalize_shape(points)
+        motion = shape_motion(self.previous_shape, shape) if self.previous_shape is not None else 0.0
+        self.previous_shape = shape
+
+        pose = np.asarray(rotation, dtype=np.float64)
+        if self.previous_pose is not None:
+            jitter = float(np.minimum(np.abs(pose - self.previous_pose), JITTER_CLIP).mean())
+        else:
+            jitter = 0.0
+        self.previous_pose = pose
+
+        # Nháy mắt: EAR giảm dưới ngưỡng so với mức trung bình rồi mở lại
+        blink = 0.0
+        if self.ready():
+            closed = ear < BLINK_EAR_RATIO * self.sums[self.EAR] / self.count
+            if self.eye_closed and not closed:
+                blink = 1.0
+            self.eye_closed = closed
+
+        # Ghi đè hàng cũ nhất và cập nhật tổng của từng cột
+        row = np.array([ear, motion, jitter, blink])
+        self.sums += row - self.buffer[self.index]
+        self.buffer[self.index] = row
+        self.times[self.index] = time.monotonic() if timestamp is None else timestamp
+        self.index = (self.index + 1) % self.window
+        self.count = min(self.count + 1, self.window)
+        if self.index == 0:
+            # Mỗi vòng tính lại tổng từ bộ đệm để tránh sai số tích lũy
+            self.sums = self.buffer.sum(axis=0)
+
+    def score(self):
+        """Điểm liveness trong [0, 1]; 0 khi lịch sử chưa phủ đủ min_seconds giây"""
+        if not self.ready():
+            return 0.0
+        means = self.sums / self.count
+        blink_score = min(1.0, self.sums[self.BLINK])
+        motion_score = np.clip((means[self.MOTION] - MOTION_LOW) / (MOTION_HIGH - MOTION_LOW), 0.0, 1.0)
+        jitter_score = np.clip(means[self.JITTER] / JITTER_HIGH, 0.0, 1.0)
+        return float(BLINK_WEIGHT * blink_score + MOTION_WEIGHT * motion_score + JITTER_WEIGHT * jitter_score)
+
+    def stats(self):
+        """Các giá trị trung bình của cửa sổ hiện tại (trả về cho client)"""
+        means = self.sums / self.count if self.count else self.sums
+        return {
+            "score": round(self.score(), 4),
+            "frames": self.count,
+            "seconds": round(self.span(), 2),
+            "blinks": int(round(self.sums[self.BLINK])),
+            "ear": round(float(means[self.EAR]), 4),
+            "motion": round(float(means[self.MOTION]), 5),
+            "jitter": round(float(means[self.JITTER]), 4)
+        }
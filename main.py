@@ -1,31 +1,346 @@
 import cv2
-import mediapipe as mp
 import numpy as np
 import math
 import time
 import base64
-from flask import Flask, render_template, Response, request, jsonify, send_from_directory
+import struct
+from flask import Flask, render_template, Response, request, jsonify, g
+from werkzeug.utils import safe_join
 import threading
 import json
 from io import BytesIO
 import logging
+import multiprocessing
 import os
 import socket
 import uuid
 from datetime import datetime
+from session_manager import FrameSlot, GraphPool, SessionManager
+from face_graphs import FaceGraphs, get_mediapipe, landmarks_to_array
+from inference_engine import InferenceEngine
+from capture_writer import CaptureWriter
+from capture_store import CaptureStore
+from face_index import FaceIndex, create_embedder
+from liveness import LivenessTracker
+from motion_gate import MotionGate
+from capture_selector import CaptureSelector
+from thumbnail_cache import ThumbnailCache
+from metrics import REGISTRY, Counter, Gauge, Histogram, suppressed
+
+# WebSocket là tùy chọn (cần gói flask-sock), nếu không có client dùng HTTP polling
+try:
+    from flask_sock import Sock
+except ImportError:
+    Sock = None
 
 # Cấu hình logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def is_child_process():
+    """True khi main được import trong tiến trình con (worker của enroll.py, hoặc worker suy luận khi server
+    được chạy bằng `python main.py` nên spawn nạp lại main.py làm module chính của tiến trình con)"""
+    return (
+        multiprocessing.parent_process() is not None
+        or getattr(multiprocessing.current_process(), "_inheriting", False)
+    )
+
 # Thư mục để lưu ảnh đã chụp
 TEMP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'temp_captures')
 if not os.path.exists(TEMP_DIR):
     os.makedirs(TEMP_DIR)
 
-class FaceDetectionApp:
+# Ghi ảnh chụp ở nền: số thread ghi, kích thước hàng đợi và thời gian tối đa chờ ảnh ghi xong khi phục vụ (giây)
+CAPTURE_WRITER_THREADS = int(os.environ.get("CAPTURE_WRITER_THREADS", 1))
+CAPTURE_QUEUE_SIZE = int(os.environ.get("CAPTURE_QUEUE_SIZE", 64))
+CAPTURE_WAIT_TIMEOUT = float(os.environ.get("CAPTURE_WAIT_TIMEOUT", 5.0))
+# Kho ảnh chụp: ảnh được đóng gói theo phiên trong TEMP_DIR/packs, metadata được đánh chỉ mục trong SQLite
+capture_store = CaptureStore(TEMP_DIR)
+
+# Phục vụ ảnh chụp: tên file chứa thời điểm chụp và phiên nên ảnh không đổi, trình duyệt được cache vĩnh viễn.
+# ?size= trả ảnh thu nhỏ (làm tròn lên một trong THUMBNAIL_SIZES), giữ tối đa THUMBNAIL_CACHE_SIZE ảnh trong bộ nhớ;
+# thư viện ảnh trên giao diện web dùng ảnh thu nhỏ GALLERY_THUMBNAIL_SIZE px
+CAPTURE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+THUMBNAIL_SIZES = [int(size) for size in os.environ.get("THUMBNAIL_SIZES", "48,64,96").split(",") if size.strip()]
+THUMBNAIL_CACHE_SIZE = int(os.environ.get("THUMBNAIL_CACHE_SIZE", 512))
+GALLERY_THUMBNAIL_SIZE = int(os.environ.get("GALLERY_THUMBNAIL_SIZE", 64))
+
+def read_capture_image(filename):
+    """Bytes JPEG của ảnh chụp từ kho ảnh, hoặc từ file rời (định dạng cũ) nếu chưa được nhập vào kho"""
+    image_bytes = capture_store.read_image(filename)
+    if image_bytes is not None:
+        return image_bytes
+    path = safe_join(TEMP_DIR, filename)
+    if path is None or not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+thumbnail_cache = ThumbnailCache(read_capture_image, THUMBNAIL_SIZES, THUMBNAIL_CACHE_SIZE)
+
+# Nhận diện 1:N: backend trích xuất đặc trưng, thư mục chỉ mục, ngưỡng cosine để coi là khớp và khoảng cách tối
+# thiểu giữa nhân viên giống nhất và nhân viên thứ hai. Với đặc trưng LBP, cặp ảnh của hai người khác nhau đã đo được
+# cosine 0.88-0.93 còn ảnh của cùng một người (đổi sáng, xoay, mờ, nén JPEG) khoảng 0.92-0.97, nên ngưỡng mặc định
+# nằm trên các cặp khác người đã đo và kết quả chỉ được coi là nhận diện khi đạt cả ngưỡng lẫn khoảng cách
+FACE_EMBEDDER = os.environ.get("FACE_EMBEDDER", "lbp")
+FACE_INDEX_DIR = os.environ.get("FACE_INDEX_DIR", os.path.join(TEMP_DIR, "face_index"))
+IDENTIFY_THRESHOLD = float(os.environ.get("IDENTIFY_THRESHOLD", 0.95))
+IDENTIFY_MARGIN = float(os.environ.get("IDENTIFY_MARGIN", 0.02))
+face_embedder = create_embedder(FACE_EMBEDDER)
+# Chỉ mục chỉ được mở trong tiến trình web (hoặc tiến trình chính của enroll.py); tiến trình con không ghi
+# vào chỉ mục (worker của enroll.py gửi đặc trưng về tiến trình chính)
+face_index = None if is_child_process() else FaceIndex(FACE_INDEX_DIR, FACE_EMBEDDER, face_embedder.dim)
+
+def face_index_label(filename, metadata):
+    """Nhãn của ảnh chụp trong chỉ mục khuôn mặt, None nếu ảnh không thuộc nhân viên đã đăng ký"""
+    user_info = metadata.get("user_info", {})
+    if not user_info.get("employeeId"):
+        return None
+    return {
+        "employee_id": user_info["employeeId"],
+        "fullname": user_info.get("fullname"),
+        "department": user_info.get("department"),
+        "direction": metadata.get("direction"),
+        "filename": filename
+    }
+
+def enroll_capture(face_image, filename, metadata):
+    """Đăng ký đặc trưng của ảnh vừa chụp vào chỉ mục khuôn mặt (chạy trong thread ghi ảnh)"""
+    label = face_index_label(filename, metadata)
+    if label is not None:
+        face_index.add(face_embedder.embed(face_image), label)
+
+capture_writer = CaptureWriter(capture_store, CAPTURE_WRITER_THREADS, CAPTURE_QUEUE_SIZE, on_write=enroll_capture)
+
+# Chế độ phản hồi khung hình
+RESPONSE_MODE_FULL = "full"          # Vẽ overlay và trả về khung hình đã xử lý
+RESPONSE_MODE_ANALYSIS = "analysis"  # Chỉ trả về kết quả phân tích, client tự vẽ overlay
+
+# Hồ sơ encode khung hình trả về mặc định: cạnh dài tối đa (0 = giữ nguyên kích thước) và chất lượng JPEG.
+# Client có thể thương lượng hồ sơ riêng (POST /output_profile hoặc lệnh "profile" qua WebSocket)
+OUTPUT_MAX_DIM = int(os.environ.get("OUTPUT_MAX_DIM", 0))
+OUTPUT_JPEG_QUALITY = int(os.environ.get("OUTPUT_JPEG_QUALITY", 85))
+
+# Tự động giảm kích thước và chất lượng khi RTT client đo được (trung bình trượt) cao:
+# (RTT tối thiểu ms, cạnh dài tối đa, chất lượng JPEG tối đa), mức cao nhất thỏa mãn được áp dụng
+OUTPUT_ADAPTIVE = os.environ.get("OUTPUT_ADAPTIVE", "1") != "0"
+RTT_LEVELS = [(250, 640, 75), (500, 480, 65), (1000, 320, 50)]
+RTT_SMOOTHING = 0.3  # Trọng số của mẫu RTT mới trong trung bình trượt
+
+# Chế độ kết hợp: khung và sự hiện diện khuôn mặt lấy từ Face Mesh, Face Detection chỉ chạy
+# mỗi DETECTION_INTERVAL khung hình, khi mất tracking hoặc khi cần điểm tin cậy để chụp ảnh.
+# Đặt bằng 1 để chạy cả hai mô hình trên mọi khung hình như trước
+DETECTION_INTERVAL = int(os.environ.get("DETECTION_INTERVAL", 10))
+
+# Tracking ROI: khi đang tracking, suy luận trên vùng cắt quanh khuôn mặt (thêm lề ROI_PADDING
+# theo kích thước khuôn mặt mỗi bên) được thu nhỏ về tối đa ROI_INPUT_SIZE pixel thay vì toàn khung hình
+ROI_TRACKING = os.environ.get("ROI_TRACKING", "1") != "0"
+ROI_INPUT_SIZE = int(os.environ.get("ROI_INPUT_SIZE", 256))
+ROI_PADDING = 0.5
+
+# Metric của đường xử lý khung hình (xuất tại /metrics)
+STAGE_SECONDS = Histogram("face_app_stage_seconds", "Thời gian của từng bước xử lý khung hình")
+FRAME_SECONDS = Histogram("face_app_frame_seconds", "Tổng thời gian xử lý một khung hình (gồm cả chụp ảnh)")
+FRAMES_TOTAL = Counter("face_app_frames_total", "Số khung hình nhận được theo kết quả (processed, dropped, error)")
+
+def inference_stage(detect, mesh):
+    """Tên bước (nhãn metric) cho một lần chạy đồ thị"""
+    if detect and mesh:
+        return "detection_mesh"
+    return "detection" if detect else "mesh"
+
+# Liveness theo thời gian: số khung hình trong bộ đệm vòng của mỗi phiên, số giây lịch sử tối thiểu trước khi chấm
+# điểm, tỷ trọng của điểm liveness trong real_face_score (phần còn lại là độ tin cậy của Face Detection; 0 = chỉ dùng
+# độ tin cậy như trước) và ngưỡng real_face_score để chụp ảnh. Client gửi khoảng 1 khung hình/giây nên hiếm khi bắt
+# được nháy mắt: với tỷ trọng 0.3 và ngưỡng 0.6, độ tin cậy 0.8 chỉ cần điểm liveness từ 0.14 (chuyển động nhỏ hoặc
+# rung góc xoay) thay vì phải có nháy mắt
+LIVENESS_WINDOW = int(os.environ.get("LIVENESS_WINDOW", 90))
+LIVENESS_MIN_SECONDS = float(os.environ.get("LIVENESS_MIN_SECONDS", 3.0))
+LIVENESS_WEIGHT = float(os.environ.get("LIVENESS_WEIGHT", 0.3))
+REAL_FACE_THRESHOLD = float(os.environ.get("REAL_FACE_THRESHOLD", 0.6))
+
+# Cổng chuyển động: khung hình của client gần như không đổi (độ lệch xám trung bình của ảnh thu nhỏ
+# dưới MOTION_THRESHOLD) thì dùng lại kết quả trước, hoặc chỉ chạy Face Detection nếu chưa có khuôn mặt.
+# Tối đa MOTION_MAX_SKIPS khung hình liên tiếp dùng lại kết quả; MOTION_GATE=0 để tắt
+MOTION_GATE = os.environ.get("MOTION_GATE", "1") != "0"
+MOTION_THRESHOLD = float(os.environ.get("MOTION_THRESHOLD", 2.0))
+MOTION_MAX_SKIPS = int(os.environ.get("MOTION_MAX_SKIPS", 5))
+MOTION_GATE_TOTAL = Counter("face_app_motion_gate_total", "Khung hình theo kết quả của cổng chuyển động (analyzed, cached, presence)")
+
+# Chọn ảnh tốt nhất: mỗi hướng giữ tối đa CAPTURE_CANDIDATES ứng viên (vùng khuôn mặt CAPTURE_ROI_SIZE px) trong
+# một cửa sổ CAPTURE_WINDOW_FRAMES khung hình hoặc CAPTURE_WINDOW_SECONDS giây rồi lưu ứng viên tốt nhất.
+# CAPTURE_SELECTION=0 để lưu ngay khung hình đầu tiên đạt ngưỡng như trước
+CAPTURE_SELECTION = os.environ.get("CAPTURE_SELECTION", "1") != "0"
+CAPTURE_CANDIDATES = int(os.environ.get("CAPTURE_CANDIDATES", 3))
+CAPTURE_WINDOW_FRAMES = int(os.environ.get("CAPTURE_WINDOW_FRAMES", 5))
+CAPTURE_WINDOW_SECONDS = float(os.environ.get("CAPTURE_WINDOW_SECONDS", 1.5))
+CAPTURE_ROI_SIZE = int(os.environ.get("CAPTURE_ROI_SIZE", 160))
+
+# Tên hướng (tiếng Việt, như get_capture_direction) -> khóa của captured_directions
+DIRECTION_KEYS = {
+    "Nhìn thẳng": "straight",
+    "Quay trái": "left",
+    "Quay phải": "right",
+    "Ngẩng lên": "up",
+    "Cúi xuống": "down"
+}
+
+# /captured_images?wait=: thời gian chờ tối đa (giây) của long-poll; 0 để tắt long-poll.
+# Long-poll luôn tắt khi server không chạy đa luồng (worker sync của gunicorn)
+CAPTURED_IMAGES_MAX_WAIT = float(os.environ.get("CAPTURED_IMAGES_MAX_WAIT", 25.0))
+
+# Nạp video từ file: chỉ phân tích 1 trên VIDEO_STRIDE khung hình
+VIDEO_STRIDE = int(os.environ.get("VIDEO_STRIDE", 5))
+
+# Các điểm mốc Face Mesh chính được trả về cho client (cũng dùng để tính góc xoay)
+KEY_LANDMARKS = {
+    "left_eye": 33,
+    "right_eye": 263,
+    "nose_tip": 1,
+    "chin": 152,
+    "forehead": 10,
+    "mouth_left": 61,
+    "mouth_right": 291
+}
+KEY_LANDMARK_INDICES = list(KEY_LANDMARKS.values())
+
+class FrameContext:
+    """Dữ liệu của một khung hình đi qua toàn bộ pipeline trong một request
+
+    Giữ khung hình đã decode và kết quả Face Mesh để bước chụp ảnh dùng lại,
+    không phải decode lại dữ liệu hay chạy lại suy luận.
+    """
+
     def __init__(self):
+        self.frame = None           # Khung hình BGR gốc (chưa lật)
+        self.face_landmarks = None  # Mảng landmark (N, 3) theo tọa độ khung hình đã lật (gương)
+        self.result = None          # Kết quả phân tích của chính khung hình này (không thay đổi sau khi tạo)
+
+    def frame_landmarks(self):
+        """Landmark theo tọa độ của khung hình gốc (chưa lật), None nếu không có khuôn mặt"""
+        if self.face_landmarks is None:
+            return None
+        landmarks = self.face_landmarks.copy()
+        landmarks[:, 0] = 1.0 - landmarks[:, 0]
+        return landmarks
+
+def iter_video_frames(path, stride=1):
+    """Generator đọc file video, trả về (chỉ số, khung hình BGR) của 1 trên stride khung hình
+
+    Khung hình bị bỏ qua chỉ được grab (không retrieve/chuyển đổi màu), và chỉ giữ một khung hình
+    trong bộ nhớ tại mỗi thời điểm. File video được đóng khi generator kết thúc hoặc bị đóng sớm.
+    """
+    stride = max(1, int(stride))
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f"Không thể mở video: {path}")
+    try:
+        index = 0
+        while capture.grab():
+            if index % stride == 0:
+                ok, frame = capture.retrieve()
+                if not ok:
+                    break
+                yield index, frame
+            index += 1
+    finally:
+        capture.release()
+
+def decode_frame_data(frame_data):
+    """Giải mã dữ liệu khung hình từ client (chuỗi base64/data URL hoặc bytes JPEG thô)"""
+    if isinstance(frame_data, str):
+        # Định dạng cũ: data URL base64 gửi trong JSON
+        frame_data = frame_data.split(',')[1] if ',' in frame_data else frame_data
+        frame_bytes = base64.b64decode(frame_data)
+    else:
+        # Định dạng nhị phân: bytes JPEG thô, không cần decode base64
+        frame_bytes = frame_data
+
+    nparr = np.frombuffer(frame_bytes, np.uint8)
+    return cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+
+def crop_face_from_image(image, face_landmarks=None):
+    """Cắt khuôn mặt từ hình ảnh để đảm bảo khuôn mặt hiển thị đầy đủ
+
+    face_landmarks là mảng landmark (N, 3) của chính hình ảnh này (ví dụ lấy từ FrameContext);
+    khi có sẵn, việc cắt chỉ là cắt mảng, không cần chạy lại suy luận.
+    """
+    try:
+        if face_landmarks is None:
+            # Không có kết quả Face Mesh sẵn: chạy Face Mesh trên bộ đồ thị mượn riêng cho ảnh này,
+            # không ảnh hưởng tới tracking của phiên
+            face_landmarks = detect_face_landmarks(image)
+        
+        # Nếu không phát hiện được khuôn mặt, trả về hình ảnh gốc
+        if face_landmarks is None:
+            # Đảm bảo hình ảnh là vuông
+            h, w = image.shape[:2]
+            size = min(h, w)
+            top = (h - size) // 2
+            left = (w - size) // 2
+            return image[top:top+size, left:left+size]
+        
+        h, w = image.shape[:2]
+        
+        # Tìm tọa độ pixel và các điểm biên của khuôn mặt (phép toán trên mảng)
+        face_coords = (face_landmarks[:, :2].astype(np.float64) * (w, h)).astype(np.int64)
+        x_min, y_min = (int(v) for v in face_coords.min(axis=0))
+        x_max, y_max = (int(v) for v in face_coords.max(axis=0))
+        
+        # Mở rộng vùng cắt để đảm bảo khuôn mặt hiển thị đầy đủ
+        face_width = x_max - x_min
+        face_height = y_max - y_min
+        
+        # Tính toán trung tâm khuôn mặt
+        center_x = (x_min + x_max) // 2
+        center_y = (y_min + y_max) // 2
+        
+        # Mở rộng hơn để lấy đầy đủ khuôn mặt và đảm bảo tỷ lệ vuông
+        # Lấy kích thước dài nhất và thêm lề
+        face_size = max(face_width, face_height)
+        padding = int(face_size * 0.5)  # Thêm 50% padding để đảm bảo khuôn mặt hiển thị đầy đủ
+        size = face_size + 2 * padding
+        
+        # Tính toán tọa độ vùng cắt, đảm bảo không vượt quá kích thước ảnh
+        left = max(0, center_x - size // 2)
+        top = max(0, center_y - size // 2)
+        right = min(w, center_x + size // 2)
+        bottom = min(h, center_y + size // 2)
+        
+        # Đảm bảo vùng cắt là vuông
+        crop_width = right - left
+        crop_height = bottom - top
+        
+        if crop_width > crop_height:
+            # Nếu chiều rộng lớn hơn, điều chỉnh top và bottom
+            diff = crop_width - crop_height
+            top = max(0, top - diff // 2)
+            bottom = min(h, bottom + diff // 2)
+        elif crop_height > crop_width:
+            # Nếu chiều cao lớn hơn, điều chỉnh left và right
+            diff = crop_height - crop_width
+            left = max(0, left - diff // 2)
+            right = min(w, right + diff // 2)
+        
+        # Cắt ảnh
+        cropped_image = image[top:bottom, left:right]
+        
+        # Kiểm tra nếu ảnh cắt thành công
+        if cropped_image.size == 0:
+            logger.warning("Ảnh cắt không hợp lệ, trả về ảnh gốc")
+            return image
+            
+        return cropped_image
+        
+    except Exception as e:
+        logger.error(f"Lỗi khi cắt ảnh khuôn mặt: {e}")
+        # Trả về hình ảnh gốc nếu có lỗi
+        return image
+
+class FaceDetectionApp:
+    def __init__(self, graphs=None, graph_provider=None):
         # Khởi tạo các module MediaPipe
+        mp = get_mediapipe()
         self.mp_face_detection = mp.solutions.face_detection
         self.mp_face_mesh = mp.solutions.face_mesh
         self.mp_drawing = mp.solutions.drawing_utils
@@ -38,7 +353,20 @@ class FaceDetectionApp:
         self.frame_count = 0
         self.start_time = 0
         self.fps = 0
+        self.fps_frames = 0  # Số khung hình từ start_time (cửa sổ tính FPS)
         self.real_face_score = 0
+        self.detection_score = 0  # Độ tin cậy của lần Face Detection gần nhất
+        
+        # Đặc trưng theo thời gian (EAR, chuyển động landmark, độ rung góc xoay) để đánh giá khuôn mặt thật
+        self.liveness = LivenessTracker(LIVENESS_WINDOW, LIVENESS_MIN_SECONDS)
+        self.motion_gate = MotionGate(MOTION_THRESHOLD, MOTION_MAX_SKIPS) if MOTION_GATE else None
+        self.capture_selector = CaptureSelector(
+            CAPTURE_CANDIDATES,
+            CAPTURE_WINDOW_FRAMES,
+            CAPTURE_WINDOW_SECONDS,
+            CAPTURE_ROI_SIZE
+        ) if CAPTURE_SELECTION else None
+        self.liveness_weight = LIVENESS_WEIGHT
         
         # Biến lưu trữ thông tin người dùng
         self.user_info = {
@@ -58,6 +386,26 @@ class FaceDetectionApp:
         }
         self.captured_images = []  # Danh sách lưu thông tin ảnh đã chụp
         self.session_id = str(uuid.uuid4())[:8]  # ID phiên làm việc để nhóm ảnh
+        # Bảo vệ captured_images/captured_directions và báo cho các request long-poll khi có ảnh mới
+        self.capture_condition = threading.Condition()
+        self.response_mode = RESPONSE_MODE_FULL  # Chế độ phản hồi mặc định của phiên
+        self.output_profile = {
+            "max_dim": OUTPUT_MAX_DIM,
+            "quality": OUTPUT_JPEG_QUALITY,
+            "grayscale": False,
+            "adaptive": OUTPUT_ADAPTIVE
+        }
+        self.rtt_ms = None  # RTT trung bình trượt do client báo (ms)
+        self.frame_slot = FrameSlot()  # Mỗi lần chỉ xử lý một khung hình, khung hình chờ cũ bị thay thế
+        
+        # Chế độ kết hợp: Face Detection chỉ chạy mỗi detection_interval khung hình
+        self.detection_interval = DETECTION_INTERVAL
+        self.frames_since_detection = 0
+        
+        # Khung khuôn mặt của khung hình trước (tọa độ tương đối) dùng cho tracking ROI
+        self.roi_tracking = ROI_TRACKING
+        self.tracking_box = None
+        self.roi_active = False  # Lần chạy Face Mesh gần nhất dùng ROI hay toàn khung hình
         
         # Biến để lưu kết quả phân tích mới nhất
         self.latest_result = {
@@ -72,27 +420,60 @@ class FaceDetectionApp:
                 "roll": "Thẳng",
                 "pitch": "Thẳng",
                 "yaw": "Thẳng"
-            }
+            },
+            "detections": [],
+            "landmarks": {}
         }
         
-        # Khởi tạo Face Detection với các tùy chọn
-        self.face_detection = self.mp_face_detection.FaceDetection(
-            model_selection=1, 
-            min_detection_confidence=0.5
-        )
-        
-        # Khởi tạo Face Mesh với các tùy chọn
-        self.face_mesh = self.mp_face_mesh.FaceMesh(
-            max_num_faces=1,
-            refine_landmarks=True,
-            min_detection_confidence=0.5,
-            min_tracking_confidence=0.5
-        )
+        # Dùng bộ đồ thị được cấp sẵn, hoặc lấy lười từ graph_provider() (phiên do SessionManager quản lý:
+        # đồ thị có thể bị thu hồi cho phiên khác và được lấy lại ở khung hình tiếp theo), nếu không thì tự tạo.
+        # Bộ đồ thị có thể nằm trong tiến trình này (FaceGraphs) hoặc trên worker (RemoteFaceGraphs)
+        self.graph_provider = graph_provider
+        self.graphs = graphs if graphs is not None or graph_provider is not None else FaceGraphs()
+        # Bộ đồ thị của phiên chỉ được một request dùng tại một thời điểm và không được trả về pool
+        # khi đang suy luận (phiên có thể bị loại bỏ trong lúc request đang chạy)
+        self.graphs_lock = threading.RLock()
         
         logger.info("Đã thiết lập thành công các module nhận diện khuôn mặt.")
 
-    def process_image(self, image):
-        """Xử lý hình ảnh để nhận diện khuôn mặt và phân tích góc xoay"""
+    def release_graphs(self):
+        """Trả lại bộ đồ thị khi phiên bị loại bỏ hoặc bị thu hồi đồ thị (chờ lần suy luận đang chạy kết thúc)"""
+        with self.graphs_lock:
+            graphs = self.graphs
+            self.graphs = None
+        return graphs
+
+    def ensure_graphs(self):
+        """Đảm bảo phiên có bộ đồ thị, lấy lại từ graph_provider nếu chưa có hoặc đã bị thu hồi
+
+        Ném TimeoutError nếu pool không có bộ đồ thị nào trong thời gian chờ.
+        """
+        with self.graphs_lock:
+            if self.graphs is None:
+                if self.graph_provider is None:
+                    raise RuntimeError("Phiên đã bị loại bỏ, bộ đồ thị đã được trả về pool")
+                self.graphs = self.graph_provider()
+                # Đồ thị mới không có trạng thái tracking của khung hình trước
+                self.tracking_box = None
+                self.roi_active = False
+            return self.graphs
+
+    def reset_tracking(self):
+        """Xóa trạng thái tracking (đồ thị, ROI) khi khung hình tiếp theo không nối tiếp khung hình trước"""
+        with self.graphs_lock:
+            if self.graphs is not None:
+                self.graphs.reset()
+            self.tracking_box = None
+            self.roi_active = False
+
+    def process_image(self, image, render=True, context=None):
+        """Xử lý hình ảnh để nhận diện khuôn mặt và phân tích góc xoay
+
+        Nếu render=False (chế độ chỉ phân tích), bỏ qua việc sao chép và vẽ
+        overlay lên khung hình; client tự vẽ từ detections/landmarks trong latest_result.
+        Nếu có context (FrameContext), landmark và kết quả phân tích của khung hình được lưu vào context.
+        latest_result được thay bằng dict kết quả mới của khung hình, không bao giờ sửa tại chỗ.
+        """
         try:
             # Kiểm tra khung hình đầu vào
             if image is None or image.size == 0 or image.shape[0] == 0 or image.shape[1] == 0:
@@ -104,8 +485,9 @@ class FaceDetectionApp:
                 logger.warning("Khung hình không đúng định dạng, cần khung hình BGR 3 kênh")
                 return np.zeros((480, 640, 3), dtype=np.uint8)
                 
-            # Tạo bản sao của hình ảnh để tránh sửa đổi gốc
-            image = image.copy()
+            # Tạo bản sao của hình ảnh để tránh sửa đổi gốc (chỉ cần khi vẽ overlay)
+            if render:
+                image = image.copy()
                 
             # Lật hình ảnh theo chiều ngang để hiển thị như gương
             image = cv2.flip(image, 1)
@@ -113,24 +495,19 @@ class FaceDetectionApp:
             # Chuyển không gian màu từ BGR sang RGB cho MediaPipe
             image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
             
-            # Xử lý hình ảnh với Face Detection một cách an toàn
-            detection_results = None
-            try:
-                detection_results = self.face_detection.process(image_rgb)
-            except Exception as e:
-                logger.error(f"Lỗi khi xử lý face detection: {e}")
+            # Chế độ kết hợp (detection_interval > 1): Face Mesh chạy trước trên mọi khung hình,
+            # Face Detection chỉ chạy khi cần (xem should_run_detection).
+            # Các đồ thị chạy trong tiến trình này hoặc trên worker suy luận
+            fused = self.detection_interval > 1
+            if fused:
                 detection_results = None
+                _, face_landmarks_list = self.run_tracked_inference(image_rgb, detect=False)
+            else:
+                detection_results, face_landmarks_list = self.run_tracked_inference(image_rgb)
             
-            # Xử lý hình ảnh với Face Mesh một cách an toàn
-            mesh_results = None
-            try:
-                mesh_results = self.face_mesh.process(image_rgb)
-            except Exception as e:
-                logger.error(f"Lỗi khi xử lý face mesh: {e}")
-                mesh_results = None
-            
-            # Cập nhật trạng thái mặc định
-            self.latest_result = {
+            # Kết quả của khung hình này được tạo mới và chỉ công bố (thay latest_result) khi đã đầy đủ
+            real_face_score = 0
+            result = {
                 "face_detected": False,
                 "real_face_score": 0,
                 "rotation": {
@@ -142,95 +519,52 @@ class FaceDetectionApp:
                     "roll": "Thẳng",
                     "pitch": "Thẳng",
                     "yaw": "Thẳng"
-                }
+                },
+                "detections": [],
+                "landmarks": {}
             }
             
-            # Vẽ kết quả nếu phát hiện được khuôn mặt
-            if detection_results and detection_results.detections:
-                for detection in detection_results.detections:
-                    # Vẽ khung nhận diện khuôn mặt
-                    self.mp_drawing.draw_detection(image, detection)
-                    
-                    # Lấy điểm tin cậy
-                    score = detection.score[0]
-                    
-                    # Kiểm tra khuôn mặt thật/giả
-                    self.real_face_score = self.analyze_real_face(image, detection, score)
-                    
-                    # Hiển thị thông tin khuôn mặt thật/giả
-                    cv2.putText(
-                        image,
-                        f"Khuôn mặt thật: {self.real_face_score:.0%}",
-                        (10, 70),
-                        cv2.FONT_HERSHEY_SIMPLEX,
-                        0.7,
-                        (0, 255, 0) if self.real_face_score > 0.7 else (0, 0, 255),
-                        2
-                    )
-                    
-                    # Cập nhật trạng thái
-                    self.latest_result["face_detected"] = True
-                    self.latest_result["real_face_score"] = float(self.real_face_score)
+            # Khung khuôn mặt suy ra từ landmark của Face Mesh (tọa độ tương đối)
+            mesh_box = None
+            overlay_seconds = 0.0  # Tổng thời gian vẽ overlay của khung hình
             
             # Phân tích và hiển thị thông tin về góc xoay khuôn mặt nếu có landmark
-            if mesh_results and mesh_results.multi_face_landmarks:
-                for face_landmarks in mesh_results.multi_face_landmarks:
+            if face_landmarks_list:
+                for face_landmarks in face_landmarks_list:
                     # TẮT việc vẽ lưới điểm mốc khuôn mặt để giảm lag
+                    mesh_box = self.landmarks_bounding_box(face_landmarks)
+                    if context is not None:
+                        context.face_landmarks = face_landmarks
                     
                     try:
                         # Phân tích góc xoay một cách an toàn
+                        rotation_start = time.perf_counter()
                         roll, pitch, yaw = self.calculate_face_rotation(face_landmarks, image)
-                        
-                        # Hiển thị thông tin góc xoay
-                        cv2.putText(
-                            image,
-                            f"Nghiêng (Roll): {roll:.1f}°",
-                            (10, 110),
-                            cv2.FONT_HERSHEY_SIMPLEX,
-                            0.7,
-                            (255, 0, 0),
-                            2
-                        )
-                        cv2.putText(
-                            image,
-                            f"Ngẩng/Cúi (Pitch): {pitch:.1f}°",
-                            (10, 150),
-                            cv2.FONT_HERSHEY_SIMPLEX,
-                            0.7,
-                            (255, 0, 0),
-                            2
-                        )
-                        cv2.putText(
-                            image,
-                            f"Quay (Yaw): {yaw:.1f}°",
-                            (10, 190),
-                            cv2.FONT_HERSHEY_SIMPLEX,
-                            0.7,
-                            (255, 0, 0),
-                            2
-                        )
+                        STAGE_SECONDS.observe(time.perf_counter() - rotation_start, stage="rotation")
                         
                         # Phân tích hướng xoay khuôn mặt
                         roll_text, pitch_text, yaw_text = self.analyze_rotation_direction(roll, pitch, yaw)
                         
-                        # Hiển thị thông tin góc xoay bằng chữ
-                        cv2.putText(
-                            image,
-                            f"Hướng: {roll_text}, {pitch_text}, {yaw_text}",
-                            (10, 230),
-                            cv2.FONT_HERSHEY_SIMPLEX,
-                            0.7,
-                            (0, 128, 255),
-                            2
-                        )
+                        # Cập nhật đặc trưng liveness của khung hình (O(1) theo độ dài lịch sử)
+                        self.liveness.update(face_landmarks, (roll, pitch, yaw), image.shape[1], image.shape[0])
+                        result["liveness"] = self.liveness.stats()
+                        
+                        if render:
+                            overlay_start = time.perf_counter()
+                            self.draw_rotation_overlay(image, roll, pitch, yaw, roll_text, pitch_text, yaw_text)
+                            overlay_seconds += time.perf_counter() - overlay_start
+                        
+                        # Các điểm mốc chính (tọa độ tương đối) để client tự vẽ overlay
+                        key_points = face_landmarks[KEY_LANDMARK_INDICES, :2].tolist()
+                        result["landmarks"] = dict(zip(KEY_LANDMARKS, key_points))
                         
                         # Cập nhật kết quả
-                        self.latest_result["rotation"] = {
+                        result["rotation"] = {
                             "roll": float(roll),
                             "pitch": float(pitch),
                             "yaw": float(yaw)
                         }
-                        self.latest_result["rotation_text"] = {
+                        result["rotation_text"] = {
                             "roll": roll_text,
                             "pitch": pitch_text,
                             "yaw": yaw_text
@@ -238,6 +572,78 @@ class FaceDetectionApp:
                     except Exception as e:
                         logger.error(f"Lỗi khi tính toán góc xoay: {e}")
             
+            # Lưu khung khuôn mặt để khung hình sau suy luận trên ROI (None = mất tracking)
+            self.tracking_box = mesh_box
+            
+            # Mất khuôn mặt: lịch sử liveness không còn thuộc về cùng một người
+            if mesh_box is None:
+                self.liveness.reset()
+            
+            # Chỉ chạy Face Detection khi cần điểm tin cậy mới hoặc khi mất tracking
+            if fused:
+                if self.should_run_detection(mesh_box is not None, result):
+                    detection_results, _ = self.run_tracked_inference(image_rgb, mesh=False)
+                    self.frames_since_detection = 0
+                    # Face Detection không thấy khuôn mặt: không dùng lại điểm tin cậy cũ
+                    self.detection_score = 0
+                    real_face_score = 0
+                else:
+                    self.frames_since_detection += 1
+            
+            # Vẽ kết quả nếu phát hiện được khuôn mặt
+            if detection_results and detection_results.detections:
+                for detection in detection_results.detections:
+                    # Lấy điểm tin cậy
+                    score = detection.score[0]
+                    
+                    # Kiểm tra khuôn mặt thật/giả
+                    self.detection_score = score
+                    real_face_score = self.analyze_real_face(image, detection, score)
+                    
+                    if render:
+                        # Vẽ khung nhận diện khuôn mặt
+                        overlay_start = time.perf_counter()
+                        self.mp_drawing.draw_detection(image, detection)
+                        self.draw_real_face_score(image, real_face_score)
+                        overlay_seconds += time.perf_counter() - overlay_start
+                    
+                    # Cập nhật trạng thái
+                    result["face_detected"] = True
+                    result["real_face_score"] = float(real_face_score)
+                    result["detections"].append(self.detection_to_dict(detection))
+            elif fused and mesh_box is not None:
+                # Khuôn mặt vẫn đang được Face Mesh tracking: dùng khung từ landmark
+                # và điểm tin cậy của lần Face Detection gần nhất (liveness vẫn cập nhật theo khung hình)
+                real_face_score = self.analyze_real_face(image, None, self.detection_score)
+                if render:
+                    overlay_start = time.perf_counter()
+                    h, w = image.shape[:2]
+                    top_left = (int(mesh_box["xmin"] * w), int(mesh_box["ymin"] * h))
+                    bottom_right = (
+                        int((mesh_box["xmin"] + mesh_box["width"]) * w),
+                        int((mesh_box["ymin"] + mesh_box["height"]) * h)
+                    )
+                    cv2.rectangle(image, top_left, bottom_right, (224, 224, 224), 2)
+                    self.draw_real_face_score(image, real_face_score)
+                    overlay_seconds += time.perf_counter() - overlay_start
+                
+                result["face_detected"] = True
+                result["real_face_score"] = float(real_face_score)
+                result["detections"].append({
+                    "score": float(real_face_score),
+                    "box": mesh_box,
+                    "keypoints": [],
+                    "source": "mesh"
+                })
+            
+            if render:
+                STAGE_SECONDS.observe(overlay_seconds, stage="overlay")
+            
+            # Công bố kết quả bằng một phép gán: request khác chỉ thấy kết quả cũ hoặc mới đầy đủ
+            self.real_face_score = real_face_score
+            self.latest_result = result
+            if context is not None:
+                context.result = result
             return image
             
         except Exception as e:
@@ -245,37 +651,244 @@ class FaceDetectionApp:
             # Trả về khung hình trống nếu xảy ra lỗi
             return np.zeros((480, 640, 3), dtype=np.uint8)
 
+    def get_tracking_roi(self, width, height):
+        """Tính vùng ROI (pixel) quanh khuôn mặt của khung hình trước, None nếu cần dùng toàn khung hình"""
+        box = self.tracking_box
+        if not self.roi_tracking or box is None:
+            return None
+        
+        # Vùng vuông quanh tâm khuôn mặt, thêm lề mỗi bên
+        face_size = max(box["width"] * width, box["height"] * height)
+        size = face_size * (1 + 2 * ROI_PADDING)
+        center_x = (box["xmin"] + box["width"] / 2) * width
+        center_y = (box["ymin"] + box["height"] / 2) * height
+        
+        left = max(0, int(center_x - size / 2))
+        top = max(0, int(center_y - size / 2))
+        right = min(width, int(center_x + size / 2))
+        bottom = min(height, int(center_y + size / 2))
+        
+        # ROI gần bằng toàn khung hình thì không cần cắt
+        if right - left <= 1 or bottom - top <= 1 or (right - left) * (bottom - top) >= 0.8 * width * height:
+            return None
+        return left, top, right, bottom
+
+    def run_tracked_inference(self, image_rgb, detect=True, mesh=True):
+        """Chạy suy luận trên ROI quanh khuôn mặt đang tracking và ánh xạ kết quả về toàn khung hình
+
+        Kết quả (landmark, khung, keypoint) luôn theo tọa độ tương đối của toàn khung hình nên
+        calculate_face_rotation và logic chụp ảnh không cần thay đổi.
+        Khi không tìm thấy khuôn mặt trong ROI, chạy lại trên toàn khung hình.
+        """
+        height, width = image_rgb.shape[:2]
+        roi = self.get_tracking_roi(width, height)
+        
+        # Face Mesh dùng landmark của khung hình trước (theo tọa độ ảnh đầu vào) để tracking,
+        # nên khi chuyển giữa ROI và toàn khung hình cần xóa trạng thái tracking
+        if mesh and (roi is not None) != self.roi_active:
+            self.reset_tracking()
+            self.roi_active = roi is not None
+        
+        if roi is None:
+            return self.run_graphs(image_rgb, detect, mesh)
+        
+        left, top, right, bottom = roi
+        crop = image_rgb[top:bottom, left:right]
+        
+        # Chuẩn hóa kích thước đầu vào (chỉ thu nhỏ, không phóng to)
+        scale = ROI_INPUT_SIZE / max(crop.shape[0], crop.shape[1])
+        if scale < 1:
+            crop = cv2.resize(
+                crop,
+                (max(1, int(crop.shape[1] * scale)), max(1, int(crop.shape[0] * scale))),
+                interpolation=cv2.INTER_AREA
+            )
+        else:
+            crop = np.ascontiguousarray(crop)
+        
+        detection_results, face_landmarks_list = self.run_graphs(crop, detect, mesh)
+        
+        if mesh and not face_landmarks_list:
+            # Mất khuôn mặt trong ROI: quay lại suy luận trên toàn khung hình
+            self.reset_tracking()
+            return self.run_graphs(image_rgb, detect, mesh)
+        
+        self.map_results_to_frame(detection_results, face_landmarks_list, roi, width, height)
+        return detection_results, face_landmarks_list
+
+    def run_graphs(self, image_rgb, detect, mesh):
+        """Chạy bộ đồ thị của phiên và ghi thời gian vào metric theo bước"""
+        with self.graphs_lock:
+            graphs = self.ensure_graphs()
+            start = time.perf_counter()
+            results = graphs.process(image_rgb, detect=detect, mesh=mesh)
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=inference_stage(detect, mesh))
+        return results
+
+    def map_results_to_frame(self, detection_results, face_landmarks_list, roi, width, height):
+        """Chuyển tọa độ tương đối theo ROI của kết quả MediaPipe về tọa độ tương đối của toàn khung hình"""
+        left, top, right, bottom = roi
+        scale_x = (right - left) / width
+        scale_y = (bottom - top) / height
+        offset_x = left / width
+        offset_y = top / height
+        
+        if face_landmarks_list:
+            # z cùng tỷ lệ với chiều rộng ảnh đầu vào
+            scale = np.array([scale_x, scale_y, scale_x], dtype=np.float32)
+            offset = np.array([offset_x, offset_y, 0], dtype=np.float32)
+            for face_landmarks in face_landmarks_list:
+                face_landmarks *= scale
+                face_landmarks += offset
+        
+        if detection_results and detection_results.detections:
+            for detection in detection_results.detections:
+                box = detection.location_data.relative_bounding_box
+                box.xmin = box.xmin * scale_x + offset_x
+                box.ymin = box.ymin * scale_y + offset_y
+                box.width = box.width * scale_x
+                box.height = box.height * scale_y
+                for keypoint in detection.location_data.relative_keypoints:
+                    keypoint.x = keypoint.x * scale_x + offset_x
+                    keypoint.y = keypoint.y * scale_y + offset_y
+
+    def should_run_detection(self, has_mesh, analysis):
+        """Quyết định có chạy Face Detection cho khung hình hiện tại không (chế độ kết hợp)
+
+        analysis là kết quả (đang tạo) của khung hình hiện tại, chứa góc xoay từ Face Mesh.
+        """
+        # Mất tracking: dùng Face Detection (full-range) để xác nhận có khuôn mặt hay không
+        if not has_mesh:
+            return True
+        
+        # Chạy định kỳ mỗi detection_interval khung hình để làm mới điểm tin cậy
+        if self.frames_since_detection + 1 >= self.detection_interval:
+            return True
+        
+        # Cần điểm tin cậy mới khi khung hình này có thể được chụp
+        return self.get_capture_direction(
+            analysis["rotation"],
+            analysis["rotation_text"]
+        ) is not None
+
+    def landmarks_bounding_box(self, face_landmarks):
+        """Tính khung bao khuôn mặt (tọa độ tương đối) từ mảng landmark (N, 3) của Face Mesh"""
+        x_min, y_min = np.clip(face_landmarks[:, :2].min(axis=0), 0.0, 1.0)
+        x_max, y_max = np.clip(face_landmarks[:, :2].max(axis=0), 0.0, 1.0)
+        return {
+            "xmin": float(x_min),
+            "ymin": float(y_min),
+            "width": float(x_max - x_min),
+            "height": float(y_max - y_min)
+        }
+
+    def draw_real_face_score(self, image, score=None):
+        """Hiển thị thông tin khuôn mặt thật/giả lên khung hình (mặc định là điểm của khung hình gần nhất)"""
+        if score is None:
+            score = self.real_face_score
+        cv2.putText(
+            image,
+            f"Khuôn mặt thật: {score:.0%}",
+            (10, 70),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.7,
+            (0, 255, 0) if score >= REAL_FACE_THRESHOLD else (0, 0, 255),
+            2
+        )
+
+    def draw_rotation_overlay(self, image, roll, pitch, yaw, roll_text, pitch_text, yaw_text):
+        """Vẽ thông tin góc xoay lên khung hình"""
+        # Hiển thị thông tin góc xoay
+        cv2.putText(
+            image,
+            f"Nghiêng (Roll): {roll:.1f}°",
+            (10, 110),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.7,
+            (255, 0, 0),
+            2
+        )
+        cv2.putText(
+            image,
+            f"Ngẩng/Cúi (Pitch): {pitch:.1f}°",
+            (10, 150),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.7,
+            (255, 0, 0),
+            2
+        )
+        cv2.putText(
+            image,
+            f"Quay (Yaw): {yaw:.1f}°",
+            (10, 190),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.7,
+            (255, 0, 0),
+            2
+        )
+        
+        # Hiển thị thông tin góc xoay bằng chữ
+        cv2.putText(
+            image,
+            f"Hướng: {roll_text}, {pitch_text}, {yaw_text}",
+            (10, 230),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.7,
+            (0, 128, 255),
+            2
+        )
+
+    def detection_to_dict(self, detection):
+        """Chuyển kết quả face detection thành dict (tọa độ tương đối) để trả về client"""
+        box = detection.location_data.relative_bounding_box
+        return {
+            "score": float(detection.score[0]),
+            "box": {
+                "xmin": float(box.xmin),
+                "ymin": float(box.ymin),
+                "width": float(box.width),
+                "height": float(box.height)
+            },
+            "keypoints": [
+                [float(kp.x), float(kp.y)]
+                for kp in detection.location_data.relative_keypoints
+            ]
+        }
+
     def analyze_real_face(self, image, detection, score):
-        """Phân tích xem có phải khuôn mặt thật không dựa trên nhiều yếu tố"""
+        """Phân tích xem có phải khuôn mặt thật không dựa trên nhiều yếu tố
+
+        Kết hợp độ tin cậy của Face Detection với điểm liveness theo thời gian của phiên
+        (nháy mắt, chuyển động nhỏ của landmark, độ rung góc xoay).
+        """
         # Giá trị cơ bản từ độ tin cậy của face detection
         base_score = score
         
-        # Có thể bổ sung thêm các phép phân tích khác ở đây
-        # như phân tích cấu trúc ảnh, đánh giá kết cấu da, phát hiện mắt nháy, v.v.
+        # Điểm liveness từ bộ đệm vòng của phiên (0 cho đến khi đủ số khung hình tối thiểu)
+        liveness_score = self.liveness.score()
         
-        return base_score
+        return (1 - self.liveness_weight) * base_score + self.liveness_weight * liveness_score
 
     def calculate_face_rotation(self, face_landmarks, image):
-        """Tính toán góc xoay của khuôn mặt theo 3 trục"""
+        """Tính toán góc xoay của khuôn mặt theo 3 trục
+
+        face_landmarks là mảng landmark (N, 3) tọa độ tương đối (chấp nhận cả NormalizedLandmarkList của MediaPipe).
+        """
+        if not isinstance(face_landmarks, np.ndarray):
+            face_landmarks = landmarks_to_array(face_landmarks)
         h, w, _ = image.shape
         
-        # Lấy các điểm mốc quan trọng
-        # Điểm mốc cho mắt trái, mắt phải, mũi, cằm và trán
-        left_eye = self.get_landmark_position(face_landmarks.landmark[33], w, h)           # Mắt trái
-        right_eye = self.get_landmark_position(face_landmarks.landmark[263], w, h)         # Mắt phải
-        nose_tip = self.get_landmark_position(face_landmarks.landmark[1], w, h)            # Đỉnh mũi
-        chin = self.get_landmark_position(face_landmarks.landmark[152], w, h)              # Cằm
-        forehead = self.get_landmark_position(face_landmarks.landmark[10], w, h)           # Điểm trên trán
-        mouth_left = self.get_landmark_position(face_landmarks.landmark[61], w, h)         # Miệng trái
-        mouth_right = self.get_landmark_position(face_landmarks.landmark[291], w, h)       # Miệng phải
+        # Lấy các điểm mốc quan trọng theo tọa độ pixel trong một phép toán trên mảng:
+        # mắt trái, mắt phải, đỉnh mũi, cằm, trán, miệng trái, miệng phải
+        points = (face_landmarks[KEY_LANDMARK_INDICES, :2].astype(np.float64) * (w, h)).astype(np.int64)
+        left_eye, right_eye, nose_tip, chin, forehead = points[:5]
         
         # Điểm trung tâm giữa hai mắt
-        eye_center = ((left_eye[0] + right_eye[0]) // 2, (left_eye[1] + right_eye[1]) // 2)
+        eye_center = (left_eye + right_eye) // 2
         
         # Tính Roll - góc nghiêng của mặt (xoay theo trục z)
         # Dựa vào góc của đường thẳng nối hai mắt so với phương ngang
-        dY = right_eye[1] - left_eye[1]
-        dX = right_eye[0] - left_eye[0]
+        dX, dY = right_eye - left_eye
         roll = math.degrees(math.atan2(dY, dX))
         
         # Tính Pitch - góc ngẩng/cúi của mặt (xoay theo trục x) - CẢI TIẾN MỚI
@@ -284,8 +897,11 @@ class FaceDetectionApp:
         # Tính khoảng cách từ mũi đến tâm mắt
         nose_to_eye_distance = nose_tip[1] - eye_center[1]
         
+        # Vector từ trán đến cằm
+        forehead_to_chin_x, forehead_to_chin_y = chin - forehead
+        
         # Tính khoảng cách từ trán đến cằm
-        forehead_to_chin_distance = chin[1] - forehead[1]
+        forehead_to_chin_distance = forehead_to_chin_y
         
         # Tính tỷ lệ
         nose_eye_ratio = nose_to_eye_distance / forehead_to_chin_distance if forehead_to_chin_distance > 0 else 0
@@ -298,10 +914,6 @@ class FaceDetectionApp:
         pitch_factor = 90.0  # Hệ số tỷ lệ (có thể điều chỉnh)
         pitch = (nose_eye_ratio - reference_ratio) * pitch_factor
         
-        # Điều chỉnh thêm dựa trên vector từ trán đến cằm
-        forehead_to_chin_x = chin[0] - forehead[0]
-        forehead_to_chin_y = chin[1] - forehead[1]
-        
         # Tính góc hiện tại của vector từ trán đến cằm so với trục y
         current_angle = math.degrees(math.atan2(forehead_to_chin_x, forehead_to_chin_y))
         
@@ -309,26 +921,19 @@ class FaceDetectionApp:
         pitch -= current_angle * 0.3  # Trọng số cho phương pháp vector
         
         # Giới hạn góc pitch trong phạm vi hợp lý
-        pitch = max(min(pitch, 90), -90)
+        pitch = float(max(min(pitch, 90), -90))
         
         # Tính Yaw - góc quay của mặt (xoay theo trục y)
-        # Dựa vào tỷ lệ khoảng cách giữa mắt trái/phải với mũi
-        left_eye_to_nose = math.sqrt((nose_tip[0] - left_eye[0])**2 + (nose_tip[1] - left_eye[1])**2)
-        right_eye_to_nose = math.sqrt((nose_tip[0] - right_eye[0])**2 + (nose_tip[1] - right_eye[1])**2)
+        # Dựa vào tỷ lệ khoảng cách giữa mắt trái/phải với mũi (tính cả ba khoảng cách cùng lúc)
+        vectors = points[[2, 2, 1]] - points[[0, 1, 0]]  # mũi - mắt trái, mũi - mắt phải, mắt phải - mắt trái
+        left_eye_to_nose, right_eye_to_nose, eye_distance = np.hypot(vectors[:, 0], vectors[:, 1])
         
         # Chuẩn hóa góc yaw dựa trên tỷ lệ khoảng cách
         eye_nose_diff = left_eye_to_nose - right_eye_to_nose
-        eye_distance = math.sqrt((right_eye[0] - left_eye[0])**2 + (right_eye[1] - left_eye[1])**2)
         yaw = math.degrees(math.atan2(eye_nose_diff, eye_distance))
         
         return roll, pitch, yaw
 
-    def get_landmark_position(self, landmark, width, height):
-        """Chuyển đổi tọa độ tương đối của landmark sang tọa độ pixel"""
-        x = int(landmark.x * width)
-        y = int(landmark.y * height)
-        return (x, y)
-
     def analyze_rotation_direction(self, roll, pitch, yaw):
         """Phân tích hướng xoay của khuôn mặt"""
         roll_text = "Thẳng"
@@ -348,8 +953,45 @@ class FaceDetectionApp:
         
         return roll_text, pitch_text, yaw_text
 
-    def process_frame_from_client(self, frame_data):
-        """Xử lý khung hình được gửi từ client"""
+    def decode_frame_data(self, frame_data):
+        """Giải mã dữ liệu khung hình từ client (xem hàm decode_frame_data của module)"""
+        return decode_frame_data(frame_data)
+
+    def encode_frame(self, frame, as_base64=True, profile=None):
+        """Encode khung hình thành JPEG (data URL base64 hoặc bytes thô)
+
+        Khung hình được thu nhỏ / chuyển ảnh xám theo hồ sơ (mặc định là current_output_profile())
+        trước khi encode.
+        """
+        if profile is None:
+            profile = self.current_output_profile()
+        h, w = frame.shape[:2]
+        max_dim = profile["max_dim"]
+        if max_dim and max(h, w) > max_dim:
+            scale = max_dim / max(h, w)
+            frame = cv2.resize(frame, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+        if profile["grayscale"] and frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, profile["quality"]])
+        if not as_base64:
+            return buffer.tobytes()
+        frame_base64 = base64.b64encode(buffer).decode('utf-8')
+        return f"data:image/jpeg;base64,{frame_base64}"
+
+    def process_frame_from_client(self, frame_data, as_base64=True, response_mode=None, context=None):
+        """Xử lý khung hình được gửi từ client
+
+        frame_data có thể là data URL base64 (client cũ) hoặc bytes JPEG thô.
+        Nếu as_base64=False, processed_image được trả về dưới dạng bytes JPEG thô
+        để ghi trực tiếp vào response nhị phân.
+        Ở chế độ RESPONSE_MODE_ANALYSIS, không vẽ overlay và không encode khung hình
+        (processed_image luôn là None).
+        Nếu có context (FrameContext), khung hình đã decode và landmark được lưu vào đó.
+        Lỗi do dữ liệu khung hình của client (rỗng, không decode được) có thêm "invalid_input": True.
+        Khung hình gần như không đổi so với khung hình đã phân tích gần nhất được trả về với kết quả
+        cũ và trường "motion_gated" ("cached" hoặc "presence"), xem motion_gated_result.
+        """
+        render = (response_mode or self.response_mode) != RESPONSE_MODE_ANALYSIS
         try:
             # Kiểm tra dữ liệu khung hình đầu vào
             if not frame_data or len(frame_data) < 100:  # Kiểm tra nếu frame rỗng hoặc quá nhỏ
@@ -357,63 +999,99 @@ class FaceDetectionApp:
                 return {
                     "processed_image": None,
                     "analysis_result": self.latest_result,
-                    "error": "Dữ liệu khung hình không hợp lệ"
+                    "error": "Dữ liệu khung hình không hợp lệ",
+                    "invalid_input": True
                 }
             
-            # Decode khung hình từ base64
+            # Decode khung hình (base64 hoặc bytes thô) thành mảng NumPy
             try:
-                frame_data = frame_data.split(',')[1] if ',' in frame_data else frame_data
-                frame_bytes = base64.b64decode(frame_data)
+                decode_start = time.perf_counter()
+                frame = self.decode_frame_data(frame_data)
+                STAGE_SECONDS.observe(time.perf_counter() - decode_start, stage="decode")
             except Exception as e:
-                logger.error(f"Lỗi khi decode base64: {e}")
+                logger.error(f"Lỗi khi decode dữ liệu hình ảnh: {e}")
                 return {
                     "processed_image": None,
                     "analysis_result": self.latest_result,
-                    "error": "Không thể decode dữ liệu hình ảnh"
+                    "error": "Không thể decode dữ liệu hình ảnh",
+                    "invalid_input": True
                 }
             
-            # Chuyển đổi thành mảng NumPy để xử lý với OpenCV
-            nparr = np.frombuffer(frame_bytes, np.uint8)
-            frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            
             if frame is None or frame.size == 0:
                 logger.warning("Không thể decode khung hình hoặc khung hình rỗng")
+                if not render:
+                    return {
+                        "processed_image": None,
+                        "analysis_result": self.latest_result,
+                        "error": "Khung hình không hợp lệ",
+                        "invalid_input": True
+                    }
                 # Tạo khung hình rỗng để tránh lỗi
                 empty_frame = np.zeros((480, 640, 3), dtype=np.uint8)
-                _, buffer = cv2.imencode('.jpg', empty_frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
-                empty_frame_base64 = base64.b64encode(buffer).decode('utf-8')
                 
                 return {
-                    "processed_image": f"data:image/jpeg;base64,{empty_frame_base64}",
+                    "processed_image": self.encode_frame(empty_frame, as_base64),
                     "analysis_result": self.latest_result,
-                    "error": "Khung hình không hợp lệ"
+                    "error": "Khung hình không hợp lệ",
+                    "invalid_input": True
                 }
             
             # Xử lý khung hình
-            processed_frame = self.process_image(frame)
+            if context is None:
+                context = FrameContext()
+            context.frame = frame
+            
+            # Cổng chuyển động: khung hình không đổi thì dùng lại kết quả, không chạy lại suy luận
+            signature = None
+            if self.motion_gate is not None:
+                unchanged, signature = self.motion_gate.check(frame)
+                if unchanged:
+                    gated = self.motion_gated_result(frame, render, as_base64, context)
+                    if gated is not None:
+                        return gated
             
-            # Encode khung hình đã xử lý thành base64
-            _, buffer = cv2.imencode('.jpg', processed_frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
-            frame_base64 = base64.b64encode(buffer).decode('utf-8')
+            processed_frame = self.process_image(frame, render=render, context=context)
+            self.update_fps()
+            if signature is not None:
+                self.motion_gate.record_analyzed(signature, context.face_landmarks, processed_frame if render else None)
+                MOTION_GATE_TOTAL.inc(result="analyzed")
+            # Kết quả kèm FPS là một dict mới, kết quả đã công bố không bị sửa
+            analysis = dict(self.latest_result, fps=round(self.fps, 2))
+            self.latest_result = analysis
+            if context is not None:
+                context.result = analysis
             
             # Trả về kết quả
+            processed_image = None
+            if render:
+                encode_start = time.perf_counter()
+                profile = self.current_output_profile()
+                processed_image = self.encode_frame(processed_frame, as_base64, profile)
+                STAGE_SECONDS.observe(time.perf_counter() - encode_start, stage="encode")
             result = {
-                "processed_image": f"data:image/jpeg;base64,{frame_base64}",
-                "analysis_result": self.latest_result
+                "processed_image": processed_image,
+                "analysis_result": analysis
             }
+            if render:
+                # Client cần biết kích thước thật của khung hình trả về để hiển thị
+                result["output_profile"] = profile
             
             return result
         except Exception as e:
             logger.error(f"Lỗi xử lý khung hình: {e}")
+            if not render:
+                return {
+                    "processed_image": None,
+                    "analysis_result": self.latest_result,
+                    "error": str(e)
+                }
             # Tạo khung hình lỗi để trả về
             try:
                 error_frame = np.zeros((480, 640, 3), dtype=np.uint8)
                 cv2.putText(error_frame, "Lỗi xử lý hình ảnh", (50, 240), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-                _, buffer = cv2.imencode('.jpg', error_frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
-                error_frame_base64 = base64.b64encode(buffer).decode('utf-8')
                 
                 return {
-                    "processed_image": f"data:image/jpeg;base64,{error_frame_base64}",
+                    "processed_image": self.encode_frame(error_frame, as_base64),
                     "analysis_result": self.latest_result,
                     "error": str(e)
                 }
@@ -424,8 +1102,127 @@ class FaceDetectionApp:
                     "error": f"Lỗi xử lý khung hình: {str(e)}"
                 }
     
-    def save_image_to_temp(self, image, direction_text):
-        """Lưu hình ảnh vào thư mục tạm và cập nhật danh sách ảnh đã chụp"""
+    def motion_gated_result(self, frame, render, as_base64, context):
+        """Kết quả cho khung hình không đổi mà không chạy lại suy luận đầy đủ, None nếu cần phân tích
+
+        Có khuôn mặt: dùng lại kết quả và landmark của khung hình đã phân tích, chỉ khi đã chụp đủ các hướng.
+        Không có khuôn mặt: chỉ chạy Face Detection để biết có người mới xuất hiện không (có thì phân tích đầy đủ).
+        """
+        gate = self.motion_gate
+        if render and gate.processed_frame is None:
+            return None
+        if self.latest_result["face_detected"] and not all(self.captured_directions.values()):
+            # Đang chụp ảnh: chớp mắt và cử động nhỏ thấp hơn nhiều so với MOTION_THRESHOLD trên chữ ký 32x24
+            # nhưng là tín hiệu của liveness, nên mọi khung hình có khuôn mặt đều được phân tích
+            return None
+        
+        kind = "cached" if self.latest_result["face_detected"] else "presence"
+        if kind == "presence":
+            image_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            detection_results, _ = self.run_graphs(image_rgb, True, False)
+            if detection_results and detection_results.detections:
+                return None
+        
+        gate.record_skip(kind)
+        MOTION_GATE_TOTAL.inc(result=kind)
+        self.update_fps()
+        analysis = dict(self.latest_result, fps=round(self.fps, 2))
+        self.latest_result = analysis
+        context.result = analysis
+        context.face_landmarks = gate.face_landmarks
+        
+        result = {
+            "processed_image": None,
+            "analysis_result": analysis,
+            "motion_gated": kind
+        }
+        if render:
+            profile = self.current_output_profile()
+            result["processed_image"] = self.encode_frame(gate.processed_frame, as_base64, profile)
+            result["output_profile"] = profile
+        return result
+
+    def update_fps(self):
+        """Cập nhật frame_count và FPS của phiên (tính lại mỗi giây)"""
+        now = time.time()
+        self.frame_count += 1
+        self.fps_frames += 1
+        if not self.start_time:
+            self.start_time = now
+        elapsed = now - self.start_time
+        if elapsed >= 1.0:
+            self.fps = self.fps_frames / elapsed
+            self.fps_frames = 0
+            self.start_time = now
+
+    def set_response_mode(self, mode):
+        """Đặt chế độ phản hồi mặc định cho phiên (full hoặc analysis)"""
+        if mode not in (RESPONSE_MODE_FULL, RESPONSE_MODE_ANALYSIS):
+            return {"success": False, "error": f"Chế độ không hợp lệ: {mode}"}
+        self.response_mode = mode
+        return {"success": True, "mode": mode}
+
+    def set_output_profile(self, profile):
+        """Thương lượng hồ sơ encode khung hình trả về (chỉ cập nhật các trường được gửi)
+
+        max_dim: cạnh dài tối đa (0 = giữ nguyên), quality: chất lượng JPEG 10-95,
+        grayscale: trả về ảnh xám, adaptive: tự động giảm theo RTT.
+        """
+        if not isinstance(profile, dict):
+            return {"success": False, "error": "Hồ sơ không hợp lệ"}
+        updated = dict(self.output_profile)
+        try:
+            if "max_dim" in profile:
+                updated["max_dim"] = int(profile["max_dim"])
+                if updated["max_dim"] < 0 or updated["max_dim"] > 4096:
+                    raise ValueError("max_dim phải trong khoảng 0-4096")
+            if "quality" in profile:
+                updated["quality"] = int(profile["quality"])
+                if not 10 <= updated["quality"] <= 95:
+                    raise ValueError("quality phải trong khoảng 10-95")
+            for key in ("grayscale", "adaptive"):
+                if key in profile:
+                    if not isinstance(profile[key], bool):
+                        raise ValueError(f"{key} phải là true/false")
+                    updated[key] = profile[key]
+        except (TypeError, ValueError) as e:
+            return {"success": False, "error": f"Hồ sơ không hợp lệ: {e}"}
+        self.output_profile = updated
+        return {"success": True, "profile": updated, "effective": self.current_output_profile()}
+
+    def record_rtt(self, rtt_ms):
+        """Ghi nhận RTT (ms) client đo được cho khung hình trước, cập nhật trung bình trượt"""
+        try:
+            rtt_ms = float(rtt_ms)
+        except (TypeError, ValueError):
+            return
+        if not 0 < rtt_ms < 60000:
+            return
+        if self.rtt_ms is None:
+            self.rtt_ms = rtt_ms
+        else:
+            self.rtt_ms += RTT_SMOOTHING * (rtt_ms - self.rtt_ms)
+
+    def current_output_profile(self):
+        """Hồ sơ encode thực tế: hồ sơ đã thương lượng, giới hạn thêm theo RTT nếu bật adaptive"""
+        profile = self.output_profile
+        max_dim = profile["max_dim"]
+        quality = profile["quality"]
+        if profile["adaptive"] and self.rtt_ms is not None:
+            for min_rtt, level_dim, level_quality in RTT_LEVELS:
+                if self.rtt_ms >= min_rtt:
+                    max_dim = min(max_dim, level_dim) if max_dim else level_dim
+                    quality = min(quality, level_quality)
+        return {"max_dim": max_dim, "quality": quality, "grayscale": profile["grayscale"]}
+
+    def save_image_to_temp(self, image, direction_text, face_landmarks=None, analysis=None, face_image=None):
+        """Lưu hình ảnh vào thư mục tạm và cập nhật danh sách ảnh đã chụp
+
+        analysis là kết quả phân tích của chính khung hình (mặc định là latest_result).
+        face_image là vùng khuôn mặt đã cắt sẵn (ứng viên của CaptureSelector); khi có, image không được dùng.
+        """
+        if analysis is None:
+            analysis = self.latest_result
         try:
             # Đổi tên hướng từ tiếng Việt sang tiếng Anh
             english_direction = direction_text
@@ -440,16 +1237,14 @@ class FaceDetectionApp:
             elif direction_text == "Cúi xuống":
                 english_direction = "down"
 
-            # Tạo tên file dựa trên thời gian và hướng
+            # Tạo tên file dựa trên thời gian, hướng và phiên chụp (tránh trùng tên giữa các phiên)
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            base_filename = f"face-{english_direction}-{timestamp}"
-            filepath = os.path.join(TEMP_DIR, f"{base_filename}.jpg")
+            base_filename = f"face-{english_direction}-{timestamp}-{self.session_id}"
+            filename = f"{base_filename}.jpg"
             
             # Đảm bảo khuôn mặt xuất hiện đầy đủ trong hình ảnh
-            face_image = self.crop_face_from_image(image)
-            
-            # Nén hình và đổi kích thước về 128x128 pixel
-            resized_face = cv2.resize(face_image, (128, 128), interpolation=cv2.INTER_AREA)
+            if face_image is None:
+                face_image = self.crop_face_from_image(image, face_landmarks)
             
             # Lấy IP của người dùng
             try:
@@ -462,14 +1257,15 @@ class FaceDetectionApp:
                 "timestamp": timestamp,
                 "direction": english_direction,  # Lưu hướng tiếng Anh trong metadata
                 "original_direction": direction_text,  # Lưu thêm hướng tiếng Việt gốc
-                "real_face_score": float(self.real_face_score),
+                "real_face_score": float(analysis["real_face_score"]),
                 "rotation": {
-                    "roll": float(self.latest_result["rotation"]["roll"]),
-                    "pitch": float(self.latest_result["rotation"]["pitch"]),
-                    "yaw": float(self.latest_result["rotation"]["yaw"])
+                    "roll": float(analysis["rotation"]["roll"]),
+                    "pitch": float(analysis["rotation"]["pitch"]),
+                    "yaw": float(analysis["rotation"]["yaw"])
                 },
                 "client_ip": client_ip,
                 "session_id": self.session_id,
+                "capture_quality": analysis.get("capture_quality"),
                 "image_size": "128x128",
                 # Thêm thông tin người dùng vào metadata
                 "user_info": {
@@ -480,45 +1276,42 @@ class FaceDetectionApp:
                 }
             }
             
-            # Lưu ảnh đã resize với chất lượng nén 80%
-            cv2.imwrite(filepath, resized_face, [cv2.IMWRITE_JPEG_QUALITY, 80])
-            
-            # Lưu metadata vào file JSON
-            metadata_filepath = os.path.join(TEMP_DIR, f"{base_filename}.json")
-            with open(metadata_filepath, 'w', encoding='utf-8') as f:
-                json.dump(metadata, f, ensure_ascii=False, indent=2)
+            # Resize về 128x128, nén JPEG 80% và ghi vào kho ảnh ở thread ghi nền;
+            # URL của ảnh hợp lệ khi ghi xong (serve_temp_image sẽ chờ nếu cần)
+            capture_writer.submit(face_image, filename, metadata)
             
             # Thêm thông tin ảnh vào danh sách đã chụp
             image_info = {
                 "id": len(self.captured_images) + 1,
-                "path": filepath,
-                "filename": f"{base_filename}.jpg",
-                "metadata_path": metadata_filepath,
+                "filename": filename,
                 "direction": english_direction,
                 "original_direction": direction_text,
                 "timestamp": timestamp,
-                "url": f"/temp_captures/{base_filename}.jpg",
-                "real_face_score": f"{self.real_face_score:.0%}",
-                "rotation": f"Roll: {self.latest_result['rotation']['roll']:.1f}°, "
-                           f"Pitch: {self.latest_result['rotation']['pitch']:.1f}°, "
-                           f"Yaw: {self.latest_result['rotation']['yaw']:.1f}°",
+                "url": f"/temp_captures/{filename}",
+                "thumbnail_url": f"/temp_captures/{filename}?size={GALLERY_THUMBNAIL_SIZE}",
+                "real_face_score": f"{analysis['real_face_score']:.0%}",
+                "rotation": f"Roll: {analysis['rotation']['roll']:.1f}°, "
+                           f"Pitch: {analysis['rotation']['pitch']:.1f}°, "
+                           f"Yaw: {analysis['rotation']['yaw']:.1f}°",
                 "user": self.user_info["fullname"]
             }
-            self.captured_images.append(image_info)
-            
-            # Cập nhật trạng thái đã chụp
-            if direction_text == "Nhìn thẳng":
-                self.captured_directions["straight"] = True
-            elif direction_text == "Quay trái":
-                self.captured_directions["left"] = True
-            elif direction_text == "Quay phải":
-                self.captured_directions["right"] = True
-            elif direction_text == "Ngẩng lên":
-                self.captured_directions["up"] = True
-            elif direction_text == "Cúi xuống":
-                self.captured_directions["down"] = True
+            with self.capture_condition:
+                self.captured_images.append(image_info)
+                
+                # Cập nhật trạng thái đã chụp
+                if direction_text == "Nhìn thẳng":
+                    self.captured_directions["straight"] = True
+                elif direction_text == "Quay trái":
+                    self.captured_directions["left"] = True
+                elif direction_text == "Quay phải":
+                    self.captured_directions["right"] = True
+                elif direction_text == "Ngẩng lên":
+                    self.captured_directions["up"] = True
+                elif direction_text == "Cúi xuống":
+                    self.captured_directions["down"] = True
+                self.capture_condition.notify_all()
                 
-            logger.info(f"Đã lưu ảnh {direction_text} ({english_direction}) của {self.user_info['fullname']} vào: {filepath}")
+            logger.info(f"Đã đưa ảnh {direction_text} ({english_direction}) của {self.user_info['fullname']} vào hàng đợi ghi: {filename}")
             
             # Kiểm tra nếu đã chụp đủ các hướng
             all_captured = all(self.captured_directions.values())
@@ -532,154 +1325,210 @@ class FaceDetectionApp:
             logger.error(f"Lỗi khi lưu ảnh: {e}")
             return {"success": False, "error": str(e)}
     
-    def check_and_capture_face(self, frame, rotation, rotation_text):
-        """Kiểm tra và chụp ảnh khuôn mặt nếu đạt tiêu chí"""
+    def get_capture_direction(self, rotation, rotation_text):
+        """Xác định hướng chưa chụp mà tư thế hiện tại thỏa mãn (None nếu không có)"""
         # Nếu đã chụp đủ 5 hướng thì không cần chụp thêm
         if all(self.captured_directions.values()):
-            return {"captured": False, "message": "Đã chụp đủ các hướng"}
-            
-        # Kiểm tra độ tin cậy
-        if self.real_face_score < 0.7:
-            return {"captured": False, "message": "Độ tin cậy nhận diện thấp"}
+            return None
             
         # Xử lý các hướng nhìn - Sử dụng YAW cho quay trái/phải và PITCH cho ngẩng lên/cúi xuống
-        captured = False
         direction = None
         
         # Yaw (Quay trái/phải)
         if rotation_text["yaw"] == "Quay trái" and not self.captured_directions["left"] and abs(rotation["yaw"]) > 15:
             direction = "Quay trái"
-            captured = True
             
         elif rotation_text["yaw"] == "Quay phải" and not self.captured_directions["right"] and abs(rotation["yaw"]) > 15:
             direction = "Quay phải"
-            captured = True
             
         # Pitch (Ngẩng lên/Cúi xuống) - với điều kiện mới đã đảo ngược
         elif rotation_text["pitch"] == "Ngẩng lên" and not self.captured_directions["up"] and rotation["pitch"] < -7:
             direction = "Ngẩng lên"
-            captured = True
             
         elif rotation_text["pitch"] == "Cúi xuống" and not self.captured_directions["down"] and rotation["pitch"] > 10:
             direction = "Cúi xuống"
-            captured = True
             
         # Nhìn thẳng: chỉ khi cả yaw và pitch đều gần 0 (không quay, không ngẩng/cúi)
         elif (abs(rotation["yaw"]) <= 10 and abs(rotation["pitch"]) <= 10) and not self.captured_directions["straight"]:
             direction = "Nhìn thẳng"
-            captured = True
         
-        # Nếu có hướng cần chụp và chưa chụp hướng này
-        if captured and direction:
-            result = self.save_image_to_temp(frame, direction)
-            return {
-                "captured": True, 
-                "direction": direction, 
-                "all_directions_captured": result.get("all_directions_captured", False)
-            }
+        return direction
+
+    def check_and_capture_face(self, frame, rotation, rotation_text, face_landmarks=None, analysis=None):
+        """Kiểm tra và chụp ảnh khuôn mặt nếu đạt tiêu chí
+
+        face_landmarks (tùy chọn) là mảng landmark của chính frame, dùng để cắt khuôn mặt không cần suy luận lại.
+        analysis (tùy chọn) là kết quả phân tích của chính frame, mặc định là latest_result.
+        """
+        if analysis is None:
+            analysis = self.latest_result
+        # Nếu đã chụp đủ 5 hướng thì không cần chụp thêm
+        if all(self.captured_directions.values()):
+            return {"captured": False, "message": "Đã chụp đủ các hướng"}
+            
+        # Kiểm tra độ tin cậy
+        if analysis["real_face_score"] < REAL_FACE_THRESHOLD:
+            # Rời khỏi tư thế hợp lệ: lưu ứng viên tốt nhất của cửa sổ đang mở (nếu có)
+            committed = self.flush_capture_candidates()
+            return committed or {"captured": False, "message": "Độ tin cậy nhận diện thấp"}
+            
+        direction = self.get_capture_direction(rotation, rotation_text)
+        
+        if self.capture_selector is None:
+            # Nếu có hướng cần chụp và chưa chụp hướng này
+            if direction:
+                result = self.save_image_to_temp(frame, direction, face_landmarks, analysis)
+                return self.capture_result(direction, result)
+            return {"captured": False}
+        
+        if not direction:
+            committed = self.flush_capture_candidates()
+            return committed or {"captured": False}
         
-        return {"captured": False}
+        # Thêm khung hình vào cửa sổ chọn ảnh của hướng; lưu ứng viên tốt nhất khi cửa sổ đóng
+        face_image = self.crop_face_from_image(frame, face_landmarks)
+        closed = self.capture_selector.offer(direction, DIRECTION_KEYS[direction], face_image, analysis)
+        if closed is None and self.capture_selector.due():
+            closed = self.capture_selector.close()
+        if closed is not None:
+            return self.commit_capture_candidate(*closed)
+        return {
+            "captured": False,
+            "pending": True,
+            "direction": direction,
+            "message": "Đang chọn ảnh rõ nhất"
+        }
     
-    def get_captured_images(self):
-        """Lấy danh sách các ảnh đã chụp"""
+    def capture_result(self, direction, save_result):
+        """Kết quả chụp ảnh trả về cho client"""
         return {
-            "images": self.captured_images, 
-            "directions": self.captured_directions,
-            "all_captured": all(self.captured_directions.values())
+            "captured": True,
+            "direction": direction,
+            "direction_key": DIRECTION_KEYS.get(direction),
+            "image_info": save_result.get("image_info"),
+            "all_directions_captured": save_result.get("all_directions_captured", False)
         }
     
+    def commit_capture_candidate(self, direction, candidate):
+        """Lưu ứng viên tốt nhất của một cửa sổ chọn ảnh"""
+        analysis = dict(candidate["analysis"], capture_quality=candidate["quality"])
+        result = self.save_image_to_temp(None, direction, analysis=analysis, face_image=candidate["face_image"])
+        return self.capture_result(direction, result)
+    
+    def flush_capture_candidates(self):
+        """Đóng cửa sổ chọn ảnh đang mở và lưu ứng viên tốt nhất; None nếu không có cửa sổ nào"""
+        if self.capture_selector is None:
+            return None
+        closed = self.capture_selector.close()
+        if closed is None:
+            return None
+        return self.commit_capture_candidate(*closed)
+    
+    def capture_from_frame(self, frame):
+        """Phân tích một khung hình BGR đã decode (chưa lật) và tự động chụp ảnh nếu thỏa điều kiện
+
+        Giống analyze_and_capture nhưng không qua decode/encode; trả về kết quả của
+        check_and_capture_face, hoặc None nếu không phát hiện khuôn mặt.
+        """
+        context = FrameContext()
+        context.frame = frame
+        self.process_image(frame, render=False, context=context)
+        analysis = context.result
+        if context.face_landmarks is None or analysis is None or not analysis["face_detected"]:
+            return None
+        return self.check_and_capture_face(
+            frame,
+            analysis["rotation"],
+            analysis["rotation_text"],
+            context.frame_landmarks(),
+            analysis
+        )
+
+    def capture_from_video(self, path, stride=None):
+        """Generator phân tích file video và tự động chụp ảnh, dừng ngay khi đã chụp đủ 5 hướng
+
+        Khung hình được decode và phân tích lần lượt (1 trên stride khung hình, mặc định VIDEO_STRIDE)
+        nên bộ nhớ không phụ thuộc độ dài video. Mỗi khung hình đã phân tích trả về
+        {"frame_index", "face_detected", "capture_result"}; ảnh chụp giống hệt khi chụp qua trình duyệt.
+        """
+        if all(self.captured_directions.values()):
+            return
+        # Khung hình của file không liên quan tới luồng đang tracking
+        self.reset_tracking()
+        self.liveness.reset()
+
+        frames = iter_video_frames(path, VIDEO_STRIDE if stride is None else stride)
+        try:
+            for index, frame in frames:
+                capture_result = self.capture_from_frame(frame)
+                yield {
+                    "frame_index": index,
+                    "face_detected": capture_result is not None,
+                    "capture_result": capture_result
+                }
+                if all(self.captured_directions.values()):
+                    break
+        finally:
+            frames.close()
+        # Hết video khi cửa sổ chọn ảnh vẫn đang mở: lưu ứng viên tốt nhất
+        capture_result = self.flush_capture_candidates()
+        if capture_result is not None:
+            yield {"frame_index": None, "face_detected": True, "capture_result": capture_result}
+
+    def capture_version(self):
+        """Phiên bản của danh sách ảnh đã chụp (dùng làm ETag): đổi khi chụp thêm ảnh hoặc đặt lại"""
+        with self.capture_condition:
+            return f"{self.session_id}-{len(self.captured_images)}"
+
+    def wait_for_capture(self, version, timeout):
+        """Chờ tối đa timeout giây đến khi phiên bản khác version, trả về phiên bản hiện tại"""
+        with self.capture_condition:
+            self.capture_condition.wait_for(lambda: self.capture_version() != version, timeout)
+            return self.capture_version()
+
+    def get_captured_images(self, since=None, session_id=None):
+        """Lấy danh sách các ảnh đã chụp
+
+        since là id của ảnh cuối cùng client đã có (kèm session_id của lần nhận trước): chỉ trả về các ảnh
+        mới hơn. Nếu phiên chụp đã được đặt lại hoặc con trỏ không hợp lệ, trả về toàn bộ danh sách với
+        "reset": True để client thay thế danh sách cũ.
+        """
+        with self.capture_condition:
+            images = self.captured_images
+            reset = True
+            if since is not None and session_id == self.session_id and 0 <= since <= len(images):
+                images = images[since:]  # id của ảnh là thứ tự trong danh sách, bắt đầu từ 1
+                reset = False
+            return {
+                "images": list(images),
+                "directions": dict(self.captured_directions),
+                "all_captured": all(self.captured_directions.values()),
+                "session_id": self.session_id,
+                "version": self.capture_version(),
+                "total": len(self.captured_images),
+                "reset": reset
+            }
+    
     def reset_captured_directions(self):
         """Đặt lại trạng thái chụp ảnh"""
-        self.captured_directions = {
-            "straight": False,
-            "left": False,
-            "right": False,
-            "up": False,
-            "down": False
-        }
-        self.captured_images = []
-        self.session_id = str(uuid.uuid4())[:8]
+        with self.capture_condition:
+            self.captured_directions = {
+                "straight": False,
+                "left": False,
+                "right": False,
+                "up": False,
+                "down": False
+            }
+            self.captured_images = []
+            self.session_id = str(uuid.uuid4())[:8]
+            self.capture_condition.notify_all()
+        if self.capture_selector is not None:
+            self.capture_selector.reset()
         return {"success": True, "message": "Đã đặt lại trạng thái chụp ảnh"}
     
-    def crop_face_from_image(self, image):
-        """Cắt khuôn mặt từ hình ảnh để đảm bảo khuôn mặt hiển thị đầy đủ"""
-        try:
-            # Chuyển sang RGB để xử lý với MediaPipe
-            image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            
-            # Phát hiện khuôn mặt sử dụng Face Mesh
-            results = self.mp_face_mesh.process(image_rgb)
-            
-            # Nếu không phát hiện được khuôn mặt, trả về hình ảnh gốc
-            if not results.multi_face_landmarks:
-                # Đảm bảo hình ảnh là vuông
-                h, w = image.shape[:2]
-                size = min(h, w)
-                top = (h - size) // 2
-                left = (w - size) // 2
-                return image[top:top+size, left:left+size]
-            
-            h, w = image.shape[:2]
-            landmarks = results.multi_face_landmarks[0].landmark
-            
-            # Tìm tọa độ khuôn mặt
-            face_coords = [(int(landmark.x * w), int(landmark.y * h)) for landmark in landmarks]
-            
-            # Tìm các điểm biên của khuôn mặt
-            x_min = min([coord[0] for coord in face_coords])
-            y_min = min([coord[1] for coord in face_coords])
-            x_max = max([coord[0] for coord in face_coords])
-            y_max = max([coord[1] for coord in face_coords])
-            
-            # Mở rộng vùng cắt để đảm bảo khuôn mặt hiển thị đầy đủ
-            face_width = x_max - x_min
-            face_height = y_max - y_min
-            
-            # Tính toán trung tâm khuôn mặt
-            center_x = (x_min + x_max) // 2
-            center_y = (y_min + y_max) // 2
-            
-            # Mở rộng hơn để lấy đầy đủ khuôn mặt và đảm bảo tỷ lệ vuông
-            # Lấy kích thước dài nhất và thêm lề
-            face_size = max(face_width, face_height)
-            padding = int(face_size * 0.5)  # Thêm 50% padding để đảm bảo khuôn mặt hiển thị đầy đủ
-            size = face_size + 2 * padding
-            
-            # Tính toán tọa độ vùng cắt, đảm bảo không vượt quá kích thước ảnh
-            left = max(0, center_x - size // 2)
-            top = max(0, center_y - size // 2)
-            right = min(w, center_x + size // 2)
-            bottom = min(h, center_y + size // 2)
-            
-            # Đảm bảo vùng cắt là vuông
-            crop_width = right - left
-            crop_height = bottom - top
-            
-            if crop_width > crop_height:
-                # Nếu chiều rộng lớn hơn, điều chỉnh top và bottom
-                diff = crop_width - crop_height
-                top = max(0, top - diff // 2)
-                bottom = min(h, bottom + diff // 2)
-            elif crop_height > crop_width:
-                # Nếu chiều cao lớn hơn, điều chỉnh left và right
-                diff = crop_height - crop_width
-                left = max(0, left - diff // 2)
-                right = min(w, right + diff // 2)
-            
-            # Cắt ảnh
-            cropped_image = image[top:bottom, left:right]
-            
-            # Kiểm tra nếu ảnh cắt thành công
-            if cropped_image.size == 0:
-                logger.warning("Ảnh cắt không hợp lệ, trả về ảnh gốc")
-                return image
-                
-            return cropped_image
-            
-        except Exception as e:
-            logger.error(f"Lỗi khi cắt ảnh khuôn mặt: {e}")
-            # Trả về hình ảnh gốc nếu có lỗi
-            return image
+    def crop_face_from_image(self, image, face_landmarks=None):
+        """Cắt khuôn mặt từ hình ảnh (xem hàm crop_face_from_image của module)"""
+        return crop_face_from_image(image, face_landmarks)
 
 # Hàm để lấy địa chỉ IP của máy chủ
 def get_local_ip():
@@ -695,67 +1544,636 @@ def get_local_ip():
 
 # Khởi tạo Flask app
 app = Flask(__name__)
-face_detector = FaceDetectionApp()
+
+# Quản lý phiên: mỗi session token có trạng thái và bộ đồ thị MediaPipe riêng
+SESSION_COOKIE = "face_session"
+SESSION_HEADER = "X-Session-Token"
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", 8))      # Số bộ đồ thị tối đa trong pool
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 600))      # Thời gian rảnh tối đa của phiên (giây)
+SESSION_LIMIT = int(os.environ.get("SESSION_LIMIT", 256))  # Số phiên tối đa (kể cả phiên không giữ đồ thị)
+
+# Số tiến trình worker suy luận (0 = chạy MediaPipe ngay trong tiến trình web)
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", 0))
+
+if INFERENCE_WORKERS > 0:
+    # Worker được khởi động lười ở khung hình đầu tiên, mỗi phiên gắn cố định với một worker
+    inference_engine = InferenceEngine(FaceGraphs, INFERENCE_WORKERS)
+    graph_pool = GraphPool(inference_engine.create_graphs, MAX_SESSIONS)
+else:
+    inference_engine = None
+    graph_pool = GraphPool(FaceGraphs, MAX_SESSIONS)
+session_manager = SessionManager(
+    lambda graph_provider: FaceDetectionApp(graph_provider=graph_provider),
+    graph_pool,
+    ttl=SESSION_TTL,
+    max_sessions=SESSION_LIMIT
+)
+
+# Bộ đồ thị cho các request phân tích một ảnh riêng lẻ (nhận diện, cắt ảnh không có landmark sẵn):
+# mỗi request mượn một bộ trong phạm vi request, không dùng chung đồ thị tracking của phiên
+ANALYSIS_GRAPHS = int(os.environ.get("ANALYSIS_GRAPHS", 2))
+ANALYSIS_LEASE_TIMEOUT = float(os.environ.get("ANALYSIS_LEASE_TIMEOUT", 10.0))
+analysis_pool = GraphPool(inference_engine.create_graphs if inference_engine else FaceGraphs, ANALYSIS_GRAPHS)
+
+def detect_face_landmarks(image):
+    """Landmark (N, 3) của khuôn mặt đầu tiên trong ảnh BGR (tọa độ của chính ảnh), None nếu không có"""
+    image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    with analysis_pool.lease(ANALYSIS_LEASE_TIMEOUT) as graphs:
+        _, face_landmarks_list = graphs.process(image_rgb, detect=False)
+    return face_landmarks_list[0] if face_landmarks_list else None
+
+# Gauge được tính khi xuất /metrics
+Gauge("face_app_active_sessions", "Số phiên đang hoạt động", lambda: session_manager.stats()["active_sessions"])
+Gauge("face_app_graph_pool_in_use", "Số bộ đồ thị MediaPipe đang được các phiên sử dụng", lambda: graph_pool.stats()["in_use"])
+Gauge("face_app_analysis_pool_in_use", "Số bộ đồ thị đang được mượn cho request phân tích ảnh", lambda: analysis_pool.stats()["in_use"])
+Gauge("face_app_capture_queue_depth", "Số ảnh chụp đang chờ ghi", lambda: capture_writer.stats()["queue_depth"])
+Gauge("face_app_indexed_faces", "Số vector khuôn mặt trong chỉ mục nhận diện", lambda: face_index.stats()["vectors"])
+Gauge("face_app_ready", "1 khi mô hình đã được nạp và làm nóng", lambda: int(readiness["ready"]))
+
+# Nạp mô hình và làm nóng: số bộ đồ thị tạo sẵn trong pool và số khung hình giả chạy qua mỗi bộ.
+# PRELOAD_MODELS=1 nạp mô hình ở thread nền ngay khi import (dùng khi chạy bằng gunicorn);
+# run.py gọi load_models() trước khi nhận request.
+PRELOAD_GRAPHS = int(os.environ.get("PRELOAD_GRAPHS", 1))
+WARMUP_FRAMES = int(os.environ.get("WARMUP_FRAMES", 3))
+PRELOAD_MODELS = os.environ.get("PRELOAD_MODELS", "0") == "1"
+
+# Trạng thái sẵn sàng của tiến trình (trả về tại /ready)
+readiness = {
+    "ready": False,
+    "loading": False,
+    "graphs": 0,
+    "warmup_frames": 0,
+    "load_time_ms": None,
+    "lazy": False,  # Sẵn sàng nhờ khung hình đầu tiên được xử lý (không nạp trước mô hình)
+    "error": None
+}
+readiness_lock = threading.Lock()
+
+def mark_ready_lazily():
+    """Đánh dấu tiến trình sẵn sàng khi không nạp trước mô hình và khung hình đầu tiên đã được xử lý thành công"""
+    with readiness_lock:
+        if readiness["ready"] or readiness["loading"]:
+            return
+        readiness.update({"ready": True, "lazy": True, "graphs": graph_pool.stats()["created"], "error": None})
+    logger.info("Đồ thị được tạo lười ở khung hình đầu tiên, tiến trình đã sẵn sàng")
+
+def synthetic_face_frame(width=640, height=480):
+    """Khung hình BGR vẽ một khuôn mặt đơn giản, đủ để Face Detection và Face Mesh chạy hết pipeline"""
+    frame = np.full((height, width, 3), (90, 110, 130), dtype=np.uint8)
+    cx, cy = width // 2, height // 2
+    cv2.ellipse(frame, (cx, cy), (95, 125), 0, 0, 360, (150, 180, 220), -1)
+    for dx in (-38, 38):
+        cv2.ellipse(frame, (cx + dx, cy - 25), (18, 9), 0, 0, 360, (255, 255, 255), -1)
+        cv2.circle(frame, (cx + dx, cy - 25), 7, (60, 40, 30), -1)
+        cv2.line(frame, (cx + dx - 22, cy - 50), (cx + dx + 22, cy - 52), (60, 50, 40), 5)
+    cv2.line(frame, (cx, cy - 15), (cx - 8, cy + 25), (120, 140, 180), 4)
+    cv2.ellipse(frame, (cx, cy + 60), (35, 12), 0, 0, 180, (80, 80, 170), -1)
+    return cv2.GaussianBlur(frame, (5, 5), 0)
+
+def warmup_graphs(graphs, frames):
+    """Chạy khung hình giả qua toàn bộ pipeline (decode, 2 mô hình, góc xoay, overlay, encode) trên bộ đồ thị"""
+    _, buffer = cv2.imencode('.jpg', synthetic_face_frame(), [cv2.IMWRITE_JPEG_QUALITY, 85])
+    frame_bytes = buffer.tobytes()
+    warmup_app = FaceDetectionApp(graphs)
+    warmup_app.detection_interval = 1  # Chạy cả hai mô hình trên mọi khung hình
+    warmup_app.motion_gate = None      # Khung hình giả giống nhau, không được bỏ qua suy luận
+    # Khung hình giả (gồm lần chạy nguội đầu tiên) không được tính vào metric độ trễ của production
+    with suppressed():
+        for _ in range(frames):
+            warmup_app.process_frame_from_client(frame_bytes, as_base64=False, response_mode=RESPONSE_MODE_FULL)
+    warmup_app.release_graphs()
+
+def load_models(graph_sets=None, warmup_frames=None):
+    """Nạp MediaPipe, tạo sẵn graph_sets bộ đồ thị trong pool và làm nóng mỗi bộ bằng warmup_frames khung hình giả
+
+    Trả về trạng thái sẵn sàng; sau khi xong /ready trả về 200.
+    """
+    graph_sets = PRELOAD_GRAPHS if graph_sets is None else graph_sets
+    warmup_frames = WARMUP_FRAMES if warmup_frames is None else warmup_frames
+    with readiness_lock:
+        if readiness["ready"] or readiness["loading"]:
+            return dict(readiness)
+        readiness["loading"] = True
+    
+    start_time = time.time()
+    try:
+        get_mediapipe()
+        graph_sets = max(1, min(graph_sets, MAX_SESSIONS))
+        created = graph_pool.prefill(graph_sets, lambda graphs: warmup_graphs(graphs, warmup_frames))
+        # Một bộ đồ thị cho request phân tích ảnh (/identify) để request đầu tiên không phải chờ tạo đồ thị
+        analysis_pool.prefill(1, lambda graphs: warmup_graphs(graphs, 1))
+        with readiness_lock:
+            readiness.update({
+                "ready": True,
+                "graphs": created,
+                "warmup_frames": created * warmup_frames,
+                "load_time_ms": round((time.time() - start_time) * 1000, 1),
+                "error": None
+            })
+        logger.info(f"Đã nạp và làm nóng {created} bộ đồ thị trong {readiness['load_time_ms']} ms")
+    except Exception as e:
+        logger.error(f"Lỗi khi nạp mô hình: {e}")
+        with readiness_lock:
+            readiness["error"] = str(e)
+    finally:
+        with readiness_lock:
+            readiness["loading"] = False
+    return dict(readiness)
+
+# Chỉ nạp trước trong tiến trình web, không nạp trong tiến trình con
+if PRELOAD_MODELS and not is_child_process():
+    threading.Thread(target=load_models, name="model-loader", daemon=True).start()
+
+@app.before_request
+def resolve_session_token():
+    """Xác định session token của request (header hoặc cookie), tạo mới nếu chưa có"""
+    token = request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+    g.new_session_token = not token
+    g.session_token = token or uuid.uuid4().hex
+
+@app.after_request
+def set_session_cookie(response):
+    """Gửi session token mới cho client qua cookie"""
+    if getattr(g, "new_session_token", False):
+        response.set_cookie(SESSION_COOKIE, g.session_token, httponly=True, samesite="Lax")
+    return response
+
+def get_face_detector():
+    """Lấy đối tượng FaceDetectionApp của phiên hiện tại"""
+    return session_manager.get(g.session_token)
 
 @app.route('/')
 def index():
     """Trang chủ của ứng dụng"""
     return render_template('index.html')
 
-@app.route('/process_frame', methods=['POST'])
-def process_frame():
-    """Endpoint xử lý khung hình từ client"""
-    if 'image' not in request.json:
-        return jsonify({"error": "Không tìm thấy dữ liệu hình ảnh"}), 400
-    
-    frame_data = request.json['image']
-    result = face_detector.process_frame_from_client(frame_data)
+# Các định dạng phản hồi của /process_frame
+RESPONSE_FORMAT_JSON = "json"          # JSON + data URL base64 (tương thích client cũ)
+RESPONSE_FORMAT_JPEG = "jpeg"          # Bytes JPEG thô, kết quả phân tích trong header X-Analysis-Result
+RESPONSE_FORMAT_ENVELOPE = "envelope"  # [4 byte độ dài JSON (big-endian)][JSON UTF-8][bytes JPEG]
+ENVELOPE_MIMETYPE = "application/x-face-envelope"
+
+def read_frame_payload():
+    """Đọc dữ liệu khung hình từ request: bytes thô, multipart hoặc JSON base64"""
+    mimetype = request.mimetype
+    if mimetype in ("application/octet-stream", "image/jpeg"):
+        return request.get_data(cache=False)
+    if mimetype == "multipart/form-data":
+        image_file = request.files.get("image")
+        return image_file.read() if image_file else None
+    data = request.get_json(silent=True)
+    if not data:
+        return None
+    return data.get("image")
+
+def get_response_mode():
+    """Chế độ phản hồi chọn cho từng request (?mode=, header X-Response-Mode hoặc trường JSON "mode")"""
+    mode = request.args.get("mode") or request.headers.get("X-Response-Mode")
+    if not mode and request.is_json:
+        data = request.get_json(silent=True) or {}
+        mode = data.get("mode")
+    if mode in (RESPONSE_MODE_FULL, RESPONSE_MODE_ANALYSIS):
+        return mode
+    return None
+
+def get_response_format():
+    """Xác định định dạng phản hồi từ tham số ?response= hoặc header Accept"""
+    response_format = request.args.get("response")
+    if response_format in (RESPONSE_FORMAT_JSON, RESPONSE_FORMAT_JPEG, RESPONSE_FORMAT_ENVELOPE):
+        return response_format
+    accept = request.accept_mimetypes
+    if accept.best == ENVELOPE_MIMETYPE:
+        return RESPONSE_FORMAT_ENVELOPE
+    if accept.best == "image/jpeg":
+        return RESPONSE_FORMAT_JPEG
+    return RESPONSE_FORMAT_JSON
+
+def pack_envelope(result, image_bytes):
+    """Envelope nhị phân: [4 byte độ dài JSON (big-endian)][JSON UTF-8 của result][bytes JPEG]"""
+    meta_bytes = json.dumps(result, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return struct.pack(">I", len(meta_bytes)) + meta_bytes + image_bytes
+
+def build_binary_response(result, response_format):
+    """Tạo phản hồi nhị phân (JPEG thô hoặc envelope) từ kết quả xử lý
+
+    Với JPEG thô, kết quả không có khung hình trả về 204 kèm header X-Analysis-Result thay vì JPEG rỗng.
+    """
+    image_bytes = result.pop("processed_image", None) or b""
+
+    if response_format == RESPONSE_FORMAT_JPEG:
+        if image_bytes:
+            response = Response(image_bytes, mimetype="image/jpeg")
+        else:
+            # Không có khung hình (khung hình bị thay thế khi đang chờ): 204, kết quả phân tích chỉ nằm trong header
+            response = Response(status=204)
+        # Header HTTP chỉ chấp nhận ASCII nên escape các ký tự Unicode
+        response.headers["X-Analysis-Result"] = json.dumps(result, separators=(",", ":"))
+        return response
+
+    return Response(pack_envelope(result, image_bytes), mimetype=ENVELOPE_MIMETYPE)
+
+def admit_and_analyze(face_detector, frame_data, as_base64=True, response_mode=None):
+    """Xử lý khung hình qua cổng tiếp nhận của phiên (khung hình mới nhất thắng)
+
+    Nếu khung hình bị một khung hình mới hơn thay thế khi đang chờ, trả về ngay kết quả
+    phân tích gần nhất của phiên với "dropped": True thay vì chờ suy luận.
+    """
+    frame_start = time.perf_counter()
+    try:
+        # Lấy (lại) bộ đồ thị trước khi xử lý để báo lỗi rõ ràng khi pool đã hết
+        face_detector.ensure_graphs()
+    except TimeoutError as e:
+        FRAMES_TOTAL.inc(result="error")
+        return {
+            "processed_image": None,
+            "analysis_result": dict(face_detector.latest_result),
+            "error": str(e),
+            "unavailable": True
+        }
+    result = face_detector.frame_slot.run(
+        lambda: analyze_and_capture(face_detector, frame_data, as_base64, response_mode)
+    )
+    if result is None:
+        FRAMES_TOTAL.inc(result="dropped")
+        result = {
+            "processed_image": None,
+            "analysis_result": dict(face_detector.latest_result),
+            "dropped": True
+        }
+    else:
+        FRAME_SECONDS.observe(time.perf_counter() - frame_start)
+        FRAMES_TOTAL.inc(result="error" if "error" in result else "processed")
+        if "error" not in result and not readiness["ready"]:
+            mark_ready_lazily()
+    return result
+
+def analyze_and_capture(face_detector, frame_data, as_base64=True, response_mode=None):
+    """Phân tích khung hình của client và tự động chụp ảnh nếu thỏa các điều kiện"""
+    # Khung hình đã decode và landmark được giữ lại để chụp ảnh không cần decode/suy luận lại
+    context = FrameContext()
+    result = face_detector.process_frame_from_client(
+        frame_data,
+        as_base64=as_base64,
+        response_mode=response_mode,
+        context=context
+    )
     
     # Kiểm tra và chụp ảnh nếu thỏa các điều kiện
     if "analysis_result" in result and result["analysis_result"]["face_detected"]:
         # Lưu khung hình gốc (không phải khung hình đã xử lý)
         try:
-            frame_data = frame_data.split(',')[1] if ',' in frame_data else frame_data
-            frame_bytes = base64.b64decode(frame_data)
-            nparr = np.frombuffer(frame_bytes, np.uint8)
-            frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            
-            if frame is not None:
+            if context.frame is not None:
                 # Kiểm tra và chụp ảnh theo các góc xoay
                 capture_result = face_detector.check_and_capture_face(
-                    frame,
+                    context.frame,
                     result["analysis_result"]["rotation"],
-                    result["analysis_result"]["rotation_text"]
+                    result["analysis_result"]["rotation_text"],
+                    context.frame_landmarks(),
+                    result["analysis_result"]
                 )
                 
                 # Thêm thông tin chụp ảnh vào kết quả
                 result["capture_result"] = capture_result
         except Exception as e:
             logger.error(f"Lỗi khi chụp ảnh tự động: {e}")
+    elif "analysis_result" in result and result["analysis_result"] is not None:
+        # Mất khuôn mặt khi cửa sổ chọn ảnh đang mở: lưu ứng viên tốt nhất đã có
+        try:
+            capture_result = face_detector.flush_capture_candidates()
+            if capture_result is not None:
+                result["capture_result"] = capture_result
+        except Exception as e:
+            logger.error(f"Lỗi khi chụp ảnh tự động: {e}")
     
-    if "error" in result and result["processed_image"] is None:
-        return jsonify(result), 500
+    return result
+
+@app.route('/process_frame', methods=['POST'])
+def process_frame():
+    """Endpoint xử lý khung hình từ client
+
+    Nhận khung hình dạng JSON {"image": "<data URL base64>"} (client cũ),
+    bytes JPEG thô (application/octet-stream) hoặc multipart (trường "image").
+    """
+    face_detector = get_face_detector()
+    frame_data = read_frame_payload()
+    if not frame_data:
+        return jsonify({"error": "Không tìm thấy dữ liệu hình ảnh"}), 400
+    
+    face_detector.record_rtt(request.headers.get("X-Client-RTT"))
+    response_mode = get_response_mode() or face_detector.response_mode
+    # Chế độ chỉ phân tích không có khung hình nên luôn trả về JSON
+    response_format = RESPONSE_FORMAT_JSON if response_mode == RESPONSE_MODE_ANALYSIS else get_response_format()
+    result = admit_and_analyze(
+        face_detector,
+        frame_data,
+        as_base64=(response_format == RESPONSE_FORMAT_JSON),
+        response_mode=response_mode
+    )
+    
+    if "error" in result:
+        # Lỗi do dữ liệu của client là 400, pool đồ thị đã hết là 503, lỗi xử lý là 500
+        result.pop("processed_image", None)
+        if result.get("unavailable"):
+            return jsonify(result), 503
+        return jsonify(result), 400 if result.get("invalid_input") else 500
+    
+    if response_format != RESPONSE_FORMAT_JSON:
+        return build_binary_response(result, response_format)
         
     return jsonify(result)
 
+if Sock is not None:
+    sock = Sock(app)
+
+    @sock.route('/ws')
+    def stream_frames(ws):
+        """Kênh WebSocket hai chiều thay cho polling /process_frame và /captured_images
+
+        Client gửi khung hình dạng bytes JPEG (message nhị phân) hoặc lệnh điều khiển dạng JSON
+        ({"type": "mode", "mode": "analysis"}, {"type": "profile", "max_dim": 480, ...},
+        {"type": "rtt", "rtt_ms": 320}). Server trả về {"type": "result", ...} cho mỗi khung hình: message
+        văn bản JSON khi không có khung hình trả về (chế độ analysis), hoặc message nhị phân dạng envelope
+        (JSON kết quả + bytes JPEG, không base64) ở chế độ full. Server chủ động đẩy {"type": "capture", ...}
+        ngay khi chụp được ảnh mới.
+        Client chỉ gửi khung hình tiếp theo sau khi nhận kết quả nên các khung hình không chồng lên nhau.
+        """
+        token = g.session_token
+        response_mode = None
+        while True:
+            message = ws.receive()
+            face_detector = session_manager.get(token)
+            
+            if isinstance(message, str):
+                # Lệnh điều khiển
+                try:
+                    command = json.loads(message)
+                except ValueError:
+                    ws.send(json.dumps({"type": "error", "error": "Lệnh không hợp lệ"}))
+                    continue
+                if command.get("type") == "mode":
+                    if command.get("mode") in (RESPONSE_MODE_FULL, RESPONSE_MODE_ANALYSIS):
+                        response_mode = command["mode"]
+                    ws.send(json.dumps({"type": "mode", "mode": response_mode or face_detector.response_mode}))
+                elif command.get("type") == "profile":
+                    profile = {key: value for key, value in command.items() if key != "type"}
+                    ws.send(json.dumps({"type": "profile", **face_detector.set_output_profile(profile)}, ensure_ascii=False))
+                elif command.get("type") == "rtt":
+                    face_detector.record_rtt(command.get("rtt_ms"))
+                continue
+            
+            result = admit_and_analyze(
+                face_detector,
+                message,
+                as_base64=False,
+                response_mode=response_mode or face_detector.response_mode
+            )
+            result["type"] = "result"
+            image_bytes = result.pop("processed_image", None)
+            if image_bytes:
+                ws.send(pack_envelope(result, image_bytes))
+            else:
+                ws.send(json.dumps(result, ensure_ascii=False))
+            
+            # Đẩy sự kiện chụp ảnh để client không phải polling /captured_images
+            capture_result = result.get("capture_result")
+            if capture_result and capture_result.get("captured"):
+                ws.send(json.dumps({
+                    "type": "capture",
+                    "image_info": capture_result.get("image_info"),
+                    "directions": face_detector.captured_directions,
+                    "all_directions_captured": capture_result.get("all_directions_captured", False)
+                }, ensure_ascii=False))
+
 @app.route('/temp_captures/<path:filename>')
 def serve_temp_image(filename):
-    """Phục vụ hình ảnh từ thư mục tạm"""
-    return send_from_directory(TEMP_DIR, filename)
+    """Phục vụ hình ảnh từ kho ảnh, chờ nếu ảnh vẫn đang trong hàng đợi ghi
+
+    ?size=<px> trả về ảnh thu nhỏ có cạnh dài nhất không lớn hơn kích thước cho phép gần nhất. Ảnh không bao giờ
+    thay đổi nên phản hồi được cache vĩnh viễn (immutable) và request có If-None-Match trùng ETag nhận 304
+    mà không cần đọc kho ảnh.
+    """
+    size = None
+    if request.args.get("size"):
+        try:
+            size = thumbnail_cache.resolve_size(max(1, int(request.args["size"])))
+        except ValueError:
+            return jsonify({"success": False, "error": "size không hợp lệ"}), 400
+    etag = filename if size is None else f"{filename}@{size}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        if not capture_writer.wait(filename, CAPTURE_WAIT_TIMEOUT):
+            return jsonify({"success": False, "error": "Ảnh đang được lưu, vui lòng thử lại"}), 503
+        if size is not None:
+            image_bytes = thumbnail_cache.get(filename, size)
+        else:
+            image_bytes = read_capture_image(filename)
+        if image_bytes is None:
+            return jsonify({"success": False, "error": "Không tìm thấy ảnh"}), 404
+        response = Response(image_bytes, mimetype='image/jpeg')
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = CAPTURE_CACHE_CONTROL
+    return response
+
+@app.route('/identify', methods=['POST'])
+def identify():
+    """Nhận diện khuôn mặt trong khung hình với các nhân viên đã đăng ký
+
+    Nhận khung hình như /process_frame; ?top_k= là số nhân viên giống nhất trả về (mặc định 5). identified là
+    nhân viên giống nhất khi điểm đạt IDENTIFY_THRESHOLD và hơn nhân viên thứ hai ít nhất IDENTIFY_MARGIN.
+    Không dùng phiên: request nhận diện chỉ mượn một bộ đồ thị của analysis_pool trong lúc suy luận.
+    """
+    frame_data = read_frame_payload()
+    if not frame_data:
+        return jsonify({"error": "Không tìm thấy dữ liệu hình ảnh"}), 400
+    try:
+        top_k = max(1, int(request.args.get("top_k", 5)))
+    except ValueError:
+        return jsonify({"error": "top_k không hợp lệ"}), 400
+    
+    start_time = time.time()
+    try:
+        frame = decode_frame_data(frame_data)
+    except Exception:
+        frame = None
+    if frame is None or frame.size == 0:
+        return jsonify({"error": "Không thể giải mã hình ảnh"}), 400
+    
+    # Ảnh nhận diện độc lập với luồng khung hình của phiên: suy luận trên bộ đồ thị mượn riêng
+    try:
+        landmarks = detect_face_landmarks(frame)
+    except TimeoutError as e:
+        return jsonify({"error": str(e)}), 503
+    if landmarks is None:
+        return jsonify({"success": True, "face_detected": False, "matches": [], "identified": None})
+    
+    # Cắt khuôn mặt theo landmark của khung hình, trích xuất đặc trưng và tìm trong chỉ mục
+    search_start = time.time()
+    face_image = crop_face_from_image(frame, landmarks)
+    # Luôn lấy ít nhất 2 nhân viên để so khoảng cách giữa kết quả tốt nhất và kết quả thứ hai
+    matches = face_index.search(face_embedder.embed(face_image), max(top_k, 2))[0]
+    margin = round(matches[0]["score"] - matches[1]["score"], 4) if len(matches) > 1 else None
+    identified = None
+    if matches and matches[0]["score"] >= IDENTIFY_THRESHOLD and (margin is None or margin >= IDENTIFY_MARGIN):
+        identified = matches[0]
+    
+    return jsonify({
+        "success": True,
+        "face_detected": True,
+        "matches": matches[:top_k],
+        "identified": identified,
+        "threshold": IDENTIFY_THRESHOLD,
+        "margin": margin,
+        "min_margin": IDENTIFY_MARGIN,
+        "search_time_ms": round((time.time() - search_start) * 1000, 2),
+        "processing_time_ms": round((time.time() - start_time) * 1000, 2)
+    })
+
+def capture_summary(capture):
+    """Các trường của ảnh chụp mà thư viện ảnh cần (không gồm email, IP của client và metadata khác)"""
+    user_info = capture.get("user_info") or {}
+    return {
+        "filename": capture["filename"],
+        "url": capture["url"],
+        "thumbnail_url": f"{capture['url']}?size={GALLERY_THUMBNAIL_SIZE}",
+        "direction": capture.get("direction"),
+        "original_direction": capture.get("original_direction"),
+        "timestamp": capture.get("timestamp"),
+        "session_id": capture.get("session_id"),
+        "real_face_score": capture.get("real_face_score"),
+        "employee_id": user_info.get("employeeId"),
+        "fullname": user_info.get("fullname"),
+        "department": user_info.get("department")
+    }
+
+@app.route('/captures', methods=['GET'])
+def query_captures():
+    """Tìm ảnh đã chụp theo employee_id, session_id, department, direction và khoảng thời gian since/until
+
+    Endpoint không yêu cầu xác thực nên chỉ trả về các trường tóm tắt của capture_summary.
+    """
+    filters = {key: request.args.get(key) for key in ("employee_id", "session_id", "department", "direction", "since", "until")}
+    try:
+        captures = capture_store.query(
+            limit=request.args.get("limit", 100),
+            offset=request.args.get("offset", 0),
+            **filters
+        )
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    captures = [capture_summary(capture) for capture in captures]
+    return jsonify({"success": True, "count": len(captures), "captures": captures})
 
 @app.route('/captured_images', methods=['GET'])
 def get_captured_images():
-    """Lấy danh sách ảnh đã chụp"""
-    return jsonify(face_detector.get_captured_images())
+    """Lấy danh sách ảnh đã chụp
+
+    Phản hồi có ETag là phiên bản của danh sách: request có If-None-Match trùng phiên bản hiện tại nhận 304.
+    ?since=<id ảnh cuối>&session=<session_id> chỉ trả về các ảnh mới hơn. ?wait=<giây> (long-poll) giữ request
+    đến khi có ảnh mới hoặc hết thời gian (tối đa CAPTURED_IMAGES_MAX_WAIT) khi phiên bản chưa đổi. Long-poll chỉ
+    bật khi server xử lý nhiều request song song bằng thread (wsgi.multithread, ví dụ gunicorn -k gthread): với worker
+    sync, giữ request sẽ chiếm cả worker nên server trả lời ngay và client quay về polling định kỳ.
+    """
+    face_detector = session_manager.find(g.session_token)
+    if face_detector is None:
+        # Route chỉ đọc không tạo phiên: phiên chưa tồn tại thì chưa có ảnh nào
+        return jsonify({
+            "images": [],
+            "directions": {key: False for key in DIRECTION_KEYS.values()},
+            "all_captured": False,
+            "session_id": None,
+            "version": None,
+            "total": 0,
+            "reset": True
+        })
+    try:
+        since = int(request.args["since"]) if request.args.get("since") else None
+        wait = min(max(0.0, float(request.args.get("wait", 0))), CAPTURED_IMAGES_MAX_WAIT)
+    except ValueError:
+        return jsonify({"success": False, "error": "since hoặc wait không hợp lệ"}), 400
+    if not request.environ.get("wsgi.multithread"):
+        wait = 0.0
+    
+    version = face_detector.capture_version()
+    if wait > 0 and request.if_none_match.contains(version):
+        version = face_detector.wait_for_capture(version, wait)
+    if request.if_none_match.contains(version):
+        response = Response(status=304)
+    else:
+        data = face_detector.get_captured_images(since, request.args.get("session"))
+        response = jsonify(data)
+        version = data["version"]
+    response.set_etag(version)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 @app.route('/reset_capture', methods=['POST'])
 def reset_capture():
     """Đặt lại trạng thái chụp ảnh"""
+    face_detector = get_face_detector()
     return jsonify(face_detector.reset_captured_directions())
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Trạng thái sẵn sàng: 200 khi mô hình đã được nạp và làm nóng, 503 nếu chưa"""
+    with readiness_lock:
+        status = dict(readiness)
+    return jsonify(status), 200 if status["ready"] else 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Metric theo định dạng text của Prometheus"""
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/session_stats', methods=['GET'])
+def session_stats():
+    """Thống kê phiên đang hoạt động và mức sử dụng pool đồ thị"""
+    stats = session_manager.stats()
+    if inference_engine is not None:
+        stats["inference_engine"] = inference_engine.stats()
+    stats["analysis_pool"] = analysis_pool.stats()
+    stats["capture_writer"] = capture_writer.stats()
+    stats["thumbnail_cache"] = thumbnail_cache.stats()
+    stats["face_index"] = face_index.stats()
+    # Endpoint giám sát không được tạo phiên (và không làm phiên khác mất đồ thị): chỉ báo phiên đã tồn tại
+    face_detector = session_manager.find(g.session_token)
+    if face_detector is None:
+        stats["current_session"] = None
+        return jsonify(stats)
+    stats["current_session"] = {
+        "frames": face_detector.frame_slot.stats(),
+        "motion_gate": face_detector.motion_gate.stats() if face_detector.motion_gate is not None else None,
+        "output": {
+            "profile": face_detector.output_profile,
+            "effective": face_detector.current_output_profile(),
+            "rtt_ms": round(face_detector.rtt_ms, 1) if face_detector.rtt_ms is not None else None
+        }
+    }
+    return jsonify(stats)
+
+@app.route('/response_mode', methods=['POST'])
+def set_response_mode():
+    """Đặt chế độ phản hồi mặc định (full/analysis) cho phiên hiện tại"""
+    face_detector = get_face_detector()
+    data = request.get_json(silent=True) or {}
+    result = face_detector.set_response_mode(data.get("mode"))
+    if not result["success"]:
+        return jsonify(result), 400
+    return jsonify(result)
+
+@app.route('/output_profile', methods=['POST'])
+def set_output_profile():
+    """Thương lượng hồ sơ encode khung hình trả về (max_dim, quality, grayscale, adaptive) cho phiên hiện tại"""
+    face_detector = get_face_detector()
+    result = face_detector.set_output_profile(request.get_json(silent=True))
+    if not result["success"]:
+        return jsonify(result), 400
+    return jsonify(result)
+
 @app.route('/register_user', methods=['POST'])
 def register_user():
     """Endpoint nhận thông tin người dùng từ client"""
+    face_detector = get_face_detector()
     try:
         user_data = request.json
         if not user_data:
@@ -0,0 +1,157 @@
+"""
+Metric nhẹ cho đường xử lý khung hình và endpoint /metrics (định dạng text của Prometheus).
+
+Histogram có các bucket cố định và Counter được cập nhật trong một lock ngắn nên
+chi phí mỗi lần ghi rất thấp. Gauge được tính bằng hàm callback khi xuất metric.
+Các metric tự đăng ký vào REGISTRY khi được tạo, giống cách dùng prometheus_client.
+Trong phạm vi suppressed(), các lần ghi metric của thread hiện tại bị bỏ qua (ví dụ
+khung hình giả khi làm nóng mô hình).
+"""
+
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Bucket mặc định (giây) cho thời gian của từng bước xử lý
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """Danh sách các metric được xuất tại /metrics"""
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Xuất tất cả metric theo định dạng text của Prometheus"""
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Số lớp suppressed() đang mở của từng thread
+_local = threading.local()
+
+
+@contextmanager
+def suppressed():
+    """Bỏ qua mọi lần ghi Counter/Histogram của thread hiện tại trong phạm vi with"""
+    _local.depth = getattr(_local, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        _local.depth -= 1
+
+
+def _recording():
+    return not getattr(_local, "depth", 0)
+
+
+class Counter:
+    """Bộ đếm tăng dần, có thể phân theo nhãn"""
+
+    type = "counter"
+
+    def __init__(self, name, help, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def inc(self, amount=1, **labels):
+        if not _recording():
+            return
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        return [f"{self.name}{_format_labels(key)} {_format_value(value)}" for key, value in values.items()]
+
+
+class Histogram:
+    """Histogram với các bucket cố định, có thể phân theo nhãn"""
+
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.series = {}  # nhãn -> [số lần theo bucket..., tổng, số lượng]
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def observe(self, value, **labels):
+        if not _recording():
+            return
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def samples(self):
+        with self.lock:
+            series = {key: list(values) for key, values in self.series.items()}
+        lines = []
+        for key, values in series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values):
+                cumulative += count
+                bucket_labels = key + (("le", _format_value(bound)),)
+                lines.append(f"{self.name}_bucket{_format_labels(bucket_labels)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(values[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {values[-1]}")
+        return lines
+
+
+class Gauge:
+    """Giá trị tức thời được lấy từ hàm callback khi xuất metric"""
+
+    type = "gauge"
+
+    def __init__(self, name, help, callback, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        registry.register(self)
+
+    def samples(self):
+        try:
+            value = self.callback()
+        except Exception:
+            return []
+        return [f"{self.name} {_format_value(value)}"]
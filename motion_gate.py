@@ -0,0 +1,70 @@
+"""
+Cổng chuyển động: bỏ qua suy luận MediaPipe khi khung hình gần như không đổi.
+
+Mỗi khung hình được thu nhỏ về một ảnh xám rất nhỏ (mặc định 32x24) làm chữ ký.
+Nếu độ lệch tuyệt đối trung bình giữa chữ ký này và chữ ký của khung hình được
+phân tích gần nhất nhỏ hơn ngưỡng, khung hình được coi là không đổi và phiên dùng
+lại kết quả phân tích trước đó. So sánh với khung hình đã phân tích (không phải
+khung hình vừa nhận) nên thay đổi chậm vẫn được tích lũy và phát hiện. Sau
+max_skips khung hình dùng lại liên tiếp, khung hình tiếp theo luôn được phân tích.
+"""
+
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    """Bộ phát hiện thay đổi khung hình của một phiên và thống kê tỷ lệ dùng lại kết quả"""
+
+    def __init__(self, threshold=2.0, max_skips=5, size=(32, 24)):
+        self.threshold = threshold  # Độ lệch trung bình (mức xám 0-255) dưới ngưỡng là không đổi
+        self.max_skips = max_skips
+        self.size = size
+        self.counts = {"analyzed": 0, "cached": 0, "presence": 0}
+        self.reset()
+
+    def reset(self):
+        """Xóa khung hình tham chiếu (khung hình tiếp theo luôn được phân tích)"""
+        self.reference = None
+        self.face_landmarks = None   # Landmark của khung hình tham chiếu (tọa độ khung hình đã lật)
+        self.processed_frame = None  # Khung hình đã vẽ overlay của khung hình tham chiếu (chế độ full)
+        self.skips = 0
+        self.last_difference = None
+
+    def signature(self, frame):
+        """Chữ ký của khung hình BGR: ảnh xám thu nhỏ (thu nhỏ trước để đổi màu trên ít điểm ảnh)"""
+        small = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(np.int16)
+
+    def check(self, frame):
+        """Trả về (không đổi, chữ ký) của khung hình so với khung hình tham chiếu"""
+        signature = self.signature(frame)
+        if self.reference is None or self.skips >= self.max_skips:
+            self.last_difference = None
+            return False, signature
+        self.last_difference = float(np.abs(signature - self.reference).mean())
+        return self.last_difference < self.threshold, signature
+
+    def record_analyzed(self, signature, face_landmarks=None, processed_frame=None):
+        """Khung hình đã được phân tích đầy đủ: trở thành khung hình tham chiếu mới"""
+        self.reference = signature
+        self.face_landmarks = face_landmarks
+        self.processed_frame = processed_frame
+        self.skips = 0
+        self.counts["analyzed"] += 1
+
+    def record_skip(self, kind):
+        """Khung hình dùng lại kết quả: "cached" (có khuôn mặt) hoặc "presence" (chỉ kiểm tra có khuôn mặt)"""
+        self.counts[kind] += 1
+        if kind == "cached":
+            self.skips += 1
+
+    def stats(self):
+        total = sum(self.counts.values())
+        skipped = self.counts["cached"] + self.counts["presence"]
+        return {
+            **self.counts,
+            "hit_rate": round(skipped / total, 4) if total else 0.0,
+            "threshold": self.threshold,
+            "last_difference": round(self.last_difference, 3) if self.last_difference is not None else None
+        }
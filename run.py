@@ -7,7 +7,6 @@ Cung cấp một giao diện dòng lệnh để chạy ứng dụng web với c
 import argparse
 import os
 import sys
-from main import app
 
 def parse_args():
     """Phân tích các đối số dòng lệnh."""
@@ -15,13 +14,41 @@ def parse_args():
     parser.add_argument('--host', default='0.0.0.0', help='Host để lắng nghe (mặc định: 0.0.0.0)')
     parser.add_argument('--port', type=int, default=5000, help='Port để lắng nghe (mặc định: 5000)')
     parser.add_argument('--debug', action='store_true', help='Chạy trong chế độ debug')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Số tiến trình worker suy luận MediaPipe (mặc định: biến môi trường INFERENCE_WORKERS hoặc 0 = không dùng worker)')
+    parser.add_argument('--import-legacy', action='store_true',
+                        help='Nhập các cặp file .jpg/.json rời trong temp_captures vào kho ảnh trước khi chạy')
+    parser.add_argument('--preload-graphs', type=int, default=None,
+                        help='Số bộ đồ thị MediaPipe tạo sẵn khi khởi động (mặc định: biến môi trường PRELOAD_GRAPHS hoặc 1)')
+    parser.add_argument('--warmup-frames', type=int, default=None,
+                        help='Số khung hình giả chạy qua mỗi bộ đồ thị để làm nóng (mặc định: biến môi trường WARMUP_FRAMES hoặc 3)')
+    parser.add_argument('--no-preload', action='store_true',
+                        help='Không nạp mô hình trước khi nhận request (nạp lười ở khung hình đầu tiên)')
     return parser.parse_args()
 
 def main():
     """Hàm main để chạy ứng dụng."""
     args = parse_args()
     
+    # Cấu hình số worker suy luận trước khi import ứng dụng
+    if args.workers is not None:
+        os.environ["INFERENCE_WORKERS"] = str(args.workers)
+    from main import app, capture_store, load_models, TEMP_DIR
+    
+    if args.import_legacy:
+        imported = capture_store.import_legacy_files(TEMP_DIR)
+        print(f"Đã nhập {imported} ảnh định dạng cũ vào kho ảnh")
+    
     print("=== Ứng Dụng Web Nhận Diện Khuôn Mặt ===")
+    
+    # Nạp và làm nóng mô hình trước khi nhận request để người dùng đầu tiên không phải chờ
+    if not args.no_preload:
+        print("Đang nạp và làm nóng mô hình...")
+        status = load_models(args.preload_graphs, args.warmup_frames)
+        if status["ready"]:
+            print(f"Mô hình sẵn sàng sau {status['load_time_ms']} ms ({status['graphs']} bộ đồ thị)")
+        else:
+            print(f"Không thể nạp mô hình: {status['error']}")
     print(f"Khởi động server tại http://{args.host}:{args.port}/")
     
     if args.debug:
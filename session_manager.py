@@ -0,0 +1,332 @@
+"""
+Quản lý phiên làm việc và pool đồ thị MediaPipe.
+
+Mỗi phiên (xác định bằng session token) có trạng thái riêng: thông tin người dùng,
+tiến độ chụp ảnh và một bộ đồ thị FaceDetection/FaceMesh riêng để việc tracking
+của các kiosk không ảnh hưởng lẫn nhau. Trạng thái phiên bị xóa khi phiên rảnh
+quá TTL, hoặc khi số phiên vượt max_sessions (phiên ít dùng nhất không giữ đồ thị bị
+loại bỏ trước) để client không gửi cookie không làm bộ nhớ tăng vô hạn. Số bộ đồ thị được giới hạn bởi GraphPool và được cấp lười ở khung hình
+đầu tiên; khi pool đã dùng hết, bộ đồ thị của phiên ít dùng nhất (LRU) bị thu hồi
+(chỉ mất trạng thái tracking) và phiên đó lấy lại đồ thị ở khung hình tiếp theo.
+FrameSlot giới hạn mỗi phiên chỉ xử lý một khung hình và giữ tối đa một khung
+hình chờ (khung hình mới nhất).
+Các request không thuộc luồng khung hình của phiên (ví dụ nhận diện một ảnh) mượn
+một bộ đồ thị riêng trong phạm vi request bằng GraphPool.lease.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class GraphPool:
+    """Pool giới hạn các bộ đồ thị MediaPipe, tạo lười khi cần và tái sử dụng sau khi trả về"""
+
+    def __init__(self, factory, max_size):
+        self.factory = factory
+        self.max_size = max_size
+        self.free = []
+        self.created = 0
+        self.in_use = 0
+        self.lock = threading.Condition()
+
+    def acquire(self):
+        """Lấy một bộ đồ thị rảnh, trả về None nếu pool đã dùng hết"""
+        with self.lock:
+            if self.free:
+                graphs = self.free.pop()
+            elif self.created < self.max_size:
+                self.created += 1
+                graphs = None
+            else:
+                return None
+            self.in_use += 1
+
+        if graphs is None:
+            try:
+                graphs = self.factory()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                    self.in_use -= 1
+                raise
+        return graphs
+
+    def release(self, graphs):
+        """Trả bộ đồ thị về pool sau khi xóa trạng thái tracking"""
+        try:
+            graphs.reset()
+        except Exception as e:
+            logger.error(f"Lỗi khi đặt lại đồ thị: {e}")
+        with self.lock:
+            self.in_use -= 1
+            self.free.append(graphs)
+            self.lock.notify()
+
+    def acquire_wait(self, timeout=None):
+        """Lấy một bộ đồ thị, chờ tối đa timeout giây nếu pool đã dùng hết (ném TimeoutError khi hết giờ)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        graphs = self.acquire()
+        while graphs is None:
+            with self.lock:
+                if not self.free and self.created >= self.max_size:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError("Không có bộ đồ thị rảnh trong pool")
+                    self.lock.wait(remaining)
+            graphs = self.acquire()
+        return graphs
+
+    @contextmanager
+    def lease(self, timeout=None):
+        """Mượn một bộ đồ thị trong phạm vi with, chờ tối đa timeout giây nếu pool đã dùng hết
+
+        Bộ đồ thị được đặt lại trạng thái tracking khi trả về nên mỗi request dùng độc quyền
+        một bộ đồ thị sạch.
+        """
+        graphs = self.acquire_wait(timeout)
+        try:
+            yield graphs
+        finally:
+            self.release(graphs)
+
+    def prefill(self, count, warmup=None):
+        """Tạo sẵn tối đa count bộ đồ thị (chạy warmup(graphs) cho mỗi bộ) rồi đưa vào danh sách rảnh"""
+        graphs_list = []
+        try:
+            for _ in range(count):
+                graphs = self.acquire()
+                if graphs is None:
+                    break
+                graphs_list.append(graphs)
+            for graphs in graphs_list:
+                if warmup is not None:
+                    warmup(graphs)
+        finally:
+            for graphs in graphs_list:
+                self.release(graphs)
+        return len(graphs_list)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": self.max_size,
+                "created": self.created,
+                "in_use": self.in_use,
+                "free": len(self.free)
+            }
+
+
+class FrameSlot:
+    """Cổng tiếp nhận khung hình của một phiên: một khung hình đang xử lý và một chỗ chờ
+
+    Khung hình mới thay thế khung hình đang chờ chưa được xử lý (khung hình mới nhất thắng);
+    khung hình bị thay thế được trả về ngay để request của nó không phải chờ suy luận.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.busy = False
+        self.waiting = None  # Vé của khung hình đang chờ: {"dropped": bool}
+        self.processed = 0
+        self.dropped = 0
+
+    def run(self, work):
+        """Chạy work() khi đến lượt; trả về None nếu khung hình bị khung hình mới hơn thay thế"""
+        ticket = {"dropped": False}
+        with self.condition:
+            if self.waiting is not None:
+                self.waiting["dropped"] = True
+                self.dropped += 1
+                self.condition.notify_all()
+            self.waiting = ticket
+            while self.busy and not ticket["dropped"]:
+                self.condition.wait()
+            if ticket["dropped"]:
+                return None
+            self.waiting = None
+            self.busy = True
+
+        try:
+            return work()
+        finally:
+            with self.condition:
+                self.busy = False
+                self.processed += 1
+                self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "busy": self.busy
+            }
+
+
+class SessionManager:
+    """Quản lý các phiên theo session token với thời gian rảnh tối đa (TTL) và thu hồi đồ thị theo LRU
+
+    session_factory(graph_provider) tạo trạng thái phiên chưa có đồ thị; phiên gọi graph_provider()
+    để lấy (hoặc lấy lại sau khi bị thu hồi) một bộ đồ thị khi cần suy luận.
+    """
+
+    def __init__(self, session_factory, graph_pool, ttl=600, acquire_timeout=30.0, max_sessions=256):
+        self.session_factory = session_factory
+        self.graph_pool = graph_pool
+        self.ttl = ttl
+        self.max_sessions = max_sessions  # Số phiên tối đa (có hoặc không có đồ thị)
+        self.acquire_timeout = acquire_timeout  # Thời gian chờ tối đa khi mọi bộ đồ thị đang được dùng
+        self.sessions = OrderedDict()  # token -> (session, thời điểm truy cập cuối)
+        self.evictions = {"ttl": 0, "lru": 0}
+        self.graph_reclaims = 0  # Số lần thu hồi đồ thị của phiên ít dùng nhất
+        self.lock = threading.Lock()
+
+    def find(self, token):
+        """Lấy phiên theo token nếu đã tồn tại; không tạo phiên và không cập nhật thời điểm truy cập"""
+        with self.lock:
+            entry = self.sessions.get(token)
+        return entry[0] if entry is not None else None
+
+    def get(self, token):
+        """Lấy phiên theo token, tạo mới (chưa cấp đồ thị) nếu chưa có"""
+        expired = []
+        with self.lock:
+            now = time.time()
+            expired = self._pop_expired(now)
+
+            entry = self.sessions.get(token)
+            if entry is not None:
+                self.sessions[token] = (entry[0], now)
+                self.sessions.move_to_end(token)
+                session = entry[0]
+            else:
+                session = None
+
+        for old_session in expired:
+            self._close(old_session)
+
+        if session is not None:
+            return session
+
+        session = self.session_factory(lambda: self._acquire_graphs(token))
+        with self.lock:
+            existing = self.sessions.get(token)
+            if existing is None:
+                self.sessions[token] = (session, time.time())
+                evicted = self._pop_over_limit(token)
+                logger.info(f"Đã tạo phiên mới {token[:8]} ({len(self.sessions)} phiên đang hoạt động)")
+        if existing is not None:
+            # Một request khác cùng token đã tạo phiên trước (phiên vừa tạo chưa có đồ thị)
+            return existing[0]
+
+        for old_session in evicted:
+            self._close(old_session)
+        return session
+
+    def _acquire_graphs(self, token):
+        """Lấy đồ thị từ pool cho phiên token, thu hồi đồ thị của phiên khác ít dùng nhất nếu pool đã đầy
+
+        Phiên bị thu hồi giữ nguyên trạng thái (thông tin người dùng, ảnh đã chụp), chỉ mất trạng thái
+        tracking. Ném TimeoutError nếu sau acquire_timeout giây vẫn không có bộ đồ thị nào.
+        """
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            graphs = self.graph_pool.acquire()
+            if graphs is not None:
+                return graphs
+
+            victim_token, victim = self._reclaim_candidate(token)
+            if victim is not None:
+                # Chờ lần suy luận đang chạy của phiên kia kết thúc rồi trả đồ thị về pool
+                graphs = victim.release_graphs()
+                if graphs is not None:
+                    self.graph_pool.release(graphs)
+                    with self.lock:
+                        self.graph_reclaims += 1
+                    logger.info(f"Thu hồi đồ thị của phiên {victim_token[:8]} (LRU) cho phiên {token[:8]}")
+                continue
+
+            # Mọi bộ đồ thị đang được trả về hoặc vừa được cấp: chờ một bộ rảnh rồi thử lại
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("Không có bộ đồ thị rảnh trong pool")
+            try:
+                return self.graph_pool.acquire_wait(min(remaining, 0.1))
+            except TimeoutError:
+                continue
+
+    def _reclaim_candidate(self, token):
+        """Phiên khác đang giữ đồ thị và được truy cập lâu nhất, (None, None) nếu không có"""
+        with self.lock:
+            for other_token, (session, _) in self.sessions.items():
+                if other_token != token and session.graphs is not None:
+                    return other_token, session
+        return None, None
+
+    def _pop_expired(self, now):
+        """Lấy ra các phiên đã quá TTL (gọi khi đang giữ lock)"""
+        expired = []
+        while self.sessions:
+            token, (session, last_access) = next(iter(self.sessions.items()))
+            if now - last_access < self.ttl:
+                break
+            self.sessions.popitem(last=False)
+            self.evictions["ttl"] += 1
+            logger.info(f"Loại bỏ phiên {token[:8]} (hết hạn TTL)")
+            expired.append(session)
+        return expired
+
+    def _pop_over_limit(self, token):
+        """Lấy ra các phiên ít dùng nhất khi số phiên vượt max_sessions (gọi khi đang giữ lock)
+
+        Ưu tiên phiên không giữ đồ thị; phiên token vừa tạo không bao giờ bị loại bỏ.
+        """
+        evicted = []
+        while len(self.sessions) > self.max_sessions:
+            candidates = [other for other in self.sessions if other != token]
+            if not candidates:
+                break
+            victim_token = next(
+                (other for other in candidates if self.sessions[other][0].graphs is None),
+                candidates[0]
+            )
+            session, _ = self.sessions.pop(victim_token)
+            self.evictions["lru"] += 1
+            logger.info(f"Loại bỏ phiên {victim_token[:8]} (vượt giới hạn {self.max_sessions} phiên, LRU)")
+            evicted.append(session)
+        return evicted
+
+    def _close(self, session):
+        graphs = session.release_graphs()
+        if graphs is not None:
+            self.graph_pool.release(graphs)
+
+    def cleanup(self):
+        """Loại bỏ các phiên đã hết hạn"""
+        with self.lock:
+            expired = self._pop_expired(time.time())
+        for session in expired:
+            self._close(session)
+        return len(expired)
+
+    def stats(self):
+        """Thống kê số phiên đang hoạt động và mức sử dụng pool đồ thị"""
+        with self.lock:
+            active = len(self.sessions)
+            with_graphs = sum(1 for session, _ in self.sessions.values() if session.graphs is not None)
+            evictions = dict(self.evictions)
+            graph_reclaims = self.graph_reclaims
+        return {
+            "active_sessions": active,
+            "sessions_with_graphs": with_graphs,
+            "ttl": self.ttl,
+            "max_sessions": self.max_sessions,
+            "evictions": evictions,
+            "graph_reclaims": graph_reclaims,
+            "graph_pool": self.graph_pool.stats()
+        }
@@ -27,11 +27,15 @@ const fpsElement = document.getElementById('fps');
 const PROCESSING_INTERVAL = 100; // Khoảng thời gian giữa các lần xử lý (ms)
 const FPS_UPDATE_INTERVAL = 1000; // Khoảng thời gian cập nhật FPS (ms)
 const SERVER_RATE_LIMIT = 1000; // Rate limit gửi đến server: 1 khung hình/giây (ms)
-const CAPTURED_IMAGES_CHECK_INTERVAL = 3000; // Khoảng thời gian kiểm tra ảnh đã chụp (ms)
+const CAPTURED_IMAGES_CHECK_INTERVAL = 3000; // Khoảng thời gian kiểm tra ảnh đã chụp khi không long-poll được (ms)
+const CAPTURED_IMAGES_LONG_POLL = 20; // Thời gian server giữ request /captured_images chờ ảnh mới (giây)
+const REAL_FACE_THRESHOLD = 0.6; // Ngưỡng real_face_score để chụp ảnh (REAL_FACE_THRESHOLD của server)
 
 // Cấu hình hiển thị
 const CONFIG = {
     showProcessedVideo: false,   // Không hiển thị video đã xử lý để giảm lag
+    clientOverlay: true,         // Chế độ chỉ phân tích: server không vẽ/encode khung hình, client tự vẽ overlay
+    useWebSocket: true,          // Dùng WebSocket (/ws) thay cho polling, tự chuyển về HTTP nếu không kết nối được
     autoCapture: true,           // Tự động chụp ảnh
     notifyOnCapture: true,       // Hiển thị thông báo khi chụp
     autoPause: true,             // Tự động dừng camera khi đã chụp đủ các hướng
@@ -44,13 +48,20 @@ const CONFIG = {
 let stream = null;
 let isProcessing = false;
 let processingInterval = null;
-let capturedImagesInterval = null;
+let capturedImagesTimer = null;      // Hẹn giờ của request /captured_images tiếp theo
+let capturedImagesPolling = false;   // Vòng long-poll /captured_images đang chạy
+// Danh sách ảnh đã chụp nhận từ /captured_images: chỉ tải phần mới (since) và dùng ETag để nhận 304 khi không đổi
+let capturedImagesState = { images: [], sessionId: null, etag: null };
 let framesSent = 0;
 let lastFpsUpdateTime = 0;
 let ctx = null;
 let lastProcessingTime = 0;
 let lastServerRequestTime = 0; // Thời điểm gửi yêu cầu cuối cùng đến server
-let pendingImageData = null;   // Lưu trữ khung hình mới nhất đang chờ gửi
+let pendingImageData = null;   // Lưu trữ khung hình mới nhất đang chờ gửi (Blob JPEG)
+let frameCanvas = null;        // Canvas dùng lại để lấy khung hình từ video
+let streamSocket = null;       // Kết nối WebSocket đang hoạt động (null nếu dùng HTTP polling)
+let streamTimer = null;        // Hẹn giờ gửi khung hình tiếp theo qua WebSocket
+let streamCapturedImages = []; // Ảnh đã chụp nhận được qua WebSocket
 let allDirectionsCaptured = false; // Đã chụp đủ các hướng hay chưa
 
 // Biến trạng thái cho tính năng tự động chụp
@@ -216,11 +227,8 @@ async function startProcessing() {
                     });
             }
             
-            // Bắt đầu xử lý frame
-            processingInterval = setInterval(processFrame, PROCESSING_INTERVAL);
-            
-            // Bắt đầu kiểm tra ảnh đã chụp
-            capturedImagesInterval = setInterval(checkCapturedImages, CAPTURED_IMAGES_CHECK_INTERVAL);
+            // Bắt đầu gửi khung hình (WebSocket hoặc HTTP polling)
+            startFrameLoop();
             
             // Cập nhật UI
             startBtn.disabled = true;
@@ -305,11 +313,8 @@ function createRetryButton() {
 function stopProcessing() {
     if (!isProcessing) return;
     
-    // Dừng interval
-    if (processingInterval) {
-        clearInterval(processingInterval);
-        processingInterval = null;
-    }
+    // Dừng WebSocket và interval
+    stopFrameLoop();
     
     // Dừng stream từ camera
     if (stream) {
@@ -377,62 +382,78 @@ function takeScreenshot() {
     console.log('Đã chụp ảnh.');
 }
 
-// Xử lý frame từ video
+// Encode canvas thành Blob JPEG
+function canvasToJpegBlob(canvas, quality) {
+    return new Promise(resolve => canvas.toBlob(resolve, 'image/jpeg', quality));
+}
+
+// Lấy khung hình hiện tại từ video dưới dạng Blob JPEG
+async function grabFrameBlob() {
+    // Dùng lại một canvas duy nhất
+    if (!frameCanvas) {
+        frameCanvas = document.createElement('canvas');
+    }
+    frameCanvas.width = video.videoWidth;
+    frameCanvas.height = video.videoHeight;
+    
+    const context = frameCanvas.getContext('2d');
+    context.drawImage(video, 0, 0, frameCanvas.width, frameCanvas.height);
+    
+    // Chuyển khung hình thành bytes JPEG thô (không qua base64)
+    return await canvasToJpegBlob(frameCanvas, 0.8);
+}
+
+// Cập nhật FPS (số khung hình đã gửi mỗi giây)
+function countFrameSent() {
+    framesSent++;
+    const now = performance.now();
+    if (now - lastFpsUpdateTime >= FPS_UPDATE_INTERVAL) {
+        const fps = Math.round(framesSent * 1000 / (now - lastFpsUpdateTime));
+        fpsElement.textContent = fps;
+        framesSent = 0;
+        lastFpsUpdateTime = now;
+    }
+}
+
+// Xử lý frame từ video (chế độ HTTP polling)
 async function processFrame() {
     if (!isProcessing || !video.videoWidth) return;
     
     const currentTime = performance.now();
     
     try {
-        // Lấy khung hình từ video
-        const canvas = document.createElement('canvas');
-        canvas.width = video.videoWidth;
-        canvas.height = video.videoHeight;
-        
-        const context = canvas.getContext('2d');
-        context.drawImage(video, 0, 0, canvas.width, canvas.height);
-        
-        // Chuyển khung hình thành base64
-        const imageData = canvas.toDataURL('image/jpeg', 0.8);
-        
-        // Lưu khung hình mới nhất
-        pendingImageData = imageData;
-        
         // Kiểm tra xem đã đến thời gian gửi yêu cầu tiếp theo chưa (rate limiting)
         if (currentTime - lastServerRequestTime < SERVER_RATE_LIMIT) {
-            // Chưa đến thời gian gửi tiếp, bỏ qua frame này
+            // Chưa đến thời gian gửi tiếp, bỏ qua frame này (không cần encode)
             return;
         }
         
         // Đã đến thời gian gửi yêu cầu mới
         lastServerRequestTime = currentTime;
         
+        pendingImageData = await grabFrameBlob();
+        if (!pendingImageData) return;
+        
         // Hiển thị chỉ báo đang gửi
         const sendingIndicator = document.getElementById('sending-indicator');
         if (sendingIndicator) {
             sendingIndicator.style.display = 'block';
         }
         
-        // Gửi đến server để xử lý
-        const response = await fetch('/process_frame', {
+        // Gửi bytes JPEG đến server để xử lý
+        const response = await fetch(CONFIG.clientOverlay ? '/process_frame?mode=analysis' : '/process_frame', {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json',
+                'Content-Type': 'application/octet-stream',
+                'Accept': 'application/json',
+                // RTT của khung hình trước để server tự giảm kích thước/chất lượng khung hình trả về
+                'X-Client-RTT': String(lastProcessingTime),
             },
-            body: JSON.stringify({
-                image: pendingImageData
-            })
+            body: pendingImageData
         });
         
         // Đếm số frame đã gửi để tính FPS
-        framesSent++;
-        const now = performance.now();
-        if (now - lastFpsUpdateTime >= FPS_UPDATE_INTERVAL) {
-            const fps = Math.round(framesSent * 1000 / (now - lastFpsUpdateTime));
-            fpsElement.textContent = fps;
-            framesSent = 0;
-            lastFpsUpdateTime = now;
-        }
+        countFrameSent();
         
         const data = await response.json();
         
@@ -441,80 +462,265 @@ async function processFrame() {
             sendingIndicator.style.display = 'none';
         }
         
-        // Tính thời gian xử lý
-        const endTime = performance.now();
-        lastProcessingTime = Math.round(endTime - currentTime);
-        processingTime.textContent = lastProcessingTime;
+        handleFrameResult(data, currentTime);
+    } catch (error) {
+        console.error('Lỗi xử lý frame:', error);
+    }
+}
+
+// Xử lý kết quả phân tích một khung hình từ server (HTTP hoặc WebSocket)
+function handleFrameResult(data, startTime) {
+    // Tính thời gian xử lý
+    const endTime = performance.now();
+    lastProcessingTime = Math.round(endTime - startTime);
+    processingTime.textContent = lastProcessingTime;
+    
+    // Kiểm tra lỗi
+    if (data.error) {
+        console.error('Lỗi từ server:', data.error);
+        return;
+    }
+    
+    // Hiển thị kết quả phân tích (không hiển thị hình ảnh đã xử lý)
+    updateAnalysisResults(data);
+    
+    // Kiểm tra kết quả chụp ảnh từ server
+    if (data.capture_result && data.capture_result.captured) {
+        const captureInfo = data.capture_result;
+        
+        // Hiển thị thông báo nếu chụp thành công
+        showNotification(`Đã chụp hướng: ${captureInfo.direction}`, 2000);
         
-        // Kiểm tra lỗi
-        if (data.error) {
-            console.error('Lỗi từ server:', data.error);
-            return;
+        // Cập nhật trạng thái chụp theo thông tin từ server
+        if (captureInfo.direction_key && capturedDirections[captureInfo.direction_key] !== undefined) {
+            capturedDirections[captureInfo.direction_key] = true;
+            // Cập nhật chỉ báo hướng trong UI
+            updateDirectionIndicators();
         }
         
-        // Hiển thị kết quả phân tích (không hiển thị hình ảnh đã xử lý)
-        updateAnalysisResults(data);
-        
-        // Kiểm tra kết quả chụp ảnh từ server
-        if (data.capture_result && data.capture_result.captured) {
-            const captureInfo = data.capture_result;
-            
-            // Hiển thị thông báo nếu chụp thành công
-            showNotification(`Đã chụp hướng: ${captureInfo.direction}`, 2000);
-            
-            // Cập nhật trạng thái chụp theo thông tin từ server
-            if (captureInfo.direction_key && capturedDirections[captureInfo.direction_key] !== undefined) {
-                capturedDirections[captureInfo.direction_key] = true;
-                // Cập nhật chỉ báo hướng trong UI
-                updateDirectionIndicators();
-            }
+        // Kiểm tra nếu đã chụp đủ các hướng
+        if (captureInfo.all_directions_captured) {
+            showNotification('Đã thu thập đủ tất cả các hướng khuôn mặt!', 5000);
+            allDirectionsCaptured = true;
             
-            // Kiểm tra nếu đã chụp đủ các hướng
-            if (captureInfo.all_directions_captured) {
-                showNotification('Đã thu thập đủ tất cả các hướng khuôn mặt!', 5000);
-                allDirectionsCaptured = true;
+            // Tự động dừng camera ngay khi nhận được thông báo đã chụp đủ các hướng
+            if (CONFIG.autoPause || CONFIG.alwaysStopWhenComplete) {
+                console.log('Đã chụp đủ các hướng, chuẩn bị dừng camera...');
                 
-                // Tự động dừng camera ngay khi nhận được thông báo đã chụp đủ các hướng
-                if (CONFIG.autoPause || CONFIG.alwaysStopWhenComplete) {
-                    console.log('Đã chụp đủ các hướng, chuẩn bị dừng camera...');
+                // Thêm độ trễ ngắn để người dùng thấy hình ảnh cuối cùng
+                setTimeout(() => {
+                    // Dừng và ngắt camera
+                    stopProcessing();
+                    showNotification('Đã tự động dừng camera khi thu thập đủ ảnh', 4000);
                     
-                    // Thêm độ trễ ngắn để người dùng thấy hình ảnh cuối cùng
-                    setTimeout(() => {
-                        // Dừng và ngắt camera
-                        stopProcessing();
-                        showNotification('Đã tự động dừng camera khi thu thập đủ ảnh', 4000);
-                        
-                        // Hiển thị thông báo hoàn thành rõ ràng cho người dùng
-                        const completionMessage = document.createElement('div');
-                        completionMessage.id = 'capture-completion-message';
-                        completionMessage.className = 'alert alert-success';
-                        completionMessage.innerHTML = '<strong>Hoàn thành!</strong> Đã thu thập đủ 5 hướng khuôn mặt. Bạn có thể nhấn "Bắt đầu lại" để chụp bộ mới.';
-                        
-                        // Chèn thông báo vào trang
-                        const controlsContainer = document.querySelector('.controls-container');
-                        if (controlsContainer) {
-                            // Xóa thông báo cũ nếu có
-                            const oldMessage = document.getElementById('capture-completion-message');
-                            if (oldMessage) {
-                                oldMessage.remove();
-                            }
-                            
-                            controlsContainer.insertBefore(completionMessage, controlsContainer.firstChild);
+                    // Hiển thị thông báo hoàn thành rõ ràng cho người dùng
+                    const completionMessage = document.createElement('div');
+                    completionMessage.id = 'capture-completion-message';
+                    completionMessage.className = 'alert alert-success';
+                    completionMessage.innerHTML = '<strong>Hoàn thành!</strong> Đã thu thập đủ 5 hướng khuôn mặt. Bạn có thể nhấn "Bắt đầu lại" để chụp bộ mới.';
+                    
+                    // Chèn thông báo vào trang
+                    const controlsContainer = document.querySelector('.controls-container');
+                    if (controlsContainer) {
+                        // Xóa thông báo cũ nếu có
+                        const oldMessage = document.getElementById('capture-completion-message');
+                        if (oldMessage) {
+                            oldMessage.remove();
                         }
                         
-                        // Thay đổi nút "Bắt đầu" để hiển thị "Bắt đầu lại"
-                        const startBtn = document.getElementById('start-btn');
-                        if (startBtn) {
-                            startBtn.innerHTML = '<i class="fas fa-redo"></i> Bắt đầu lại';
-                            startBtn.classList.add('restart-btn');
-                        }
-                    }, CONFIG.autoStopDelay);
-                }
+                        controlsContainer.insertBefore(completionMessage, controlsContainer.firstChild);
+                    }
+                    
+                    // Thay đổi nút "Bắt đầu" để hiển thị "Bắt đầu lại"
+                    const startBtn = document.getElementById('start-btn');
+                    if (startBtn) {
+                        startBtn.innerHTML = '<i class="fas fa-redo"></i> Bắt đầu lại';
+                        startBtn.classList.add('restart-btn');
+                    }
+                }, CONFIG.autoStopDelay);
             }
         }
+    }
+}
+
+// Kết nối kênh WebSocket, trả về true nếu kết nối thành công
+function connectStream() {
+    return new Promise(resolve => {
+        if (!CONFIG.useWebSocket || !window.WebSocket) {
+            resolve(false);
+            return;
+        }
+        
+        const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+        let socket;
+        try {
+            socket = new WebSocket(`${protocol}//${window.location.host}/ws`);
+        } catch (error) {
+            console.warn('Không thể tạo WebSocket:', error);
+            resolve(false);
+            return;
+        }
+        socket.binaryType = 'arraybuffer';
         
+        const timeout = setTimeout(() => {
+            socket.close();
+            resolve(false);
+        }, 3000);
+        
+        socket.onopen = () => {
+            clearTimeout(timeout);
+            streamSocket = socket;
+            if (CONFIG.clientOverlay) {
+                socket.send(JSON.stringify({ type: 'mode', mode: 'analysis' }));
+            } else {
+                socket.send(JSON.stringify({ type: 'profile', ...outputProfile() }));
+            }
+            resolve(true);
+        };
+        socket.onerror = () => {
+            clearTimeout(timeout);
+            resolve(false);
+        };
+        socket.onmessage = handleStreamMessage;
+        socket.onclose = () => {
+            const wasActive = streamSocket === socket;
+            streamSocket = null;
+            // Mất kết nối khi đang xử lý: chuyển sang HTTP polling
+            if (wasActive && isProcessing) {
+                console.warn('Mất kết nối WebSocket, chuyển sang HTTP polling');
+                startPolling();
+            }
+        };
+    });
+}
+
+// Gửi khung hình tiếp theo qua WebSocket (chỉ gửi khi đã nhận kết quả khung hình trước)
+async function sendStreamFrame() {
+    if (!isProcessing || !streamSocket || streamSocket.readyState !== WebSocket.OPEN) return;
+    
+    try {
+        const blob = await grabFrameBlob();
+        if (!blob || !streamSocket) return;
+        if (lastProcessingTime > 0) {
+            streamSocket.send(JSON.stringify({ type: 'rtt', rtt_ms: lastProcessingTime }));
+        }
+        lastServerRequestTime = performance.now();
+        streamSocket.send(blob);
+        countFrameSent();
     } catch (error) {
-        console.error('Lỗi xử lý frame:', error);
+        console.error('Lỗi gửi khung hình qua WebSocket:', error);
+    }
+}
+
+// Tách envelope nhị phân [4 byte độ dài JSON][JSON][bytes JPEG] thành kết quả và ảnh JPEG (Blob)
+function parseEnvelope(buffer) {
+    const metaLength = new DataView(buffer).getUint32(0);
+    const data = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, metaLength)));
+    if (buffer.byteLength > 4 + metaLength) {
+        data.processed_image = new Blob([buffer.slice(4 + metaLength)], { type: 'image/jpeg' });
+    }
+    return data;
+}
+
+// Xử lý message từ server qua WebSocket (văn bản JSON, hoặc envelope nhị phân khi có khung hình trả về)
+function handleStreamMessage(event) {
+    let data;
+    try {
+        data = typeof event.data === 'string' ? JSON.parse(event.data) : parseEnvelope(event.data);
+    } catch (error) {
+        console.error('Message WebSocket không hợp lệ:', error);
+        return;
+    }
+    
+    if (data.type === 'result') {
+        handleFrameResult(data, lastServerRequestTime);
+        
+        // Lên lịch gửi khung hình tiếp theo theo giới hạn tốc độ
+        const elapsed = performance.now() - lastServerRequestTime;
+        streamTimer = setTimeout(sendStreamFrame, Math.max(0, SERVER_RATE_LIMIT - elapsed));
+    } else if (data.type === 'capture') {
+        // Server chủ động đẩy ảnh vừa chụp, không cần polling /captured_images
+        if (data.image_info) {
+            streamCapturedImages.push(data.image_info);
+        }
+        updateServerCapturedImages({
+            images: streamCapturedImages,
+            directions: data.directions
+        });
+    }
+}
+
+// Hồ sơ khung hình trả về: không lớn hơn kích thước hiển thị của khung xem trước
+function outputProfile() {
+    const scale = window.devicePixelRatio || 1;
+    const maxDim = Math.round(Math.max(overlay.clientWidth, overlay.clientHeight) * scale);
+    return { max_dim: maxDim > 0 ? maxDim : 0 };
+}
+
+// Bắt đầu gửi khung hình: ưu tiên WebSocket, nếu không được thì dùng HTTP polling
+async function startFrameLoop() {
+    streamCapturedImages = [];
+    if (await connectStream()) {
+        console.log('Đang dùng WebSocket để gửi khung hình.');
+        sendStreamFrame();
+    } else {
+        startPolling();
+    }
+}
+
+// Bắt đầu HTTP polling (dự phòng khi không có WebSocket)
+function startPolling() {
+    if (!isProcessing || processingInterval) return;
+    
+    if (!CONFIG.clientOverlay) {
+        fetch('/output_profile', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(outputProfile())
+        }).catch(error => console.warn('Không thể đặt hồ sơ khung hình trả về:', error));
+    }
+    
+    // Bắt đầu xử lý frame
+    processingInterval = setInterval(processFrame, PROCESSING_INTERVAL);
+    
+    // Bắt đầu kiểm tra ảnh đã chụp
+    capturedImagesState = { images: [], sessionId: null, etag: null };
+    capturedImagesPolling = true;
+    pollCapturedImages();
+}
+
+// Vòng long-poll /captured_images: gửi request tiếp theo ngay khi request trước trả về;
+// chỉ chờ CAPTURED_IMAGES_CHECK_INTERVAL khi lỗi hoặc server trả 304 ngay (long-poll bị tắt)
+async function pollCapturedImages() {
+    capturedImagesTimer = null;
+    const startTime = performance.now();
+    const status = await checkCapturedImages();
+    if (!capturedImagesPolling) return;
+    
+    const returnedEarly = status === 'unchanged' && performance.now() - startTime < 1000;
+    const delay = status === 'error' || returnedEarly ? CAPTURED_IMAGES_CHECK_INTERVAL : 0;
+    capturedImagesTimer = setTimeout(pollCapturedImages, delay);
+}
+
+// Dừng kênh WebSocket và HTTP polling
+function stopFrameLoop() {
+    if (processingInterval) {
+        clearInterval(processingInterval);
+        processingInterval = null;
+    }
+    capturedImagesPolling = false;
+    if (capturedImagesTimer) {
+        clearTimeout(capturedImagesTimer);
+        capturedImagesTimer = null;
+    }
+    if (streamTimer) {
+        clearTimeout(streamTimer);
+        streamTimer = null;
+    }
+    if (streamSocket) {
+        const socket = streamSocket;
+        streamSocket = null;
+        socket.close();
     }
 }
 
@@ -522,6 +728,9 @@ async function processFrame() {
 function updateAnalysisResults(data) {
     // Hiển thị kết quả phân tích
     const result = data.analysis_result;
+    if (result && CONFIG.clientOverlay) {
+        drawAnalysisOverlay(result);
+    }
     if (result) {
         // Cập nhật trạng thái nhận diện
         detectionStatus.textContent = result.face_detected ? 'Đã phát hiện khuôn mặt' : 'Không phát hiện khuôn mặt';
@@ -548,6 +757,44 @@ function updateAnalysisResults(data) {
     }
 }
 
+// Vẽ overlay (khung khuôn mặt và điểm mốc) từ kết quả phân tích của server
+function drawAnalysisOverlay(result) {
+    if (!ctx) return;
+    
+    const w = overlay.width;
+    const h = overlay.height;
+    ctx.clearRect(0, 0, w, h);
+    
+    if (!result.face_detected) return;
+    
+    // Server phân tích trên khung hình đã lật (gương) nên cần lật lại tọa độ x
+    const toX = x => (1 - x) * w;
+    const toY = y => y * h;
+    
+    // Vẽ khung nhận diện và các điểm chính của face detection
+    (result.detections || []).forEach(det => {
+        const box = det.box;
+        ctx.strokeStyle = result.real_face_score >= REAL_FACE_THRESHOLD ? '#00ff00' : '#ff0000';
+        ctx.lineWidth = 2;
+        ctx.strokeRect(toX(box.xmin + box.width), toY(box.ymin), box.width * w, box.height * h);
+        
+        ctx.fillStyle = '#ff0000';
+        det.keypoints.forEach(([x, y]) => {
+            ctx.beginPath();
+            ctx.arc(toX(x), toY(y), 3, 0, 2 * Math.PI);
+            ctx.fill();
+        });
+    });
+    
+    // Vẽ các điểm mốc chính của face mesh
+    ctx.fillStyle = '#00a0ff';
+    Object.values(result.landmarks || {}).forEach(([x, y]) => {
+        ctx.beginPath();
+        ctx.arc(toX(x), toY(y), 2, 0, 2 * Math.PI);
+        ctx.fill();
+    });
+}
+
 // Kiểm tra hướng nhìn và tự động chụp ảnh
 function handleAutoCaptureCheck(rotation, rotationText) {
     const now = Date.now();
@@ -872,13 +1119,30 @@ function updateDirectionIndicators() {
     }
 }
 
-// Kiểm tra ảnh đã chụp từ server
+// Kiểm tra ảnh đã chụp từ server, trả về 'changed', 'unchanged' (304) hoặc 'error'
 async function checkCapturedImages() {
-    if (!isProcessing) return;
+    if (!isProcessing) return 'error';
     
     try {
-        const response = await fetch('/captured_images');
-        const data = await response.json();
+        const params = new URLSearchParams({ wait: CAPTURED_IMAGES_LONG_POLL });
+        if (capturedImagesState.sessionId) {
+            // id của ảnh tăng dần từ 1 nên số ảnh đã có là id của ảnh cuối cùng
+            params.set('since', capturedImagesState.images.length);
+            params.set('session', capturedImagesState.sessionId);
+        }
+        const headers = capturedImagesState.etag ? { 'If-None-Match': capturedImagesState.etag } : {};
+        const response = await fetch(`/captured_images?${params}`, { headers, cache: 'no-store' });
+        if (response.status === 304) return 'unchanged';
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        
+        // Ghép phần ảnh mới vào danh sách đã có (thay thế toàn bộ nếu phiên chụp đã được đặt lại)
+        const delta = await response.json();
+        capturedImagesState = {
+            images: delta.reset ? delta.images : capturedImagesState.images.concat(delta.images),
+            sessionId: delta.session_id,
+            etag: response.headers.get('ETag')
+        };
+        const data = { ...delta, images: capturedImagesState.images };
         
         if (data.all_captured && !allDirectionsCaptured) {
             // Đã chụp đủ các hướng, thông báo cho người dùng
@@ -952,8 +1216,10 @@ async function checkCapturedImages() {
                 }
             }
         }
+        return 'changed';
     } catch (error) {
         console.error('Lỗi khi kiểm tra ảnh đã chụp:', error);
+        return 'error';
     }
 }
 
@@ -991,7 +1257,8 @@ function updateServerCapturedImages(data) {
         
         // Tạo ảnh thumbnail
         const thumbnail = document.createElement('img');
-        thumbnail.src = img.url;  // Sử dụng URL từ server
+        // Ảnh thu nhỏ từ server (được trình duyệt cache vĩnh viễn nên vẽ lại không tải lại ảnh)
+        thumbnail.src = img.thumbnail_url || img.url;
         thumbnail.alt = img.filename;
         thumbnail.loading = 'lazy'; // Lazy loading
         
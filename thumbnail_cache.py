@@ -0,0 +1,89 @@
+"""
+Ảnh thu nhỏ của ảnh chụp cho thư viện ảnh và các trang quản trị.
+
+Ảnh chụp không bao giờ thay đổi sau khi được ghi (tên file chứa thời điểm chụp và
+phiên) nên ảnh thu nhỏ chỉ cần tạo một lần cho mỗi cặp (tên file, kích thước) rồi
+giữ trong bộ nhớ đệm LRU giới hạn số mục. Kích thước yêu cầu được làm tròn lên một
+trong các kích thước cho phép để số biến thể của mỗi ảnh bị giới hạn.
+"""
+
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+class ThumbnailCache:
+    """Bộ đệm LRU ảnh thu nhỏ JPEG theo (tên file, kích thước)"""
+
+    def __init__(self, loader, sizes=(48, 64, 96), max_entries=512, jpeg_quality=80):
+        self.loader = loader  # loader(tên file) -> bytes JPEG gốc hoặc None
+        self.sizes = sorted(sizes)
+        self.max_entries = max_entries
+        self.jpeg_quality = jpeg_quality
+        self.entries = OrderedDict()  # (tên file, kích thước) -> bytes JPEG
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def resolve_size(self, size):
+        """Kích thước cho phép nhỏ nhất không nhỏ hơn size, None nếu size lớn hơn mọi kích thước (dùng ảnh gốc)"""
+        for allowed in self.sizes:
+            if size <= allowed:
+                return allowed
+        return None
+
+    def get(self, filename, size):
+        """Bytes JPEG của ảnh thu nhỏ có cạnh dài nhất là size, None nếu không đọc được ảnh gốc"""
+        key = (filename, size)
+        with self.lock:
+            thumbnail = self.entries.get(key)
+            if thumbnail is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return thumbnail
+            self.misses += 1
+
+        # Tạo ngoài lock: hai request cùng lúc có thể cùng tạo một ảnh, kết quả giống nhau
+        image_bytes = self.loader(filename)
+        if image_bytes is None:
+            return None
+        thumbnail = self.render(image_bytes, size)
+        if thumbnail is None:
+            return None
+
+        with self.lock:
+            self.entries[key] = thumbnail
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return thumbnail
+
+    def render(self, image_bytes, size):
+        """Thu nhỏ ảnh JPEG để cạnh dài nhất bằng size (không phóng to ảnh nhỏ hơn)"""
+        image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            return None
+        height, width = image.shape[:2]
+        scale = size / max(height, width)
+        if scale < 1.0:
+            image = cv2.resize(
+                image,
+                (max(1, round(width * scale)), max(1, round(height * scale))),
+                interpolation=cv2.INTER_AREA
+            )
+        ok, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        return buffer.tobytes() if ok else None
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "sizes": self.sizes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0
+            }